@@ -0,0 +1,116 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import logging
+
+from mqtt_topic_filter import is_topic_level
+from threading import Lock
+from time import time
+
+FOREGROUND = "FOREGROUND"
+BACKGROUND = "BACKGROUND"
+STOPPED = "STOPPED"
+
+
+class AppStateTracker:
+    """
+    Keeps the state of the applications of a device in memory and publishes every change of state
+
+    The states follow the outcome of the lifecycle requests handled by the device: a launched application comes to
+    the FOREGROUND and sends the previous one to the BACKGROUND, an exited application takes the state of the exit
+    response and a restart stops them all. A port learning of a change by other means, e.g. the user pressing the
+    home button, reports it with update. The state of an application never seen is None, to be asked to the port.
+
+    Each change is published on <topic>/<appId> as a retained message, so a controller subscribing to <topic>/+
+    receives the current state of every application and then their changes, instead of polling get-state.
+    """
+
+    def __init__(self, topic=None, publish=None):
+        """
+        :param topic: (optional) the topic the states are published under, e.g. dab/applications/state
+        :param publish: (optional) a function accepting a topic and a payload object, publishing a retained message.
+                        A tracker created by a port before its device is given its topic and publish function by
+                        new_dab_0_1_device, see bind
+        """
+        self.logger = logging.getLogger('dab.applications.state')
+        self.topic = topic
+        self.publish = publish
+        # the lock also keeps the retained messages of an application in the order of its changes
+        self._lock = Lock()
+        self._states = {}
+
+    def bind(self, topic, publish):
+        """
+        Sets the topic and the publish function. The states tracked before are published on their next change
+        """
+        with self._lock:
+            self.topic = topic
+            self.publish = publish
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, app_id):
+        """
+        Returns the state of an application, or None when it has not been tracked yet
+        """
+        return self._states.get(app_id)
+
+    def states(self):
+        """
+        Returns a dictionary of the tracked application identifiers to their state
+        """
+        with self._lock:
+            return dict(self._states)
+
+    def update(self, app_id, state):
+        """
+        Sets the state of an application, publishing it if it changed.
+        Raises a ValueError if the application identifier is not a single topic level
+        """
+        if not is_topic_level(app_id):
+            raise ValueError(f"The application identifier must be a single topic level. app_id={app_id}")
+        with self._lock:
+            self._set(app_id, state)
+
+    def _set(self, app_id, state):
+        if self._states.get(app_id) == state:
+            return
+        self._states[app_id] = state
+        self.logger.info("Application %s is %s", app_id, state)
+        self._publish(app_id, state)
+
+    def _publish(self, app_id, state):
+        if self.publish is not None:
+            self.publish(self.topic + '/' + app_id, {"appId": app_id, "state": state, "timestamp": int(time() * 1000)})
+
+    def launched(self, app_id):
+        with self._lock:
+            for other_app_id, state in list(self._states.items()):
+                if state == FOREGROUND and other_app_id != app_id:
+                    self._set(other_app_id, BACKGROUND)
+            self._set(app_id, FOREGROUND)
+
+    def exited(self, app_id, state):
+        self.update(app_id, state)
+
+    def restarted(self):
+        with self._lock:
+            for app_id in list(self._states):
+                self._set(app_id, STOPPED)
@@ -0,0 +1,89 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import asyncio
+
+from dab_client import DabClient
+from dab_mqtt_client import DabMqttTimeoutException
+
+
+class AsyncDabClient(DabClient):
+    """
+    Sample DAB client based on the AsyncDabMqttClient implementation
+
+    It offers the same operations as the DabClient, each one returning an awaitable:
+
+        response = await async_dab_client.list_apps()
+    """
+
+    def __init__(self, async_dab_mqtt_client, topic_prefix=None, cache=None):
+        super(AsyncDabClient, self).__init__(dab_mqtt_client=async_dab_mqtt_client, topic_prefix=topic_prefix,
+                                             cache=cache)
+
+    async def _request(self, topic, payload, timeout_s=5):
+        if self.cache is None:
+            return await self.dab_mqtt_client.request(self._topic(topic), payload, timeout_s)
+
+        response = self.cache.get(topic, payload)
+        if response is not None:
+            return response
+
+        self.cache.invalidate_for_request(topic)
+        response = await self.dab_mqtt_client.request(self._topic(topic), payload, timeout_s)
+        # a read racing with this request may have cached a stale response in the meantime
+        self.cache.invalidate_for_request(topic)
+        self.cache.put(topic, payload, response)
+        return response
+
+    async def _retained(self, topic, timeout_s):
+        if self.cache is not None:
+            message = self.cache.get(topic, None)
+            if message is not None:
+                return message
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_message(message_topic, message):
+            del message_topic
+            if message is not None:
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(message))
+
+        subscription = self.dab_mqtt_client.subscribe(self._topic(topic), on_message)
+        try:
+            return await asyncio.wait_for(future, timeout_s)
+        except asyncio.TimeoutError:
+            raise DabMqttTimeoutException(f"No retained message received. Topic={topic}")
+        finally:
+            subscription.close()
+
+    async def _request_with_progress(self, topic, payload, timeout_s, progress_topic, on_progress):
+        loop = asyncio.get_running_loop()
+
+        def on_message(message_topic, message):
+            del message_topic
+            if message is not None:
+                loop.call_soon_threadsafe(on_progress, message)
+
+        subscription = self.dab_mqtt_client.subscribe(self._topic(progress_topic), on_message)
+        try:
+            return await self._request(topic, payload, timeout_s)
+        finally:
+            subscription.close()
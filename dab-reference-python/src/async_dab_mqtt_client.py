@@ -0,0 +1,171 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import asyncio
+
+from dab_mqtt_client import DabMqttClient, DabMqttTimeoutException
+from uuid import uuid4
+
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class AsyncDabMqttClient(DabMqttClient):
+    """
+    A DabMqttClient whose requests are coroutines running on an asyncio event loop
+
+    The MQTT network traffic still runs on the client thread; responses resolve asyncio futures on the event loop,
+    so any number of requests can be outstanding without holding an OS thread per request.
+    """
+
+    def __init__(self, client_id, request_handlers=[], retained_messages=[],
+                 response_topic_filter=None, transport=None, codec=None, metrics=None, compression=None,
+                 qos_policy=None, response_client_id=None):
+        """
+        :param client_id: MQTT client identifier, for MQTT diagnostic purposes
+        :param request_handlers: a list of request handlers this client supports
+        :param retained_messages: a list of messages to be published once the client is connected to the broker
+        :param response_topic_filter: (optional) a topic filter the responses of the devices not advertising
+                                      CLIENT_RESPONSE_TOPICS are received through, see DabMqttClient
+        :param transport: (optional) the MQTT transport, see DabMqttClient
+        :param codec: (optional) the payload serializer, see DabMqttClient
+        :param metrics: (optional) a DabMetrics recording the requests of this client, see DabMqttClient
+        :param compression: (optional) a PayloadCompression negotiated with the devices, see DabMqttClient
+        :param qos_policy: (optional) a dictionary of topic filters to the QoS of the requests, see DabMqttClient
+        :param response_client_id: (optional) the identifier the responses are published to this client under, see
+                                   DabMqttClient. Defaults to a random identifier, so that the responses of the devices
+                                   advertising CLIENT_RESPONSE_TOPICS are received through a single subscription
+        """
+        super(AsyncDabMqttClient, self).__init__(client_id=client_id,
+                                                 request_handlers=request_handlers,
+                                                 retained_messages=retained_messages,
+                                                 response_topic_filter=response_topic_filter,
+                                                 transport=transport,
+                                                 codec=codec,
+                                                 metrics=metrics,
+                                                 compression=compression,
+                                                 qos_policy=qos_policy,
+                                                 response_client_id=response_client_id if response_client_id
+                                                 is not None else uuid4().hex)
+
+    async def connect(self, host, port):
+        """
+        Connects to the MQTT broker on the specified host and port, without blocking the event loop.
+        Times out after 15 seconds
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, super(AsyncDabMqttClient, self).connect, host, port)
+
+    async def request(self, topic, payload, timeout_s=5, request_id=None):
+        """
+        Makes a request to the DAB-enabled device, using the request/response convention
+        This coroutine will automatically generate the request ID and append it to the request
+        Unless the operation times out, this coroutine will deserialize the response and return the object
+
+        :param topic: DAB topic, with no trailing forward slash and without the request_id
+        :param payload: an object to be serialized into JSON and sent to the DAB-enabled device
+        :param timeout_s: (optional) request timeout, expressed in seconds (default value is 5 seconds)
+        :param request_id: (optional) the request ID, see send_request. When None (default) a new one is generated
+        """
+        self.logger.info("Request: topic=%s, payload=%s", topic, payload)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        message_in_flight = self.send_request(
+            topic, payload, lambda response: loop.call_soon_threadsafe(_set_future_result, future, response), timeout_s,
+            request_id)
+
+        try:
+            response = self.codec.decode(await asyncio.wait_for(future, timeout_s))
+        except asyncio.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.request_timed_out(topic)
+            raise DabMqttTimeoutException(f"Operation timed out. Topic={topic}")
+        finally:
+            self.discard_request(message_in_flight)
+
+        self.logger.info("response=%s", response)
+        return response
+
+    async def request_many(self, requests, timeout_s=5):
+        """
+        Makes a batch of requests to the DAB-enabled device. All the requests are published back-to-back
+        and the responses are awaited together, with a single deadline for the whole batch
+
+        Returns the deserialized responses in the order of the requests. A request that has not received a response
+        before the deadline is represented by a DAB error response with the 500 status
+
+        :param requests: a list of (topic, payload) pairs, as accepted by the request coroutine
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        responses = [None] * len(requests)
+        async for index, response in self.request_many_as_completed(requests, timeout_s):
+            responses[index] = response
+        return responses
+
+    async def request_many_as_completed(self, requests, timeout_s=5):
+        """
+        Same as request_many, but yields (index, response) pairs as soon as each response arrives.
+        The requests still pending at the deadline are yielded last, as DAB error responses with the 500 status
+
+        :param requests: a list of (topic, payload) pairs, as accepted by the request coroutine
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        requests = list(requests)
+        self.logger.info("Request batch: %d requests", len(requests))
+
+        loop = asyncio.get_running_loop()
+        completed = asyncio.Queue()
+        messages_in_flight = []
+        try:
+            for index, (topic, payload) in enumerate(requests):
+                messages_in_flight.append(self.send_request(
+                    topic, payload,
+                    lambda response, index=index: loop.call_soon_threadsafe(completed.put_nowait, index),
+                    timeout_s))
+
+            deadline = loop.time() + timeout_s
+            pending = set(range(len(messages_in_flight)))
+            while pending:
+                remaining_s = deadline - loop.time()
+                if remaining_s <= 0:
+                    break
+                try:
+                    index = await asyncio.wait_for(completed.get(), remaining_s)
+                except asyncio.TimeoutError:
+                    break
+
+                if index in pending:
+                    pending.remove(index)
+                    yield index, self.codec.decode(messages_in_flight[index].response)
+
+            for index in sorted(pending):
+                topic = requests[index][0]
+                if self.metrics is not None:
+                    self.metrics.request_timed_out(topic)
+                yield index, {
+                    "status": 500,
+                    "error": f"Operation timed out. Topic={topic}",
+                }
+        finally:
+            for message_in_flight in messages_in_flight:
+                self.discard_request(message_in_flight)
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark comparing the request dispatch of the DabMqttClient:
+the historical linear scan over the request handlers against the compiled TopicRouter
+
+Usage: python3 benchmark_topic_router.py [--vendor-topics N] [--iterations N]
+"""
+
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import argparse
+import timeit
+
+import dab_topics as topics
+from mqtt_topic_filter import TopicRouter, mqtt_matches_filter
+
+REQUEST_TOPICS = [
+    topics.APPLICATIONS_LIST_TOPIC,
+    topics.APPLICATIONS_LAUNCH_TOPIC,
+    topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC,
+    topics.APPLICATIONS_EXIT_TOPIC,
+    topics.APPLICATIONS_GET_STATE_TOPIC,
+    topics.SYSTEM_RESTART_TOPIC,
+    topics.SYSTEM_LANGUAGE_LIST_TOPIC,
+    topics.SYSTEM_LANGUAGE_GET_TOPIC,
+    topics.SYSTEM_LANGUAGE_SET_TOPIC,
+    topics.INPUT_KEY_PRESS_TOPIC,
+    topics.INPUT_LONG_KEY_PRESS_TOPIC,
+    topics.HEALTH_CHECK_TOPIC,
+    topics.DEVICE_TELEMETRY_START_TOPIC,
+    topics.DEVICE_TELEMETRY_STOP_TOPIC,
+    topics.APPLICATION_TELEMETRY_START_TOPIC,
+    topics.APPLICATION_TELEMETRY_STOP_TOPIC,
+]
+
+
+def linear_dispatch(handler_topics, topic):
+    return [handler_topic for handler_topic in handler_topics if mqtt_matches_filter(topic, handler_topic + '/+')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vendor-topics', type=int, default=0,
+                        help='number of additional vendor extension topics to register (default 0)')
+    parser.add_argument('--iterations', type=int, default=100000,
+                        help='number of dispatched messages per measurement (default 100000)')
+    args = parser.parse_args()
+
+    handler_topics = REQUEST_TOPICS + [f"dab/vendor/extension-{i}/invoke" for i in range(args.vendor_topics)]
+
+    router = TopicRouter()
+    for handler_topic in handler_topics:
+        router.add(handler_topic + '/+', handler_topic)
+
+    # the worst case for the linear scan: a topic handled by the last registered handler
+    message_topics = {
+        'first handler': handler_topics[0] + '/6f1c2d4e-request-id',
+        'last handler': handler_topics[-1] + '/6f1c2d4e-request-id',
+        'no handler': 'dab/unknown/topic/6f1c2d4e-request-id',
+    }
+
+    print(f"{len(handler_topics)} request handlers, {args.iterations} messages per measurement")
+    print(f"{'message':<16}{'linear scan (us)':>20}{'topic router (us)':>20}{'speedup':>10}")
+    for name, message_topic in message_topics.items():
+        assert linear_dispatch(handler_topics, message_topic) == router.match(message_topic)
+
+        linear_s = timeit.timeit(lambda: linear_dispatch(handler_topics, message_topic), number=args.iterations)
+        router_s = timeit.timeit(lambda: router.match(message_topic), number=args.iterations)
+
+        linear_us = linear_s / args.iterations * 1e6
+        router_us = router_s / args.iterations * 1e6
+        print(f"{name:<16}{linear_us:>20.3f}{router_us:>20.3f}{linear_s / router_s:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Throughput and latency benchmark of the DAB request / response path
+
+Drives a dummy port device created with new_dab_0_1_device, through a DabMqttClient, with a weighted mix of
+DAB topics at one or more concurrency levels. By default both run in this process over a LoopbackBroker;
+with --broker they connect to an MQTT broker instead.
+
+Usage: python3 dab_benchmark.py [--broker HOST:PORT] [--concurrency 1,8,32] [--requests 2000]
+                                [--mix health-check/get=4,applications/list=1] [--payload-size 0]
+                                [--qos 0,2 --link-latency-ms 1] [--json results.json]
+"""
+
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import dab_topics as topics
+from dab_codec import codec_by_name, default_codec
+from dab_device import new_dab_0_1_device
+from dab_metrics import DabMetrics, percentile
+from dab_mqtt_client import DabMqttClient, DabMqttException
+from dummy_port.applications import Applications
+from dummy_port.system import System
+from dummy_port.telemetry import Telemetry
+from loopback_broker import LoopbackBroker
+from threading import Thread
+
+RESULTS_FORMAT_VERSION = 1
+
+# request payloads of the topics that can be part of the mix, which names them without the dab/ prefix
+REQUESTS = {
+    topics.HEALTH_CHECK_TOPIC: {},
+    topics.APPLICATIONS_LIST_TOPIC: {},
+    topics.APPLICATIONS_LAUNCH_TOPIC: {"appId": "Netflix"},
+    topics.APPLICATIONS_EXIT_TOPIC: {"appId": "Netflix", "force": False},
+    topics.APPLICATIONS_GET_STATE_TOPIC: {"appId": "Netflix"},
+    topics.SYSTEM_LANGUAGE_LIST_TOPIC: {},
+    topics.SYSTEM_LANGUAGE_GET_TOPIC: {},
+    topics.INPUT_KEY_PRESS_TOPIC: {"keyCode": "KEY_ENTER"},
+    topics.INPUT_LONG_KEY_PRESS_TOPIC: {"keyCode": "KEY_ENTER", "durationMs": 0},
+}
+
+DEFAULT_MIX = "health-check/get=4,applications/list=2,applications/launch=1,input/key-press=3"
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(','):
+        name, _, weight = entry.partition('=')
+        topic = 'dab/' + name.strip()
+        if topic not in REQUESTS:
+            raise argparse.ArgumentTypeError(
+                f"Unsupported topic {name}, choose among {', '.join(t[4:] for t in REQUESTS)}")
+        weights[topic] = float(weight or 1)
+    return weights
+
+
+def latency_histogram(sorted_samples_ms):
+    """
+    Counts the latencies in power of two buckets, from 0.0625 ms, returning [upper bound in ms, count] pairs
+    """
+    histogram = []
+    upper_ms = 0.0625
+    index = 0
+    while index < len(sorted_samples_ms):
+        count = 0
+        while index < len(sorted_samples_ms) and sorted_samples_ms[index] <= upper_ms:
+            count += 1
+            index += 1
+        histogram.append([upper_ms, count])
+        upper_ms *= 2
+    return histogram
+
+
+def run_level(dab_mqtt_client, request_mix, concurrency, request_count, payload_size, timeout_s, seed):
+    """
+    Sends request_count requests from concurrency closed-loop threads and returns the measurements
+    """
+    padding = 'x' * payload_size
+    per_thread = [request_count // concurrency + (1 if i < request_count % concurrency else 0)
+                  for i in range(concurrency)]
+    latencies_ms = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    timeouts = [0] * concurrency
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        mix_topics = list(request_mix)
+        mix_weights = list(request_mix.values())
+        for topic in rng.choices(mix_topics, mix_weights, k=per_thread[index]):
+            payload = dict(REQUESTS[topic])
+            if padding:
+                payload["padding"] = padding
+            start = time.perf_counter()
+            try:
+                response = dab_mqtt_client.request(topic, payload, timeout_s=timeout_s)
+            except DabMqttException:
+                timeouts[index] += 1
+                continue
+            latencies_ms[index].append((time.perf_counter() - start) * 1000)
+            if response.get("status") != 200:
+                errors[index] += 1
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_s = time.perf_counter() - start
+
+    samples_ms = sorted(latency for thread_latencies in latencies_ms for latency in thread_latencies)
+    return {
+        "concurrency": concurrency,
+        "requests": request_count,
+        "completed": len(samples_ms),
+        "errors": sum(errors),
+        "timeouts": sum(timeouts),
+        "elapsed_s": elapsed_s,
+        "throughput_rps": len(samples_ms) / elapsed_s if elapsed_s > 0 else None,
+        "latency_ms": {
+            "min": samples_ms[0] if samples_ms else None,
+            "mean": sum(samples_ms) / len(samples_ms) if samples_ms else None,
+            "p50": percentile(samples_ms, 50),
+            "p90": percentile(samples_ms, 90),
+            "p99": percentile(samples_ms, 99),
+            "p999": percentile(samples_ms, 99.9),
+            "max": samples_ms[-1] if samples_ms else None,
+        },
+        "histogram_ms": latency_histogram(samples_ms),
+    }
+
+
+def print_level(result, output):
+    latency = result["latency_ms"]
+
+    def ms(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    print(f"concurrency {result['concurrency']:>4}: {result['completed']:>7} requests in {result['elapsed_s']:.2f}s, "
+          f"{result['throughput_rps'] or 0:,.0f} req/s, errors {result['errors']}, timeouts {result['timeouts']}",
+          file=output)
+    print(f"  latency ms  p50 {ms(latency['p50'])}  p90 {ms(latency['p90'])}  p99 {ms(latency['p99'])}  "
+          f"p99.9 {ms(latency['p999'])}  max {ms(latency['max'])}", file=output)
+    if "python_peak_kb" in result:
+        print(f"  memory  peak python allocations {result['python_peak_kb']:,.0f} KiB", file=output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', metavar='HOST:PORT',
+                        help='MQTT broker to connect to (default an in-process LoopbackBroker)')
+    parser.add_argument('--external-device', action='store_true',
+                        help='benchmark a device already connected to the broker instead of starting one')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'weighted DAB topics to request (default {DEFAULT_MIX})')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='comma separated concurrency levels (default 1,8,32)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='number of requests per concurrency level (default 2000)')
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='number of requests sent before measuring (default 100)')
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='bytes of padding added to every request payload (default 0)')
+    parser.add_argument('--handler-workers', type=int, default=0,
+                        help='worker threads running the device request handlers (default 0, on the network thread)')
+    parser.add_argument('--response-topic-filter', default=None,
+                        help='response subscription of the client, e.g. _response/# (default per request)')
+    parser.add_argument('--codec', choices=['json', 'orjson'], default=default_codec().name,
+                        help=f'payload serializer of the device and the client (default {default_codec().name})')
+    parser.add_argument('--timeout-s', type=float, default=5, help='request timeout (default 5 seconds)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the peak Python allocations of each level with tracemalloc (slower)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record DabMetrics on the device and the client, printed in the Prometheus format')
+    parser.add_argument('--qos', help='comma separated QoS levels applied to all the requests and responses, measured '
+                                      'in turn (default the QoS policy of the device, DEFAULT_QOS)')
+    parser.add_argument('--link-latency-ms', type=float, default=0,
+                        help='one-way latency of the simulated link of the LoopbackBroker, which the QoS handshakes '
+                             'add trips of (default 0)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the topic mix (default 0)')
+    parser.add_argument('--json', metavar='FILE', help='write the machine-readable results to FILE, - for stdout')
+    args = parser.parse_args()
+
+    # the per-request logs of the DAB modules would dominate the measurements
+    logging.disable(logging.INFO)
+
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+    qos_levels = [None] if args.qos is None else [int(qos) for qos in args.qos.split(',')]
+    # the JSON results written to stdout must stay parsable, the progress text goes to stderr then
+    output = sys.stderr if args.json == '-' else sys.stdout
+
+    if args.broker is None:
+        broker = LoopbackBroker(link_latency_ms=args.link_latency_ms)
+        host, port = 'localhost', 1883
+
+        def transport(client_id):
+            return broker.transport(client_id)
+    else:
+        host, _, port = args.broker.rpartition(':')
+        host, port = host or 'localhost', int(port)
+
+        def transport(client_id):
+            del client_id
+            return None
+
+    device_metrics = DabMetrics() if args.metrics else None
+    client_metrics = DabMetrics() if args.metrics else None
+
+    results = []
+    for qos in qos_levels:
+        # the same QoS for every topic, or the default policies
+        qos_policy = None if qos is None else {'#': qos}
+        if qos is not None:
+            print(f"QoS {qos}", file=output)
+
+        dab_device = None
+        if not args.external_device:
+            dab_device = new_dab_0_1_device(client_id='DAB benchmark device',
+                                            applications=Applications(),
+                                            system=System(),
+                                            telemetry=Telemetry(),
+                                            device_info={"manufacturer": "Amazon, Netflix, Google",
+                                                         "model": "DAB Reference Implementation"},
+                                            handler_workers=args.handler_workers,
+                                            codec=codec_by_name(args.codec),
+                                            metrics=device_metrics,
+                                            transport=transport('DAB benchmark device'),
+                                            qos_policy=qos_policy)
+            dab_device.connect(host=host, port=port)
+
+        dab_mqtt_client = DabMqttClient(client_id='DAB benchmark client',
+                                        response_topic_filter=args.response_topic_filter,
+                                        codec=codec_by_name(args.codec),
+                                        metrics=client_metrics,
+                                        transport=transport('DAB benchmark client'),
+                                        qos_policy=qos_policy)
+        dab_mqtt_client.connect(host, port)
+
+        try:
+            if args.warmup > 0:
+                run_level(dab_mqtt_client, args.mix, 1, args.warmup, args.payload_size, args.timeout_s, args.seed)
+
+            for concurrency in concurrency_levels:
+                if args.trace_memory:
+                    tracemalloc.start()
+                result = run_level(dab_mqtt_client, args.mix, concurrency, args.requests, args.payload_size,
+                                   args.timeout_s, args.seed)
+                if args.trace_memory:
+                    result["python_peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+                    tracemalloc.stop()
+                result["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                result["qos"] = qos
+                results.append(result)
+                print_level(result, output)
+        finally:
+            dab_mqtt_client.disconnect()
+            if dab_device is not None:
+                dab_device.disconnect()
+
+    if args.metrics:
+        print(client_metrics.to_prometheus(prefix='dab_client_'), end='', file=output)
+        print(device_metrics.to_prometheus(prefix='dab_device_'), end='', file=output)
+
+    if args.json:
+        report = {
+            "version": RESULTS_FORMAT_VERSION,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "broker": args.broker or "loopback",
+                "mix": {topic: weight for topic, weight in args.mix.items()},
+                "requests": args.requests,
+                "payload_size": args.payload_size,
+                "handler_workers": args.handler_workers,
+                "codec": args.codec,
+                "response_topic_filter": args.response_topic_filter,
+                "timeout_s": args.timeout_s,
+                "link_latency_ms": args.link_latency_ms,
+            },
+            "results": results,
+        }
+        if args.metrics:
+            report["metrics"] = {
+                "client": client_metrics.snapshot(),
+                "device": device_metrics.snapshot(),
+            }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as results_file:
+                json.dump(report, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
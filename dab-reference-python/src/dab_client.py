@@ -19,23 +19,132 @@ __license__ = """
 
 import dab_topics as topics
 
+from dab_mqtt_client import DabMqttException, DabMqttTimeoutException
+from threading import Event
+from uuid import uuid4
+
 
 class DabClient:
     """
     Sample DAB client based on the DabMqttClient implementation
 
     """
-    def __init__(self, dab_mqtt_client):
+    def __init__(self, dab_mqtt_client, topic_prefix=None, cache=None):
+        """
+        :param dab_mqtt_client: the DabMqttClient the requests are sent through
+        :param topic_prefix: (optional) a prefix addressing one device among many, e.g. lab/tv-1 sends the
+                             requests to lab/tv-1/dab/... When None (default) the bare DAB topics are used
+        :param cache: (optional) a ResponseCache answering the idempotent reads without a round trip to the device.
+                      The retained device information and DAB version messages are kept in the cache as they
+                      are published. When None (default) every operation is sent to the device
+        """
         self.dab_mqtt_client = dab_mqtt_client
+        self.topic_prefix = topic_prefix
+        self.cache = cache
+
+        if cache is not None:
+            for retained_topic in (topics.DEVICE_INFO_TOPIC, topics.DAB_VERSION_TOPIC):
+                dab_mqtt_client.subscribe(
+                    self._topic(retained_topic),
+                    lambda topic, message, retained_topic=retained_topic: self._cache_retained(retained_topic, message))
+
+    def _cache_retained(self, topic, message):
+        if message is None:
+            self.cache.invalidate(topic)
+        else:
+            self.cache.put(topic, None, message, ttl_s=float('inf'))
+
+    def _topic(self, topic):
+        if self.topic_prefix is None:
+            return topic
+        return self.topic_prefix + '/' + topic
+
+    def _request(self, topic, payload, timeout_s=5):
+        if self.cache is None:
+            return self.dab_mqtt_client.request(self._topic(topic), payload, timeout_s)
+
+        response = self.cache.get(topic, payload)
+        if response is not None:
+            return response
+
+        self.cache.invalidate_for_request(topic)
+        response = self.dab_mqtt_client.request(self._topic(topic), payload, timeout_s)
+        # a read racing with this request may have cached a stale response in the meantime
+        self.cache.invalidate_for_request(topic)
+        self.cache.put(topic, payload, response)
+        return response
+
+    def _retained(self, topic, timeout_s):
+        if self.cache is not None:
+            message = self.cache.get(topic, None)
+            if message is not None:
+                return message
+
+        received = Event()
+        messages = []
+
+        def on_message(message_topic, message):
+            del message_topic
+            if message is not None:
+                messages.append(message)
+                received.set()
+
+        subscription = self.dab_mqtt_client.subscribe(self._topic(topic), on_message)
+        try:
+            if not received.wait(timeout_s):
+                raise DabMqttTimeoutException(f"No retained message received. Topic={topic}")
+        finally:
+            subscription.close()
+
+        return messages[0]
+
+    def _request_with_progress(self, topic, payload, timeout_s, progress_topic, on_progress):
+        subscription = self.dab_mqtt_client.subscribe(
+            self._topic(progress_topic),
+            lambda message_topic, message: message is not None and on_progress(message))
+        try:
+            return self._request(topic, payload, timeout_s)
+        finally:
+            subscription.close()
+
+    def batch(self):
+        """
+        Returns a DabClientBatch that records the operations called on it, to send them all at once:
+
+            batch = dab_client.batch()
+            batch.health_check()
+            batch.list_apps()
+            health, apps = batch.execute()
+        """
+        return DabClientBatch(self.dab_mqtt_client, self.topic_prefix)
 
     def list_apps(self):
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.APPLICATIONS_LIST_TOPIC,
             {}
         )
 
+    def get_app_state(self, app_id):
+        return self._request(
+            topics.APPLICATIONS_GET_STATE_TOPIC,
+            {
+                "appId": app_id
+            }
+        )
+
+    def watch_app_states(self, on_change):
+        """
+        Subscribes to the state changes of the applications of the device, instead of polling get_app_state.
+        on_change is called from the MQTT thread with messages like {"appId": "Netflix", "state": "FOREGROUND",
+        "timestamp": 1634000000000}, first with the last known state of every application. Close the returned
+        subscription to stop watching
+        """
+        return self.dab_mqtt_client.subscribe(
+            self._topic(topics.APPLICATIONS_STATE_TOPIC) + '/+',
+            lambda topic, message: message is not None and on_change(message))
+
     def exit_app(self, app_id, force=False):
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.APPLICATIONS_EXIT_TOPIC,
             {
                 "appId": app_id,
@@ -51,7 +160,7 @@ class DabClient:
         if parameters is not None:
             request["parameters"] = parameters
 
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.APPLICATIONS_LAUNCH_TOPIC,
             request
         )
@@ -65,13 +174,13 @@ class DabClient:
         if parameters is not None:
             request["parameters"] = parameters
 
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC,
             request
         )
 
     def key_press(self, key_code):
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.INPUT_KEY_PRESS_TOPIC,
             {
                 "keyCode": key_code
@@ -79,8 +188,8 @@ class DabClient:
         )
 
     def long_key_press(self, key_code, duration_ms):
-        return self.dab_mqtt_client.request(
-            topics.INPUT_KEY_PRESS_TOPIC,
+        return self._request(
+            topics.INPUT_LONG_KEY_PRESS_TOPIC,
             {
                 "keyCode": key_code,
                 "durationMs": duration_ms
@@ -88,8 +197,115 @@ class DabClient:
             }
         )
 
+    def key_sequence(self, keys, delay_ms=0, stop_on_error=True, on_progress=None, timeout_s=None):
+        """
+        Presses a sequence of keys in a single request; the device presses them one after the other and responds
+        with the result of each key: {"status": 200, "results": [{"keyCode": "KEY_DOWN", "status": 200}, ...]}
+
+        :param keys: the keys to press, in order. A key is either a key code or a dictionary with a keyCode and
+                     optionally a durationMs, for a long key press, and a delayMs overriding delay_ms for this key
+        :param delay_ms: (optional) the delay between two keys, in milliseconds (default 0)
+        :param stop_on_error: (optional) True (default) to stop at the first key that fails, the response then has
+                              the status of that key. When False, every key is pressed and the response is a success
+        :param on_progress: (optional) a function called with the result of each key as soon as it is pressed,
+                            {"index": 0, "total": 3, "keyCode": "KEY_DOWN", "status": 200}
+        :param timeout_s: (optional) the request timeout, in seconds. When None (default) 5 seconds more than the
+                          delays and the long key presses of the sequence
+        """
+        keys = [key if isinstance(key, dict) else {"keyCode": key} for key in keys]
+        if timeout_s is None:
+            timeout_s = 5 + sum(key.get("delayMs", delay_ms) + key.get("durationMs", 0) for key in keys) / 1000
+
+        payload = {
+            "keys": keys,
+            "delayMs": delay_ms,
+            "stopOnError": stop_on_error
+        }
+        if on_progress is None:
+            return self._request(topics.INPUT_KEY_SEQUENCE_TOPIC, payload, timeout_s)
+
+        payload["progressId"] = str(uuid4())
+        return self._request_with_progress(
+            topics.INPUT_KEY_SEQUENCE_TOPIC, payload, timeout_s,
+            topics.INPUT_KEY_SEQUENCE_PROGRESS_TOPIC + '/' + payload["progressId"], on_progress)
+
     def health_check(self):
-        return self.dab_mqtt_client.request(
+        return self._request(
             topics.HEALTH_CHECK_TOPIC,
             {}
         )
+
+    def restart(self):
+        return self._request(
+            topics.SYSTEM_RESTART_TOPIC,
+            {}
+        )
+
+    def list_languages(self):
+        return self._request(
+            topics.SYSTEM_LANGUAGE_LIST_TOPIC,
+            {}
+        )
+
+    def get_language(self):
+        return self._request(
+            topics.SYSTEM_LANGUAGE_GET_TOPIC,
+            {}
+        )
+
+    def set_language(self, language):
+        return self._request(
+            topics.SYSTEM_LANGUAGE_SET_TOPIC,
+            {
+                "language": language
+            }
+        )
+
+    def device_info(self, timeout_s=5):
+        """
+        Returns the device information, published by the device as a retained message
+        """
+        return self._retained(topics.DEVICE_INFO_TOPIC, timeout_s)
+
+    def dab_version(self, timeout_s=5):
+        """
+        Returns the DAB versions supported by the device, published as a retained message
+        """
+        return self._retained(topics.DAB_VERSION_TOPIC, timeout_s)
+
+
+class DabClientBatch(DabClient):
+    """
+    A DabClient that records the operations instead of sending them. Each operation returns its index in the batch.
+    The recorded operations are pipelined with DabMqttClient.request_many once the batch is executed
+    """
+
+    def __init__(self, dab_mqtt_client, topic_prefix=None):
+        super(DabClientBatch, self).__init__(dab_mqtt_client, topic_prefix)
+        self.requests = []
+
+    def _request(self, topic, payload, timeout_s=5):
+        # the batch is sent with the timeout of execute
+        del timeout_s
+        self.requests.append((self._topic(topic), payload))
+        return len(self.requests) - 1
+
+    def _request_with_progress(self, topic, payload, timeout_s, progress_topic, on_progress):
+        raise DabMqttException("Progress reports are not supported in batches", 400)
+
+    def execute(self, timeout_s=5):
+        """
+        Sends the recorded operations and returns their responses, in the order the operations were recorded.
+        An operation without a response before the deadline is represented by a DAB error response
+
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        return self.dab_mqtt_client.request_many(self.requests, timeout_s)
+
+    def execute_as_completed(self, timeout_s=5):
+        """
+        Sends the recorded operations and yields (index, response) pairs as the responses arrive
+
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        return self.dab_mqtt_client.request_many_as_completed(self.requests, timeout_s)
@@ -0,0 +1,87 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    """
+    Serializes the DAB payloads to JSON with the Python standard library
+    """
+
+    name = 'json'
+
+    @staticmethod
+    def encode(payload):
+        """
+        Serializes a payload object to UTF-8 encoded JSON bytes
+        """
+        return json.dumps(payload).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        """
+        Deserializes UTF-8 encoded JSON, bytes or str, to a payload object
+        """
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """
+    Serializes the DAB payloads to JSON with the orjson library, several times faster than the standard library
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("The orjson codec requires the orjson package")
+
+    @staticmethod
+    def encode(payload):
+        return orjson.dumps(payload)
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+def default_codec():
+    """
+    Returns the fastest codec available: orjson when it is installed, the standard library otherwise
+    """
+    if orjson is not None:
+        return OrjsonCodec()
+    return JsonCodec()
+
+
+def codec_by_name(name):
+    """
+    Returns a codec from its name, json or orjson
+    """
+    codecs = {JsonCodec.name: JsonCodec, OrjsonCodec.name: OrjsonCodec}
+    if name not in codecs:
+        raise ValueError(f"Unknown codec {name}, choose among {', '.join(codecs)}")
+    return codecs[name]()
@@ -0,0 +1,105 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import zlib
+
+# the compression a device lists under "compression" in its retained dab/version message, and a requester sets
+# under the COMPRESSION_KEY of its requests
+ZLIB = 'zlib'
+
+# reserved request payload key: the requester accepts compressed responses, and compressed telemetry for the streams
+# it starts. It is left in the payload for the handlers publishing messages on behalf of the requester
+COMPRESSION_KEY = '_compression'
+
+# the largest payload a compressed message may inflate to, so that a small message cannot exhaust the memory
+DEFAULT_MAX_INFLATED_BYTES = 16 * 1024 * 1024
+
+
+def is_compressed(data):
+    """
+    Returns True when a payload is a zlib stream. The header of a zlib stream starts with the 0x78 byte, which no
+    JSON text starts with, so compressed and uncompressed payloads can be told apart without any framing
+    """
+    return len(data) > 2 and data[0] == 0x78 and ((data[0] << 8) | data[1]) % 31 == 0
+
+
+def inflate(data, max_bytes=DEFAULT_MAX_INFLATED_BYTES):
+    """
+    Returns the decompressed payload when it is compressed, the payload itself otherwise.
+    Raises a ValueError if the compressed payload is invalid, truncated or inflates beyond max_bytes
+
+    :param data: the payload
+    :param max_bytes: (optional) the largest size of the decompressed payload (default 16 MiB)
+    """
+    if isinstance(data, str) or not is_compressed(data):
+        return data
+
+    decompressor = zlib.decompressobj()
+    try:
+        inflated = decompressor.decompress(data, max_bytes)
+    except zlib.error as e:
+        raise ValueError(f"Invalid compressed payload: {e}")
+    if not decompressor.eof:
+        if len(inflated) >= max_bytes:
+            raise ValueError(f"The compressed payload inflates beyond {max_bytes} bytes")
+        raise ValueError("Truncated compressed payload")
+    return inflated
+
+
+class PayloadCompression:
+    """
+    Compresses the serialized payloads larger than a threshold with zlib
+
+    Compression is negotiated: a DabMqttClient created with a PayloadCompression only compresses a request once the
+    device has advertised zlib in its retained dab/version message, and a device only compresses the responses of the
+    requests carrying the COMPRESSION_KEY. Peers that do not support it keep exchanging uncompressed payloads.
+    """
+
+    def __init__(self, threshold_bytes=1024, level=6, max_inflated_bytes=DEFAULT_MAX_INFLATED_BYTES):
+        """
+        :param threshold_bytes: (optional) the size from which a payload is compressed (default 1024 bytes)
+        :param level: (optional) the zlib compression level, from 1, the fastest, to 9, the smallest (default 6)
+        :param max_inflated_bytes: (optional) the largest size a compressed payload received may inflate to
+                                   (default 16 MiB)
+        """
+        if not 1 <= level <= 9:
+            raise ValueError(f"The compression level must be between 1 and 9. level={level}")
+        if max_inflated_bytes <= 0:
+            raise ValueError(f"max_inflated_bytes must be positive. max_inflated_bytes={max_inflated_bytes}")
+
+        self.threshold_bytes = threshold_bytes
+        self.level = level
+        self.max_inflated_bytes = max_inflated_bytes
+
+    def deflate(self, data):
+        """
+        Returns the compressed payload, or the payload itself when it is below the threshold or does not shrink
+        """
+        if len(data) < self.threshold_bytes:
+            return data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        compressed = zlib.compress(data, self.level)
+        return compressed if len(compressed) < len(data) else data
+
+    def inflate(self, data):
+        """
+        Returns the decompressed payload when it is compressed, the payload itself otherwise, see inflate
+        """
+        return inflate(data, self.max_inflated_bytes)
@@ -17,18 +17,127 @@ __license__ = """
     limitations under the License.
 """
 
-from dab_mqtt_client import DabMqttClient, DabMqttException, RequestHandler, RetainedMessage
+from dab_mqtt_client import CLIENT_RESPONSE_TOPICS, DabMqttClient, RetainedMessage, STATIC_RESPONSE
 import dab_topics as topics
-import logging
 
-logging.basicConfig(
-    format='%(asctime)s %(name)s %(levelname)s %(message)s',
-    level=logging.DEBUG,
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+from app_state_tracker import AppStateTracker, BACKGROUND, STOPPED
+from dab_compression import COMPRESSION_KEY, ZLIB
+from dab_operations import OperationRegistry, Parameter
+from dab_request_dedup import RequestDeduplicator
+from dab_request_executor import PRIORITY_HIGH, PRIORITY_LOW
+from functools import partial
+from mqtt_topic_filter import is_topic_level
+from telemetry_scheduler import TelemetryScheduler
 
+# how long the successful responses of these topics can be reused without calling the port again, for the ports
+# opting in with response_ttls=CACHEABLE_RESPONSE_TTLS: their catalog of applications changes rarely and their
+# list of languages never
+CACHEABLE_RESPONSE_TTLS = {
+    topics.APPLICATIONS_LIST_TOPIC: 5,
+    topics.SYSTEM_LANGUAGE_LIST_TOPIC: STATIC_RESPONSE,
+}
 
-def new_dab_0_1_device(client_id, applications, system, telemetry, device_info):
+# the requests waiting for a worker thread run by priority class: health checks and telemetry stops first,
+# key presses and application launches last
+DEFAULT_PRIORITIES = {
+    topics.HEALTH_CHECK_TOPIC: PRIORITY_HIGH,
+    topics.DEVICE_TELEMETRY_STOP_TOPIC: PRIORITY_HIGH,
+    topics.APPLICATION_TELEMETRY_STOP_TOPIC: PRIORITY_HIGH,
+    "dab/input/#": PRIORITY_LOW,
+    topics.APPLICATIONS_LAUNCH_TOPIC: PRIORITY_LOW,
+    topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC: PRIORITY_LOW,
+}
+
+# the QoS of the responses: the idempotent reads, which a client can simply send again, are answered at most once
+# without the QoS 2 handshake; the responses of the commands changing the device state keep DEFAULT_RESPONSE_QOS
+DEFAULT_QOS = {
+    topics.HEALTH_CHECK_TOPIC: 0,
+    topics.APPLICATIONS_LIST_TOPIC: 0,
+    topics.APPLICATIONS_GET_STATE_TOPIC: 0,
+    topics.SYSTEM_LANGUAGE_LIST_TOPIC: 0,
+    topics.SYSTEM_LANGUAGE_GET_TOPIC: 0,
+}
+
+
+def _positive(value):
+    if value <= 0:
+        return "must be a positive number of milliseconds"
+
+
+def _not_negative(value):
+    if value < 0:
+        return "must not be negative"
+
+
+def _keys(keys):
+    # every key is checked before the first one is pressed
+    for index, key in enumerate(keys):
+        if not isinstance(key, dict) or not isinstance(key.get("keyCode"), str):
+            return f"must be a list of objects with a keyCode string, key {index} is not"
+        for field in ("delayMs", "durationMs"):
+            if field not in key:
+                continue
+            value = key[field]
+            if not isinstance(value, (int, float)) or value.__class__ is bool or not value >= 0:
+                return f"must have non-negative {field} numbers, key {index} has {field}={value!r}"
+
+
+def _topic_level(value):
+    if not is_topic_level(value):
+        return "must be a single topic level"
+
+
+# the application identifier is a level of the state and telemetry topics of the application
+_APP_ID = Parameter("appId", str, required=True, check=_topic_level)
+_PARAMETERS = Parameter("parameters", argument="params")
+_FREQUENCY = Parameter("frequency", (int, float), required=True, check=_positive)
+# requests accepting compressed messages carry _compression, used by the device for the telemetry they start
+_COMPRESSION = Parameter(COMPRESSION_KEY, str, argument="compression", forwarded=False)
+
+# the operations of the 0.1 DAB specification, the port methods serving them and the parameters of their requests
+DAB_0_1_OPERATIONS = OperationRegistry()
+DAB_0_1_OPERATIONS.declare(topics.APPLICATIONS_LAUNCH_TOPIC, "applications.launch", _APP_ID, _PARAMETERS)
+DAB_0_1_OPERATIONS.declare(topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC, "applications.launch_with_content",
+                           _APP_ID, Parameter("contentId", str, required=True), _PARAMETERS)
+DAB_0_1_OPERATIONS.declare(topics.APPLICATIONS_LIST_TOPIC, "applications.list")
+DAB_0_1_OPERATIONS.declare(topics.APPLICATIONS_EXIT_TOPIC, "applications.exit",
+                           _APP_ID, Parameter("force", bool, default=False))
+DAB_0_1_OPERATIONS.declare(topics.APPLICATIONS_GET_STATE_TOPIC, "applications.get_state", _APP_ID)
+DAB_0_1_OPERATIONS.declare(topics.SYSTEM_RESTART_TOPIC, "system.restart")
+DAB_0_1_OPERATIONS.declare(topics.SYSTEM_LANGUAGE_LIST_TOPIC, "system.list_languages")
+DAB_0_1_OPERATIONS.declare(topics.SYSTEM_LANGUAGE_GET_TOPIC, "system.get_language")
+DAB_0_1_OPERATIONS.declare(topics.SYSTEM_LANGUAGE_SET_TOPIC, "system.set_language",
+                           Parameter("language", str, required=True))
+DAB_0_1_OPERATIONS.declare(topics.INPUT_KEY_PRESS_TOPIC, "system.key_press",
+                           Parameter("keyCode", str, required=True))
+DAB_0_1_OPERATIONS.declare(topics.INPUT_LONG_KEY_PRESS_TOPIC, "system.long_key_press",
+                           Parameter("keyCode", str, required=True),
+                           Parameter("durationMs", (int, float), required=True, check=_not_negative))
+# an extension of the specification, served when the system port implements key_sequence
+DAB_0_1_OPERATIONS.declare(topics.INPUT_KEY_SEQUENCE_TOPIC, "system.key_sequence",
+                           Parameter("keys", list, required=True, check=_keys),
+                           Parameter("delayMs", (int, float), default=0, check=_not_negative),
+                           Parameter("stopOnError", bool, default=True),
+                           Parameter("progressId", str, check=_topic_level, forwarded=False),
+                           port_arguments=("on_progress",), optional=True)
+DAB_0_1_OPERATIONS.declare(topics.HEALTH_CHECK_TOPIC, "system.health_check")
+# the telemetry streams sample the port on every tick: a port without the sample method does not serve them
+_DEVICE_METRICS = ("telemetry.device_metrics", ())
+_APP_METRICS = ("telemetry.app_metrics", ("app_id",))
+DAB_0_1_OPERATIONS.declare(topics.DEVICE_TELEMETRY_START_TOPIC, "telemetry.start_device_telemetry",
+                           _FREQUENCY, _COMPRESSION, requires=(_DEVICE_METRICS,))
+DAB_0_1_OPERATIONS.declare(topics.DEVICE_TELEMETRY_STOP_TOPIC, "telemetry.stop_device_telemetry",
+                           requires=(_DEVICE_METRICS,))
+DAB_0_1_OPERATIONS.declare(topics.APPLICATION_TELEMETRY_START_TOPIC, "telemetry.start_app_telemetry",
+                           _APP_ID, _FREQUENCY, _COMPRESSION, requires=(_APP_METRICS,))
+DAB_0_1_OPERATIONS.declare(topics.APPLICATION_TELEMETRY_STOP_TOPIC, "telemetry.stop_app_telemetry", _APP_ID,
+                           requires=(_APP_METRICS,))
+
+
+def new_dab_0_1_device(client_id, applications, system, telemetry, device_info, handler_workers=0,
+                       topic_prefix=None, transport=None, codec=None, response_ttls=None, metrics=None,
+                       telemetry_scheduler=None, telemetry_batching=None, dedup_ttl_s=60, max_queued=256,
+                       tap=None, app_state_tracker=None, compression=None, qos_policy=None):
     """
     Connects to the MQTT broker and wires the ported components conforming with the 0.1 DAB specification
     This method is blocking
@@ -38,92 +147,225 @@ def new_dab_0_1_device(client_id, applications, system, telemetry, device_info):
     :param system: ported system commands
     :param telemetry: ported telemetry commands
     :param device_info: an object with the device information, as defined by the specification
+    :param handler_workers: (optional) the number of worker threads running the ported commands.
+                            When 0 (default) the commands run on the MQTT network thread
+    :param topic_prefix: (optional) a prefix addressing this device among many, e.g. lab/tv-1 serves
+                         lab/tv-1/dab/... When None (default) the device serves the bare DAB topics
+    :param transport: (optional) the MQTT transport of the device, e.g. a LoopbackTransport.
+                      When None (default) the device connects to a broker with paho-mqtt
+    :param codec: (optional) the payload serializer, see DabMqttClient
+    :param response_ttls: (optional) a dictionary of DAB topics to the time, in seconds, their successful responses
+                          are reused for, e.g. CACHEABLE_RESPONSE_TTLS. When None (default) every request calls
+                          the port
+    :param metrics: (optional) a DabMetrics recording the request counters and the latencies of the ported commands
+    :param telemetry_scheduler: (optional) the TelemetryScheduler publishing the telemetry streams, which can be
+                                shared by several devices. When None (default) the device creates its own
+    :param telemetry_batching: (optional) a TelemetryBatching publishing the telemetry samples in batches, possibly
+                               downsampled. When None (default) every sample is published as its own message
+    :param dedup_ttl_s: (optional) how long, in seconds, the device remembers a request to answer its redeliveries
+                        with the same response instead of executing it again (default 60 seconds). 0 disables it
+    :param max_queued: (optional) the maximum number of requests waiting for a handler worker; the device answers
+                       the requests received beyond it with the 503 status (default 256).
+                       The waiting requests are run by priority, see DEFAULT_PRIORITIES
+    :param tap: (optional) a function called with every message received and published, e.g. the record method
+                of a TrafficRecorder, see DabMqttClient
+    :param app_state_tracker: (optional) an AppStateTracker answering applications/get-state and publishing the
+                              state changes of the applications on dab/applications/state/<appId>, which the
+                              applications port can also report changes to. When None (default) the device creates
+                              its own
+    :param compression: (optional) a PayloadCompression compressing the large responses, and telemetry messages,
+                        of the requesters accepting it; zlib is then advertised in the retained dab/version message
+                        and compressed requests are accepted. When None (default) the device publishes uncompressed
+                        payloads only
+    :param qos_policy: (optional) a dictionary of DAB topic filters to the QoS of the matching responses, see
+                       DabMqttClient. Defaults to DEFAULT_QOS
     """
+    if qos_policy is None:
+        qos_policy = DEFAULT_QOS
 
-    def parameter_from_payload(key, payload, mandatory=False, default=None):
-        if mandatory and key not in payload:
-            raise DabMqttException(f"parameter {key} is mandatory", 400)
+    def publish(topic, payload, retain=False, compress=False):
+        # the handlers publish through the client created below
+        dab_mqtt_client.publish(topic, payload, retain=retain, compress=compress)
 
-        return payload.get(key, default)
+    # raises a TypeError before connecting if a port does not implement an operation
+    request_handlers = new_dab_0_1_request_handlers(
+        applications, system, telemetry, publish,
+        topic_prefix=topic_prefix,
+        response_ttls=response_ttls,
+        telemetry_scheduler=telemetry_scheduler,
+        telemetry_batching=telemetry_batching,
+        app_state_tracker=app_state_tracker)
 
     dab_mqtt_client = DabMqttClient(
         client_id=client_id,
-        request_handlers=[
-            RequestHandler(topic=topics.APPLICATIONS_LAUNCH_TOPIC,
-                           handler=lambda topic, payload:
-                           applications.launch(
-                               app_id=parameter_from_payload("appId", payload, mandatory=True),
-                               params=parameter_from_payload("parameters", payload, default=None))),
-            RequestHandler(topic=topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC,
-                           handler=lambda topic, payload:
-                           applications.launch_with_content(
-                               app_id=parameter_from_payload("appId", payload, mandatory=True),
-                               content_id=parameter_from_payload("contentId", payload, mandatory=True),
-                               params=parameter_from_payload("parameters", payload, default=None))),
-            RequestHandler(topic=topics.APPLICATIONS_LIST_TOPIC,
-                           handler=lambda topic, payload:
-                           applications.list()),
-            RequestHandler(topic=topics.APPLICATIONS_EXIT_TOPIC,
-                           handler=lambda topic, payload:
-                           applications.exit(
-                               app_id=parameter_from_payload("appId", payload, mandatory=True),
-                               force=parameter_from_payload("force", payload, default=False))),
-            RequestHandler(topic=topics.APPLICATIONS_GET_STATE_TOPIC,
-                           handler=lambda topic, payload:
-                           applications.launch(
-                               app_id=parameter_from_payload("appId", payload, mandatory=True))),
-
-            RequestHandler(topic=topics.SYSTEM_RESTART_TOPIC,
-                           handler=lambda topic, payload:
-                           system.restart()),
-
-            RequestHandler(topic=topics.SYSTEM_LANGUAGE_LIST_TOPIC,
-                           handler=lambda topic, payload:
-                           system.list_languages()),
-            RequestHandler(topic=topics.SYSTEM_LANGUAGE_GET_TOPIC,
-                           handler=lambda topic, payload:
-                           system.get_language()),
-            RequestHandler(topic=topics.SYSTEM_LANGUAGE_SET_TOPIC,
-                           handler=lambda topic, payload:
-                           system.set_lanugage(
-                               language=parameter_from_payload("language", payload, True))),
-
-            RequestHandler(topic=topics.INPUT_KEY_PRESS_TOPIC,
-                           handler=lambda topic, payload:
-                           system.key_press(
-                               key_code=parameter_from_payload("keyCode", payload, mandatory=True))),
-
-            RequestHandler(topic=topics.INPUT_LONG_KEY_PRESS_TOPIC,
-                           handler=lambda topic, payload:
-                           system.long_key_press(
-                               key_code=parameter_from_payload("keyCode", payload, mandatory=True),
-                               duration_ms=parameter_from_payload("durationMs", payload, mandatory=True))),
-
-            RequestHandler(topic=topics.HEALTH_CHECK_TOPIC,
-                           handler=lambda topic, payload:
-                           system.health_check()),
-
-            RequestHandler(topic=topics.DEVICE_TELEMETRY_START_TOPIC,
-                           handler=lambda topic, payload:
-                           telemetry.start_device_telemetry(
-                               frequency=parameter_from_payload("frequency", payload, mandatory=True)
-                           )),
-            RequestHandler(topic=topics.DEVICE_TELEMETRY_STOP_TOPIC,
-                           handler=lambda topic, payload:
-                           telemetry.stop_device_telemetry()),
-            RequestHandler(topic=topics.APPLICATION_TELEMETRY_START_TOPIC,
-                           handler=lambda topic, payload:
-                           telemetry.start_app_telemetry(
-                               app_id=parameter_from_payload("appId", payload, mandatory=True),
-                               frequency=parameter_from_payload("frequency", payload, mandatory=True))),
-            RequestHandler(topic=topics.APPLICATION_TELEMETRY_STOP_TOPIC,
-                           handler=lambda topic, payload:
-                           telemetry.stop_app_telemetry(
-                               app=parameter_from_payload("appId", payload, mandatory=True)))
-        ],
-
-        retained_messages=[
-            RetainedMessage(topic=topics.DAB_VERSION_TOPIC, message={"versions": ["0.1"]}),
-            RetainedMessage(topic=topics.DEVICE_INFO_TOPIC, message=device_info), ])
+        handler_workers=handler_workers,
+        transport=transport,
+        codec=codec,
+        metrics=metrics,
+        request_dedup=RequestDeduplicator(ttl_s=dedup_ttl_s) if dedup_ttl_s > 0 else None,
+        # key presses are executed one at a time, in the order they were received
+        concurrency_limits={_prefixed(topic_prefix, "dab/input/#"): 1},
+        priorities={_prefixed(topic_prefix, topic_filter): priority
+                    for topic_filter, priority in DEFAULT_PRIORITIES.items()},
+        max_queued=max_queued,
+        tap=tap,
+        compression=compression,
+        qos_policy={_prefixed(topic_prefix, topic_filter): qos for topic_filter, qos in qos_policy.items()},
+        request_handlers=request_handlers,
+        retained_messages=new_dab_0_1_retained_messages(device_info, topic_prefix, compression))
 
     return dab_mqtt_client
+
+
+def _prefixed(topic_prefix, topic):
+    if topic_prefix is None:
+        return topic
+    return topic_prefix + '/' + topic
+
+
+def new_dab_0_1_retained_messages(device_info, topic_prefix=None, compression=None):
+    """
+    Returns the retained messages of a device conforming with the 0.1 DAB specification: the DAB versions, and the
+    extensions, it supports and its device information
+
+    :param device_info: an object with the device information, as defined by the specification
+    :param topic_prefix: (optional) the topic prefix of the device, see new_dab_0_1_device
+    :param compression: (optional) the PayloadCompression of the device, advertised in the dab/version message
+    """
+    dab_version = {"versions": ["0.1"], CLIENT_RESPONSE_TOPICS: True}
+    if compression is not None:
+        dab_version["compression"] = [ZLIB]
+
+    return [
+        RetainedMessage(topic=_prefixed(topic_prefix, topics.DAB_VERSION_TOPIC), message=dab_version),
+        RetainedMessage(topic=_prefixed(topic_prefix, topics.DEVICE_INFO_TOPIC), message=device_info),
+    ]
+
+
+def new_dab_0_1_request_handlers(applications, system, telemetry, publish, topic_prefix=None, response_ttls=None,
+                                 telemetry_scheduler=None, telemetry_batching=None, app_state_tracker=None):
+    """
+    Returns the request handlers of a device conforming with the 0.1 DAB specification, which track the state of its
+    applications and run its telemetry streams around the ported components. new_dab_0_1_device serves them with a
+    DabMqttClient of its own, a DabDeviceFarm serves the handlers of all its devices with a shared one.
+    Raises a TypeError if a port does not implement an operation
+
+    :param applications: ported application lifecycle commands
+    :param system: ported system commands
+    :param telemetry: ported telemetry commands
+    :param publish: a function publishing a message from the client serving the handlers, accepting a topic,
+                    a payload object and the retain and compress keyword arguments of DabMqttClient.publish
+    :param topic_prefix: (optional) the topic prefix of the device, see new_dab_0_1_device
+    :param response_ttls: (optional) see new_dab_0_1_device
+    :param telemetry_scheduler: (optional) see new_dab_0_1_device
+    :param telemetry_batching: (optional) see new_dab_0_1_device
+    :param app_state_tracker: (optional) see new_dab_0_1_device
+    """
+
+    def prefixed(topic):
+        return _prefixed(topic_prefix, topic)
+
+    # the telemetry topics of the streams started by a request accepting compressed messages
+    compressed_telemetry_topics = set()
+
+    if telemetry_scheduler is None:
+        telemetry_scheduler = TelemetryScheduler(
+            publish=lambda topic, payload: publish(topic, payload, compress=topic in compressed_telemetry_topics))
+
+    if app_state_tracker is None:
+        app_state_tracker = AppStateTracker()
+    app_state_tracker.bind(
+        topic=prefixed(topics.APPLICATIONS_STATE_TOPIC),
+        publish=lambda topic, payload: publish(topic, payload, retain=True))
+
+    def launched(app_id, response):
+        if response.get("status") == 200:
+            app_state_tracker.launched(app_id)
+        return response
+
+    def launch_app(launch, app_id, **arguments):
+        return launched(app_id, launch(app_id=app_id, **arguments))
+
+    def exit_app(exit_, app_id, force):
+        response = exit_(app_id=app_id, force=force)
+        if response.get("status") == 200:
+            app_state_tracker.exited(app_id, response.get("state", STOPPED if force else BACKGROUND))
+        return response
+
+    def get_app_state(get_state, app_id):
+        state = app_state_tracker.get(app_id)
+        if state is not None:
+            return {"status": 200, "state": state}
+
+        response = get_state(app_id=app_id)
+        if response.get("status") == 200 and "state" in response:
+            app_state_tracker.update(app_id, response["state"])
+        return response
+
+    def restart(restart_):
+        response = restart_()
+        if response.get("status") == 200:
+            app_state_tracker.restarted()
+        return response
+
+    def start_telemetry(stream_id, topic, frequency, sample, response, compress):
+        if response.get("status") == 200:
+            if compress:
+                compressed_telemetry_topics.add(topic)
+            else:
+                compressed_telemetry_topics.discard(topic)
+            telemetry_scheduler.start_stream(stream_id, topic, frequency, sample, batching=telemetry_batching)
+        return response
+
+    def stop_telemetry(stream_id, response):
+        if response.get("status") == 200:
+            telemetry_scheduler.stop_stream(stream_id)
+        return response
+
+    def start_device_telemetry(start, frequency, compression):
+        return start_telemetry(
+            stream_id=(topic_prefix, "device"),
+            topic=prefixed(topics.DEVICE_TELEMETRY_METRICS_TOPIC),
+            frequency=frequency,
+            sample=telemetry.device_metrics,
+            response=start(frequency=frequency),
+            compress=compression == ZLIB)
+
+    def stop_device_telemetry(stop):
+        return stop_telemetry(stream_id=(topic_prefix, "device"), response=stop())
+
+    def start_app_telemetry(start, app_id, frequency, compression):
+        return start_telemetry(
+            stream_id=(topic_prefix, "app", app_id),
+            topic=prefixed(topics.APPLICATION_TELEMETRY_METRICS_TOPIC) + '/' + app_id,
+            frequency=frequency,
+            sample=lambda: telemetry.app_metrics(app_id),
+            response=start(app_id=app_id, frequency=frequency),
+            compress=compression == ZLIB)
+
+    def stop_app_telemetry(stop, app_id):
+        return stop_telemetry(stream_id=(topic_prefix, "app", app_id), response=stop(app_id=app_id))
+
+    def key_sequence(press_keys, progress_id, **arguments):
+        on_progress = None
+        if progress_id is not None:
+            progress_topic = prefixed(topics.INPUT_KEY_SEQUENCE_PROGRESS_TOPIC) + '/' + progress_id
+            on_progress = partial(publish, progress_topic)
+        return press_keys(on_progress=on_progress, **arguments)
+
+    return DAB_0_1_OPERATIONS.request_handlers(
+        ports={"applications": applications, "system": system, "telemetry": telemetry},
+        wrappers={
+            topics.APPLICATIONS_LAUNCH_TOPIC: launch_app,
+            topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC: launch_app,
+            topics.APPLICATIONS_EXIT_TOPIC: exit_app,
+            topics.APPLICATIONS_GET_STATE_TOPIC: get_app_state,
+            topics.SYSTEM_RESTART_TOPIC: restart,
+            topics.INPUT_KEY_SEQUENCE_TOPIC: key_sequence,
+            topics.DEVICE_TELEMETRY_START_TOPIC: start_device_telemetry,
+            topics.DEVICE_TELEMETRY_STOP_TOPIC: stop_device_telemetry,
+            topics.APPLICATION_TELEMETRY_START_TOPIC: start_app_telemetry,
+            topics.APPLICATION_TELEMETRY_STOP_TOPIC: stop_app_telemetry,
+        },
+        topic=prefixed,
+        response_ttls=response_ttls)
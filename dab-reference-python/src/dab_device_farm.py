@@ -0,0 +1,303 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import logging
+import random
+
+import dab_topics as topics
+
+from app_state_tracker import AppStateTracker, BACKGROUND, STOPPED
+from concurrent.futures import Future
+from dab_device import DEFAULT_PRIORITIES, DEFAULT_QOS, new_dab_0_1_request_handlers, new_dab_0_1_retained_messages
+from dab_mqtt_client import DabMqttClient, DabMqttException, RequestHandler
+from dab_request_dedup import RequestDeduplicator
+from dummy_port.applications import Applications
+from dummy_port.system import System
+from dummy_port.telemetry import Telemetry
+from telemetry_scheduler import TelemetryScheduler
+from threading import Lock
+
+
+class VirtualDevice:
+    """
+    A simulated device, serving as the applications, system and telemetry ports of its DAB operations.
+    It keeps its language and the number of keys pressed on it; the state of its applications is kept by the
+    AppStateTracker of its request handlers, created with them on the first request to the device
+    """
+
+    __slots__ = ('device_id', 'topic_prefix', 'farm', 'language', 'key_presses', 'app_state_tracker', 'handlers')
+
+    def __init__(self, device_id, topic_prefix, farm, language):
+        self.device_id = device_id
+        self.topic_prefix = topic_prefix
+        self.farm = farm
+        self.language = language
+        self.key_presses = 0
+        self.app_state_tracker = None
+        # the DAB topics of the operations to their handlers
+        self.handlers = None
+
+    def _app_id(self, app_id):
+        if app_id not in self.farm.app_ids:
+            raise DabMqttException(f"Unknown application {app_id}", 400)
+        return app_id
+
+    # applications port
+
+    def list(self):
+        return self.farm.applications
+
+    def launch(self, app_id, params):
+        self._app_id(app_id)
+        return {"status": 200}
+
+    def launch_with_content(self, app_id, content_id, params):
+        self._app_id(app_id)
+        return {"status": 200}
+
+    def get_state(self, app_id):
+        # the applications launched are answered by the app state tracker
+        self._app_id(app_id)
+        return {"status": 200, "state": STOPPED}
+
+    def exit(self, app_id, force):
+        if self.app_state_tracker.get(self._app_id(app_id)) in (None, STOPPED):
+            return {"status": 200, "state": STOPPED}
+        return {"status": 200, "state": STOPPED if force else BACKGROUND}
+
+    # system port
+
+    def restart(self):
+        return {"status": 200}
+
+    def list_languages(self):
+        return self.farm.languages
+
+    def get_language(self):
+        return {"status": 200, "language": self.language}
+
+    def set_language(self, language):
+        if language not in self.farm.languages["languages"]:
+            raise DabMqttException(f"Unsupported language {language}", 400)
+        self.language = language
+        return {"status": 200}
+
+    def key_press(self, key_code):
+        self.key_presses += 1
+        return {"status": 200}
+
+    def long_key_press(self, key_code, duration_ms):
+        self.key_presses += 1
+        return {"status": 200}
+
+    def key_sequence(self, keys, delay_ms, stop_on_error, on_progress):
+        self.key_presses += len(keys)
+        results = [{"keyCode": key["keyCode"], "status": 200} for key in keys]
+        if on_progress is not None:
+            for index, result in enumerate(results):
+                on_progress(dict(result, index=index, total=len(results)))
+        return {"status": 200, "results": results}
+
+    def health_check(self):
+        return {"status": 200, "healthy": True}
+
+    # telemetry port, sampled by the dummy port
+
+    def start_device_telemetry(self, frequency):
+        return {"status": 200}
+
+    def stop_device_telemetry(self):
+        return {"status": 200}
+
+    def start_app_telemetry(self, app_id, frequency):
+        self._app_id(app_id)
+        return {"status": 200}
+
+    def stop_app_telemetry(self, app_id):
+        self._app_id(app_id)
+        return {"status": 200}
+
+    def device_metrics(self):
+        return self.farm.telemetry.device_metrics()
+
+    def app_metrics(self, app_id):
+        return self.farm.telemetry.app_metrics(app_id)
+
+
+def _duration_s(topic, payload):
+    # the time, in seconds, a device takes to execute a validated request
+    if topic == topics.INPUT_LONG_KEY_PRESS_TOPIC:
+        return payload["durationMs"] / 1000
+    if topic == topics.INPUT_KEY_SEQUENCE_TOPIC:
+        keys = payload["keys"]
+        delay_ms = payload.get("delayMs") or 0
+        return sum(key.get("delayMs", delay_ms if index > 0 else 0) + key.get("durationMs", 0)
+                   for index, key in enumerate(keys)) / 1000
+    return 0
+
+
+class DabDeviceFarm:
+    """
+    Simulates many DAB devices in one process, e.g. to load test a controller
+
+    The devices share a single DabMqttClient: its request handlers serve every device at once through a + wildcard
+    standing for the device identifier, e.g. farm/+/dab/applications/launch, so the number of MQTT subscriptions and
+    threads does not grow with the number of devices. Each device is a VirtualDevice served by the request handlers
+    of new_dab_0_1_request_handlers, as a device made with new_dab_0_1_device is: the state of its applications is
+    published on farm/<device id>/dab/applications/state, and its requests are validated, prioritized and answered
+    with the QoS of DEFAULT_PRIORITIES and DEFAULT_QOS. The handlers of a device are created on its first request.
+    The application catalog, the languages and the telemetry samples come from the dummy port.
+
+    Latency and failures are injected around the handlers: the delayed responses are published from the timer wheel
+    of the client, without holding a handler thread per request.
+    """
+
+    def __init__(self, count, topic_prefix="farm", client_id="dab-device-farm", handler_workers=0, transport=None,
+                 codec=None, metrics=None, latency_ms=0, jitter_ms=0, failure_rate=0.0, drop_rate=0.0, seed=None):
+        """
+        :param count: the number of devices, identified by device-0 to device-<count - 1>
+        :param topic_prefix: (optional) the topic prefix of the farm; a device serves <topic_prefix>/<device id>/dab/...
+                             (default farm)
+        :param client_id: (optional) MQTT client identifier of the shared client
+        :param handler_workers: (optional) the number of worker threads running the requests, see DabMqttClient
+        :param transport: (optional) the MQTT transport, see DabMqttClient
+        :param codec: (optional) the payload serializer, see DabMqttClient
+        :param metrics: (optional) a DabMetrics recording the requests of all the devices, see DabMqttClient
+        :param latency_ms: (optional) the time, in milliseconds, every device takes to respond (default 0)
+        :param jitter_ms: (optional) a random time, up to this many milliseconds, added to every response (default 0)
+        :param failure_rate: (optional) the probability of a request failing with the 500 status (default 0)
+        :param drop_rate: (optional) the probability of a request never being answered (default 0)
+        :param seed: (optional) the seed of the random latencies and failures, to replay a run
+        """
+        if '+' in topic_prefix or '#' in topic_prefix:
+            raise ValueError(f"The topic prefix must not contain wildcards. topic_prefix={topic_prefix}")
+
+        self.logger = logging.getLogger('dab.device.farm')
+        self.topic_prefix = topic_prefix
+        self.latency_s = latency_ms / 1000
+        self.jitter_s = jitter_ms / 1000
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        # the dummy port provides what every device has in common
+        self.applications = Applications().list()
+        self.app_ids = frozenset(application["appId"] for application in self.applications["applications"])
+        self.languages = System().list_languages()
+        self.telemetry = Telemetry()
+
+        self.devices = {}
+        for index in range(count):
+            device_id = f"device-{index}"
+            self.devices[device_id] = VirtualDevice(device_id, f"{topic_prefix}/{device_id}", self, "en-US")
+        self._device_id_level = topic_prefix.count('/') + 1
+        self._handlers_lock = Lock()
+
+        self.telemetry_scheduler = TelemetryScheduler(
+            publish=lambda topic, payload: self.dab_mqtt_client.publish(topic, payload))
+        # the handlers of a first device check the ports, and give the operations served by the farm
+        operation_topics = list(self._device_handlers(next(iter(self.devices.values())))) if self.devices else []
+
+        def farm_topic(topic_filter):
+            return f"{topic_prefix}/+/{topic_filter}"
+
+        self.dab_mqtt_client = DabMqttClient(
+            client_id=client_id,
+            request_handlers=[RequestHandler(topic=farm_topic(topic),
+                                             handler=lambda request_topic, payload, topic=topic:
+                                             self._dispatch(topic, request_topic, payload))
+                              for topic in operation_topics],
+            retained_messages=[retained_message for device in self.devices.values()
+                               for retained_message in new_dab_0_1_retained_messages(
+                                   {"manufacturer": "DAB reference implementation",
+                                    "model": "Virtual device",
+                                    "serialNumber": device.device_id}, device.topic_prefix)],
+            handler_workers=handler_workers,
+            transport=transport,
+            codec=codec,
+            metrics=metrics,
+            request_dedup=RequestDeduplicator(),
+            priorities={farm_topic(topic_filter): priority for topic_filter, priority in DEFAULT_PRIORITIES.items()},
+            qos_policy={farm_topic(topic_filter): qos for topic_filter, qos in DEFAULT_QOS.items()})
+
+    def __len__(self):
+        return len(self.devices)
+
+    def fleet_devices(self):
+        """
+        Returns the dictionary of device identifiers to topic prefixes, e.g. to create a DabFleet driving the farm
+        """
+        return {device_id: device.topic_prefix for device_id, device in self.devices.items()}
+
+    def connect(self, host, port):
+        self.dab_mqtt_client.connect(host, port)
+
+    def disconnect(self):
+        self.telemetry_scheduler.shutdown()
+        self.dab_mqtt_client.disconnect()
+
+    def _publish(self, topic, payload, retain=False, compress=False):
+        self.dab_mqtt_client.publish(topic, payload, retain=retain, compress=compress)
+
+    def _device_handlers(self, device):
+        handlers = device.handlers
+        if handlers is not None:
+            return handlers
+
+        with self._handlers_lock:
+            if device.handlers is None:
+                device.app_state_tracker = AppStateTracker()
+                request_handlers = new_dab_0_1_request_handlers(
+                    device, device, device, self._publish,
+                    topic_prefix=device.topic_prefix,
+                    telemetry_scheduler=self.telemetry_scheduler,
+                    app_state_tracker=device.app_state_tracker)
+                prefix_length = len(device.topic_prefix) + 1
+                device.handlers = {request_handler.topic[prefix_length:]: request_handler.handler
+                                   for request_handler in request_handlers}
+            return device.handlers
+
+    def _dispatch(self, topic, request_topic, payload):
+        device = self.devices.get(request_topic.split('/')[self._device_id_level])
+        if device is None:
+            raise DabMqttException("Unknown device", 404)
+        handler = self._device_handlers(device)[topic]
+
+        # the failures, the dropped requests and the latency are injected around the handler of the device
+        if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+            future = Future()
+            future.cancel()
+            return future
+        if self.failure_rate > 0 and self.random.random() < self.failure_rate:
+            response = {"status": 500, "error": "Injected failure"}
+            delay_s = 0
+        else:
+            response = handler(request_topic, payload)
+            delay_s = _duration_s(topic, payload)
+
+        delay_s += self.latency_s
+        if self.jitter_s > 0:
+            delay_s += self.random.random() * self.jitter_s
+        if delay_s <= 0:
+            return response
+
+        future = Future()
+        self.dab_mqtt_client.timer_wheel.schedule(delay_s, lambda: future.set_result(response))
+        return future
@@ -0,0 +1,136 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import itertools
+import logging
+
+from collections import OrderedDict, deque
+from dab_client import DabClient, DabClientBatch
+from queue import Empty, SimpleQueue
+from time import monotonic
+
+
+class DabFleet:
+    """
+    Drives many DAB devices concurrently over one shared DabMqttClient connection
+
+    Each device is addressed by an identifier mapped to its topic prefix. An operation broadcast to the fleet
+    is sent to at most max_concurrency devices at a time; every device has its own deadline, so a slow or
+    unresponsive device does not hold back the results of the others.
+    """
+
+    def __init__(self, dab_mqtt_client, devices=None, max_concurrency=32):
+        """
+        :param dab_mqtt_client: the connected DabMqttClient shared by all the devices. A client created with a
+                                response_client_id receives the responses of the devices through a single
+                                subscription, without a subscription per request
+        :param devices: (optional) a dictionary of device identifiers to topic prefixes. A None prefix
+                        addresses the device serving the bare DAB topics
+        :param max_concurrency: (optional) the maximum number of devices with a request in flight (default 32)
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1. max_concurrency={max_concurrency}")
+
+        self.logger = logging.getLogger('dab.fleet')
+        self.dab_mqtt_client = dab_mqtt_client
+        self.devices = dict(devices or {})
+        self.max_concurrency = max_concurrency
+
+    def add_device(self, device_id, topic_prefix):
+        self.devices[device_id] = topic_prefix
+
+    def remove_device(self, device_id):
+        self.devices.pop(device_id, None)
+
+    def client(self, device_id):
+        """
+        Returns a DabClient sending its requests to a single device of the fleet
+        """
+        return DabClient(self.dab_mqtt_client, self.devices[device_id])
+
+    def broadcast(self, operation, *args, device_ids=None, timeout_s=5, **kwargs):
+        """
+        Sends a DabClient operation to the devices of the fleet and yields (device_id, response) pairs
+        as the responses arrive. A device that does not respond within timeout_s of its request being sent
+        is yielded with a DAB error response with the 500 status
+
+            for device_id, response in fleet.broadcast("health_check"):
+                ...
+
+        :param operation: the name of a DabClient operation, e.g. health_check or launch_app
+        :param args: positional arguments of the operation
+        :param device_ids: (optional) the devices to send the operation to, a device listed more than once gets
+                           the operation once (default all the devices)
+        :param timeout_s: (optional) per-device timeout, expressed in seconds (default value is 5 seconds)
+        :param kwargs: keyword arguments of the operation
+        """
+        if device_ids is None:
+            device_ids = list(self.devices)
+        else:
+            device_ids = list(dict.fromkeys(device_ids))
+
+        waiting = deque()
+        for device_id in device_ids:
+            batch = DabClientBatch(self.dab_mqtt_client, self.devices[device_id])
+            getattr(batch, operation)(*args, **kwargs)
+            waiting.extend((device_id, topic, payload) for topic, payload in batch.requests)
+
+        self.logger.info("Broadcasting %s to %d devices", operation, len(waiting))
+
+        completed = SimpleQueue()
+        # requests by sequence number: every request gets the same timeout, so the insertion order is also the order
+        # of the deadlines
+        outstanding = OrderedDict()
+        sequence = itertools.count()
+        try:
+            while waiting or outstanding:
+                while waiting and len(outstanding) < self.max_concurrency:
+                    device_id, topic, payload = waiting.popleft()
+                    request = next(sequence)
+                    message_in_flight = self.dab_mqtt_client.send_request(
+                        topic, payload, lambda response, request=request: completed.put(request), timeout_s)
+                    outstanding[request] = (device_id, topic, message_in_flight, monotonic() + timeout_s)
+
+                _, _, _, earliest_deadline = next(iter(outstanding.values()))
+                try:
+                    request = completed.get(timeout=max(earliest_deadline - monotonic(), 0))
+                except Empty:
+                    now = monotonic()
+                    while outstanding:
+                        request, (device_id, topic, message_in_flight, deadline) = next(iter(outstanding.items()))
+                        if deadline > now:
+                            break
+                        del outstanding[request]
+                        self.dab_mqtt_client.discard_request(message_in_flight)
+                        if self.dab_mqtt_client.metrics is not None:
+                            self.dab_mqtt_client.metrics.request_timed_out(topic)
+                        yield device_id, {
+                            "status": 500,
+                            "error": f"Operation timed out. Topic={topic}",
+                        }
+                    continue
+
+                if request in outstanding:
+                    device_id, _, message_in_flight, _ = outstanding.pop(request)
+                    self.dab_mqtt_client.discard_request(message_in_flight)
+                    yield device_id, self.dab_mqtt_client.codec.decode(message_in_flight.response)
+        finally:
+            for _, _, message_in_flight, _ in outstanding.values():
+                self.dab_mqtt_client.discard_request(message_in_flight)
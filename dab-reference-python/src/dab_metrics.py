@@ -0,0 +1,204 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+from bisect import bisect_left
+from threading import Lock
+
+# upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# the status label of the responses without a DAB status, e.g. a handler returning something else than an object
+UNKNOWN_STATUS = 'unknown'
+
+
+def percentile(sorted_samples, p):
+    """
+    Returns the p-th percentile of samples sorted in ascending order, None when there is none. The value is
+    interpolated linearly between the closest ranks, as numpy.percentile does by default
+    """
+    if not sorted_samples:
+        return None
+    position = (len(sorted_samples) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    return sorted_samples[lower] + (sorted_samples[upper] - sorted_samples[lower]) * (position - lower)
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, as cumulative Prometheus histograms do
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last bucket counts the observations above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {
+            "buckets": buckets,
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class DabMetrics:
+    """
+    Counters, latency histograms and gauges of a DabMqttClient, labelled by DAB topic
+
+    A DabMqttClient created without metrics does not record anything and only pays for a None check per message.
+    The same DabMetrics can be shared by several clients, e.g. a device and the client driving it in a benchmark.
+    """
+
+    def __init__(self, latency_buckets_s=DEFAULT_LATENCY_BUCKETS_S):
+        """
+        :param latency_buckets_s: (optional) upper bounds, in seconds, of the latency histogram buckets
+        """
+        self.latency_buckets_s = tuple(latency_buckets_s)
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def increment(self, name, topic, status=None, value=1):
+        key = (name, topic, status)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, topic, value_s):
+        key = (name, topic)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.latency_buckets_s)
+            histogram.observe(value_s)
+
+    def register_gauge(self, name, read):
+        """
+        Registers a gauge, a function with no parameters returning the current value, read on every snapshot.
+        The gauges registered under the same name, e.g. by several clients sharing this DabMetrics, are summed
+        """
+        with self._lock:
+            self._gauges.setdefault(name, []).append(read)
+
+    # device side: requests handled by this client
+
+    def request_received(self, topic):
+        self.increment('requests_received', topic)
+
+    def request_handled(self, topic, status, latency_s):
+        self.increment('responses_sent', topic, UNKNOWN_STATUS if status is None else status)
+        self.observe('handler_latency_seconds', topic, latency_s)
+
+    def request_deduplicated(self, topic):
+        self.increment('requests_deduplicated', topic)
+
+    def request_rejected(self, topic):
+        self.increment('requests_rejected', topic)
+
+    def request_expired(self, topic):
+        self.increment('requests_expired', topic)
+
+    # client side: requests made by this client
+
+    def request_sent(self, topic):
+        self.increment('requests_sent', topic)
+
+    def response_received(self, topic, round_trip_s):
+        self.observe('round_trip_seconds', topic, round_trip_s)
+
+    def request_timed_out(self, topic):
+        self.increment('request_timeouts', topic)
+
+    def snapshot(self):
+        """
+        Returns the current values as a dictionary: counters and histograms by metric name and topic, gauges by name.
+        The counters of the responses are further broken down by DAB status
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: histogram.snapshot() for key, histogram in self._histograms.items()}
+            gauges = {name: list(reads) for name, reads in self._gauges.items()}
+
+        # a counter broken down by status for a topic counts its records without a status as UNKNOWN_STATUS
+        by_status = {(name, topic) for name, topic, status in counters if status is not None}
+
+        snapshot = {"counters": {}, "histograms": {}, "gauges": {}}
+        for (name, topic, status), value in counters.items():
+            if (name, topic) not in by_status:
+                snapshot["counters"].setdefault(name, {})[topic] = value
+            else:
+                statuses = snapshot["counters"].setdefault(name, {}).setdefault(topic, {})
+                status = UNKNOWN_STATUS if status is None else status
+                statuses[status] = statuses.get(status, 0) + value
+        for (name, topic), histogram in histograms.items():
+            snapshot["histograms"].setdefault(name, {})[topic] = histogram
+        for name, reads in gauges.items():
+            snapshot["gauges"][name] = sum(read() for read in reads)
+        return snapshot
+
+    def to_prometheus(self, prefix='dab_'):
+        """
+        Returns the current values in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def labels(topic, **extra):
+            pairs = [f'topic="{topic}"'] + [f'{key}="{value}"' for key, value in extra.items()]
+            return '{' + ','.join(pairs) + '}'
+
+        for name, values in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            for topic, value in sorted(values.items()):
+                if isinstance(value, dict):
+                    for status, count in sorted(value.items(), key=lambda item: str(item[0])):
+                        lines.append(f"{prefix}{name}_total{labels(topic, status=status)} {count}")
+                else:
+                    lines.append(f"{prefix}{name}_total{labels(topic)} {value}")
+
+        for name, values in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for topic, histogram in sorted(values.items()):
+                for bound, count in histogram["buckets"]:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{prefix}{name}_bucket{labels(topic, le=le)} {count}")
+                lines.append(f"{prefix}{name}_sum{labels(topic)} {histogram['sum']}")
+                lines.append(f"{prefix}{name}_count{labels(topic)} {histogram['count']}")
+
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value}")
+
+        return '\n'.join(lines) + '\n'
@@ -17,19 +17,60 @@ __license__ = """
     limitations under the License.
 """
 
-import json
 import logging
 
-from mqtt_topic_filter import mqtt_matches_filter
-from paho.mqtt.client import Client
-from threading import Event, Thread
+from dab_codec import default_codec
+from dab_compression import COMPRESSION_KEY, ZLIB
+from dab_request_dedup import COMPLETED, IN_PROGRESS
+from dab_request_executor import RequestExecutor
+from dab_timer_wheel import TimerWheel
+from functools import partial
+from mqtt_topic_filter import TopicRouter, is_topic_level, mqtt_matches_filter
+from queue import Empty, SimpleQueue
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, perf_counter
 from uuid import uuid4
 
-logging.basicConfig(
-    format='%(asctime)s %(name)s %(levelname)s %(message)s',
-    level=logging.DEBUG,
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+RESPONSE_TOPIC_PREFIX = '_response/'
+
+# reserved request payload key carrying the response client ID of the requester: the response is published on
+# _response/<response client ID>/<request topic> rather than on _response/<request topic>, so that the requester
+# receives its own responses only through a single subscription
+RESPONSE_CLIENT_KEY = '_responseClient'
+# key of the dab/version message under which a device advertises it answers on the topics of the response client IDs
+CLIENT_RESPONSE_TOPICS = 'clientResponseTopics'
+
+# time to live of a response that never changes, see RequestHandler
+STATIC_RESPONSE = float('inf')
+
+# reserved request payload key carrying how long the requester waits for the response, in milliseconds from the time
+# it sends the request. The device turns it into a deadline of its own monotonic clock as the request arrives, so that
+# the clocks of the device and of the requester need not agree, and drops the requests it could not start in time
+TIMEOUT_KEY = '_timeoutMs'
+
+# QoS of the requests, and of the responses, whose topic no QoS policy entry matches
+DEFAULT_REQUEST_QOS = 0
+DEFAULT_RESPONSE_QOS = 2
+
+# directions of the messages passed to the tap of a DabMqttClient
+TAP_INBOUND = 0
+TAP_OUTBOUND = 1
+
+
+def _time_out(message_in_flight, on_timeout):
+    # the response may have arrived in the same tick
+    if message_in_flight.response is None:
+        on_timeout()
+
+
+def _release_waiter(waiter):
+    # the response and the timeout may both release the waiter
+    try:
+        waiter.release()
+    except RuntimeError:
+        pass
 
 
 class RetainedMessage:
@@ -49,15 +90,26 @@ class RequestHandler:
     Represents a DAB command that conforms to the request / response format.
     """
 
-    def __init__(self, topic, handler):
+    def __init__(self, topic, handler, response_ttl_s=None, qos=None):
         """
         :param topic: an DAB MQTT topic that will accept messages in the request format.
-                      The topic must not have any wildcards like + or #
+                      The topic must not have the # wildcard; + wildcards may stand for inner levels only, e.g.
+                      farm/+/dab/health-check/get serves the health checks of every device prefix
         :param handler: a function that accepts 2 parameters, topic: str and payload: object and responds with
-                        an object that will be serialized to JSON
+                        an object that will be serialized to JSON, or with a concurrent.futures.Future of that
+                        object to respond later without holding the thread
+        :param response_ttl_s: (optional) how long, in seconds, a successful response is reused for the following
+                               requests without invoking the handler again. STATIC_RESPONSE reuses the first
+                               successful response forever. When None (default) every request invokes the handler
+        :param qos: (optional) the QoS the responses are published with. When None (default) the QoS policy of the
+                    client applies
         """
         self.topic = topic
         self.handler = handler
+        self.response_ttl_s = response_ttl_s
+        self.qos = qos
+        # (serialized response, monotonic expiry time, compressed response) of the last cacheable response
+        self.cached_response = None
 
 
 class DabMqttException(Exception):
@@ -67,15 +119,103 @@ class DabMqttException(Exception):
         super(DabMqttException, self).__init__(message, args)
 
 
+class DabMqttTimeoutException(DabMqttException):
+    """
+    Raised when no response, or no retained message, is received in time
+    """
+
+    def __init__(self, message):
+        super(DabMqttTimeoutException, self).__init__(message, 500)
+
+
 class MessageInFlight:
     """
     Represents a message that has been published to the broker that is awaiting a response
     """
 
-    def __init__(self, response_topic, request_event):
+    def __init__(self, topic, request_id, response_topic, on_response):
+        """
+        :param topic: the DAB topic of the request, without the request ID
+        :param request_id: the request ID, the trailing segment of the request topic
+        :param response_topic: the topic the response is expected on
+        :param on_response: a function called from the MQTT thread with the raw response payload
+        """
+        self.topic = topic
+        self.request_id = request_id
         self.response_topic = response_topic
-        self.request_event = request_event
+        self.on_response = on_response
         self.response = None
+        self.sent_at = None
+        # True when the response topic has a subscription of its own, unsubscribed once the request is discarded
+        self.subscribed = False
+        # the Timer of the timeout, cancelled once the request is discarded
+        self.timer = None
+
+
+class Subscription:
+    """
+    A subscription to the messages published on a topic filter, created with DabMqttClient.subscribe
+    """
+
+    def __init__(self, dab_mqtt_client, topic_filter, callback):
+        self.dab_mqtt_client = dab_mqtt_client
+        self.topic_filter = topic_filter
+        self.callback = callback
+
+    def close(self):
+        """
+        Stops receiving the messages of this subscription
+        """
+        self.dab_mqtt_client.unsubscribe(self)
+
+
+class SubscriptionStream(Subscription):
+    """
+    A subscription whose messages are read by iterating over it, created with DabMqttClient.stream.
+    The messages wait in a bounded queue; when the reader falls behind, the oldest ones are dropped
+    """
+
+    def __init__(self, dab_mqtt_client, topic_filter, max_queued):
+        super(SubscriptionStream, self).__init__(dab_mqtt_client, topic_filter, self._enqueue)
+        self.queue = deque(maxlen=max_queued)
+        self.dropped = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def _enqueue(self, topic, payload):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((topic, payload))
+            self.condition.notify()
+
+    def get(self, timeout_s=None):
+        """
+        Returns the next (topic, payload) message, waiting for it at most timeout_s seconds.
+        Returns None on timeout or once the stream is closed and drained
+
+        :param timeout_s: (optional) how long to wait for a message, in seconds. When None (default) waits until
+                          a message arrives or the stream is closed
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.queue or self.closed, timeout=timeout_s):
+                return None
+            if self.queue:
+                return self.queue.popleft()
+            return None
+
+    def __iter__(self):
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        super(SubscriptionStream, self).close()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 
 class DabMqttClient:
@@ -84,17 +224,105 @@ class DabMqttClient:
     and handles the request / response commands as defined by the DAB protocol
     """
 
-    def __init__(self, client_id, request_handlers=[], retained_messages=[]):
+    def __init__(self, client_id, request_handlers=[], retained_messages=[], response_topic_filter=None,
+                 handler_workers=0, concurrency_limits=None, transport=None, codec=None, metrics=None,
+                 request_dedup=None, priorities=None, max_queued=256, tap=None, compression=None, qos_policy=None,
+                 response_client_id=None):
+        """
+        :param client_id: MQTT client identifier, for MQTT diagnostic purposes
+        :param request_handlers: a list of request handlers this client supports
+        :param retained_messages: a list of messages to be published once the client is connected to the broker
+        :param response_topic_filter: (optional) a topic filter, e.g. _response/dab/#, the client subscribes to
+                                      once it connects. Responses to requests are then received through this single
+                                      subscription, instead of subscribing and unsubscribing for every request.
+                                      The filter is shared with the other clients: it also receives their responses.
+                                      When None (default) every request subscribes to its own response topic
+        :param handler_workers: (optional) the number of worker threads running the request handlers.
+                                When 0 (default) the handlers run on the MQTT network thread
+        :param concurrency_limits: (optional) a dictionary of topic filters to the maximum number of handlers
+                                   running concurrently for the matching request topics, e.g. {"dab/input/#": 1}.
+                                   Only applies when the handlers run on worker threads
+        :param transport: (optional) the MQTT client the messages are exchanged through, offering the subset of the
+                          paho.mqtt.client.Client interface this class uses, e.g. a LoopbackTransport connected to
+                          an in-process LoopbackBroker. When None (default) a paho-mqtt client is created
+        :param codec: (optional) the payload serializer, an object with encode(payload) -> bytes and
+                      decode(bytes) -> payload methods. When None (default) the fastest codec available is used,
+                      see dab_codec.default_codec
+        :param metrics: (optional) a DabMetrics recording the request counters and latencies of this client.
+                        When None (default) nothing is recorded
+        :param request_dedup: (optional) a RequestDeduplicator answering the requests received more than once with
+                              the response of the first one, instead of handling them again.
+                              When None (default) every request received is handled
+        :param priorities: (optional) a dictionary of topic filters to the priority class, e.g. PRIORITY_HIGH, of the
+                           matching request topics. The requests waiting for a worker thread run by class first.
+                           Only applies when the handlers run on worker threads
+        :param max_queued: (optional) the maximum number of requests waiting for a worker thread; the requests
+                           received beyond it are rejected with the 503 status, unless they displace a waiting
+                           request of a lower priority class (default 256).
+                           Only applies when the handlers run on worker threads
+        :param tap: (optional) a function called with 3 parameters, the direction TAP_INBOUND or TAP_OUTBOUND,
+                    the topic and the serialized payload, for every message received and published, e.g.
+                    TrafficRecorder.record. It is called from the MQTT thread and from the threads publishing
+        :param compression: (optional) a PayloadCompression compressing the large payloads exchanged with the peers
+                            supporting it: the requests to the devices advertising zlib in their dab/version message,
+                            and the responses to the requests carrying the COMPRESSION_KEY, which the requests of
+                            this client then carry. The compressed payloads received are inflated up to its
+                            max_inflated_bytes. When None (default) this client exchanges uncompressed payloads only
+        :param qos_policy: (optional) a dictionary of topic filters to the QoS of the matching DAB topics, e.g.
+                           {"dab/health-check/get": 0, "dab/#": 2}. The first filter matching a topic applies to the
+                           requests this client sends, and to the responses of its request handlers without a QoS of
+                           their own, which are also the QoS the request topics are subscribed with. A request topic
+                           matching no filter is sent with DEFAULT_REQUEST_QOS, a response with DEFAULT_RESPONSE_QOS.
+                           The responses to the requests of this client are subscribed with DEFAULT_RESPONSE_QOS, so
+                           that they arrive with the QoS the device publishes them with
+        :param response_client_id: (optional) an identifier of this client, unique among the clients of the broker and
+                                   a single topic level, e.g. str(uuid4()). The client subscribes to
+                                   _response/<response_client_id>/# once it connects, and the requests to the devices
+                                   advertising CLIENT_RESPONSE_TOPICS in their dab/version message carry it under the
+                                   RESPONSE_CLIENT_KEY, so that their responses are published to this client only.
+                                   The requests to the other devices, and the requests sent before their dab/version
+                                   message is received, fall back to the response_topic_filter or to a subscription per
+                                   request. When None (default) the responses are published on the DAB response topics
+        """
         self.logger = logging.getLogger('dab.mqtt.client')
+        self.codec = codec if codec is not None else default_codec()
+        self.metrics = metrics
+        self.request_dedup = request_dedup
+        self.tap = tap
+        self.compression = compression
+        self.qos_policy = qos_policy or {}
+        # QoS of the request topics, resolved once per topic
+        self._request_qos = {}
+        # topic prefix of a device, up to its dab/ level -> its retained dab/version message, None until received
+        self.peer_versions = {}
+        # the timeouts of the requests, all run from a single thread
+        self.timer_wheel = TimerWheel()
 
-        self.messages_in_flight = []
+        if response_topic_filter is not None and not response_topic_filter.startswith(RESPONSE_TOPIC_PREFIX):
+            raise DabMqttException(
+                f"Response topic filter must start with {RESPONSE_TOPIC_PREFIX}. Filter={response_topic_filter}", 400)
+        self.response_topic_filter = response_topic_filter
+
+        if response_client_id is not None and not is_topic_level(response_client_id):
+            raise DabMqttException(
+                f"Response client ID must be a single topic level. response_client_id={response_client_id}", 400)
+        self.response_client_id = response_client_id
+
+        # requests awaiting a response, keyed by the request ID, shared between the caller and the MQTT threads
+        self.messages_in_flight = {}
+        self.messages_in_flight_lock = Lock()
+
+        # subscriptions created with the subscribe method, and the QoS and number of subscriptions per topic filter
+        self.subscriptions = TopicRouter()
+        self.subscribed_topic_filters = {}
+        self.subscriptions_lock = Lock()
         self.mqtt_connected_event = Event()
         self.thread = None
 
         def _validate_request_handlers(handlers):
             incorrect_topics = [handler.topic for handler in handlers
-                                if '+' in handler.topic or '#' in handler.topic
-                                or handler.topic.endswith('/')]
+                                if '#' in handler.topic or handler.topic.endswith('/')
+                                or handler.topic == '+' or handler.topic.endswith('/+')]
             if len(incorrect_topics) > 0:
                 raise DabMqttException(
                     """
@@ -104,10 +332,34 @@ class DabMqttClient:
 
         _validate_request_handlers(request_handlers)
         self.request_handlers = request_handlers
+        self.request_router = TopicRouter()
+        # QoS of the responses, by request handler topic
+        self.response_qos = {}
+        for request_handler in request_handlers:
+            self.request_router.add(self._topic_filter_from_dab_topic(request_handler.topic), request_handler)
+            self.response_qos[request_handler.topic] = request_handler.qos if request_handler.qos is not None \
+                else self._policy_qos(request_handler.topic, DEFAULT_RESPONSE_QOS)
         self.retained_messages = retained_messages
 
-        self.mqtt_client = Client(client_id=client_id)
-        self.mqtt_client.enable_logger(logging.getLogger("paho.mqtt"))
+        self.request_executor = None
+        if handler_workers > 0:
+            self.request_executor = RequestExecutor(max_workers=handler_workers,
+                                                    concurrency_limits=concurrency_limits,
+                                                    priorities=priorities,
+                                                    max_queued=max_queued)
+
+        if transport is None:
+            # paho-mqtt is only needed when connecting to an actual broker
+            from paho.mqtt.client import Client
+            transport = Client(client_id=client_id)
+            transport.enable_logger(logging.getLogger("paho.mqtt"))
+
+        self.mqtt_client = transport
+
+        if metrics is not None:
+            metrics.register_gauge('requests_in_flight', lambda: len(self.messages_in_flight))
+            if self.request_executor is not None:
+                metrics.register_gauge('request_queue_depth', lambda: self.request_executor.stats()["queued"])
         self.mqtt_client.on_message = self._mqtt_client_on_message
         self.mqtt_client.on_connect = self._mqtt_client_on_connect
         self.mqtt_client.on_disconnect = self._mqtt_client_on_disconnect
@@ -116,73 +368,333 @@ class DabMqttClient:
     def _topic_filter_from_dab_topic(topic):
         return topic + '/+'
 
+    def _policy_qos(self, topic, default):
+        return next((qos for topic_filter, qos in self.qos_policy.items() if mqtt_matches_filter(topic, topic_filter)),
+                    default)
+
+    def _qos_of_request(self, topic):
+        if not self.qos_policy:
+            return DEFAULT_REQUEST_QOS
+        qos = self._request_qos.get(topic)
+        if qos is None:
+            qos = self._request_qos[topic] = self._policy_qos(topic, DEFAULT_REQUEST_QOS)
+        return qos
+
     def _mqtt_client_on_message(self, client, user_data, message):
         """
         Callback when the client receives a message to one of the subscribed topics
         - the message could be a response from the client / device to the previous request
+        - the message could match a subscription made with the subscribe method
         - the message could be a request to the client / device
         """
         del client, user_data
 
-        self.logger.debug(f"Message arrived on topic: {message.topic} with payload {message.payload}")
+        self.logger.debug("Message arrived on topic: %s with payload %s", message.topic, message.payload)
+        if self.tap is not None:
+            self.tap(TAP_INBOUND, message.topic, message.payload)
+        payload = message.payload
+        # only the peers of a client with compression, which requested or advertised it, send compressed payloads
+        if self.compression is not None:
+            try:
+                payload = self.compression.inflate(payload)
+            except ValueError as e:
+                self._reject_compressed_payload(message.topic, e)
+                return
+
+        if message.topic.startswith(RESPONSE_TOPIC_PREFIX):
+            request_id = message.topic.rpartition('/')[2]
+            with self.messages_in_flight_lock:
+                message_in_flight = self.messages_in_flight.get(request_id)
 
-        matched_messages_in_flight = [message_in_flight for message_in_flight in self.messages_in_flight if
-                                      message_in_flight.response_topic == message.topic]
+            if message_in_flight is not None and message_in_flight.response_topic == message.topic:
+                if self.metrics is not None:
+                    self.metrics.response_received(message_in_flight.topic, perf_counter() - message_in_flight.sent_at)
+                message_in_flight.response = payload
+                message_in_flight.on_response(payload)
+                return
 
-        for matched_message in matched_messages_in_flight:
-            matched_message.response = message.payload
-            matched_message.request_event.set()
+        if self.subscribed_topic_filters:
+            with self.subscriptions_lock:
+                subscriptions = self.subscriptions.match(message.topic)
+            if subscriptions:
+                self._notify_subscriptions(subscriptions, message.topic, payload)
 
-        if len(matched_messages_in_flight) > 0:
+        request_handlers = self.request_router.match(message.topic)
+        if not request_handlers:
             return
 
-        for request_handler in self.request_handlers:
-            topic_filter = self._topic_filter_from_dab_topic(request_handler.topic)
-            if mqtt_matches_filter(message.topic, topic_filter):
-                response_topic = '_response/' + message.topic
-                try:
-                    payload = json.loads(message.payload)
-                    response = request_handler.handler(message.topic, payload)
-                except DabMqttException as e:
-                    self.logger.error("DAB error", e)
-                    response = {
-                        "status": e.error_code,
-                        "error": e.message,
-                    }
-                except Exception as e:
-                    self.logger.error("Internal DAB error", e)
-                    response = {
-                        "status": 500,
-                        "error": "Internal DAB error",
-                    }
-
-                response_json = json.dumps(response)
-                self.logger.debug(f"Responding on topic: {response_topic}, payload {response}")
-                self.mqtt_client.publish(
-                    topic='_response/' + message.topic,
-                    payload=response_json,
-                    qos=2
-                )
+        if self.metrics is not None:
+            for request_handler in request_handlers:
+                self.metrics.request_received(request_handler.topic)
+
+        response_topic = RESPONSE_TOPIC_PREFIX + message.topic
+        try:
+            payload = self.codec.decode(payload)
+        except ValueError:
+            self._publish_response(response_topic, {
+                "status": 400,
+                "error": "Request payload is not valid JSON",
+            }, qos=self.response_qos[request_handlers[0].topic])
+            return
+
+        deadline = None
+        compress = False
+        if isinstance(payload, dict):
+            timeout_ms = payload.pop(TIMEOUT_KEY, None)
+            if isinstance(timeout_ms, (int, float)) and timeout_ms.__class__ is not bool:
+                deadline = monotonic() + timeout_ms / 1000
+            compress = self.compression is not None and payload.get(COMPRESSION_KEY) == ZLIB
+            response_client_id = payload.pop(RESPONSE_CLIENT_KEY, None)
+            if response_client_id is not None:
+                if not is_topic_level(response_client_id):
+                    self._publish_response(response_topic, {
+                        "status": 400,
+                        "error": f"{RESPONSE_CLIENT_KEY} must be a single topic level",
+                    }, qos=self.response_qos[request_handlers[0].topic])
+                    return
+                response_topic = RESPONSE_TOPIC_PREFIX + response_client_id + '/' + message.topic
+
+        # a duplicate is answered on its own response topic
+        if self.request_dedup is not None and self._deduplicate(request_handlers, message.topic, response_topic):
+            return
+        if deadline is not None and self._expired(request_handlers, message.topic, deadline):
+            return
+
+        for request_handler in request_handlers:
+            if self.request_executor is None:
+                self._handle_request(request_handler, message.topic, payload, response_topic, compress=compress)
+            elif not self.request_executor.submit(
+                    request_handler.topic,
+                    partial(self._handle_request, request_handler, message.topic, payload, response_topic, deadline,
+                            compress),
+                    reject=partial(self._reject_request, request_handler, message.topic, response_topic)):
+                self._reject_request(request_handler, message.topic, response_topic)
+
+    def _reject_compressed_payload(self, topic, error):
+        """
+        Answers a request whose compressed payload cannot be inflated; the other messages are dropped
+        """
+        self.logger.warning("Dropping the message on topic %s: %s", topic, error)
+        request_handlers = self.request_router.match(topic)
+        if request_handlers:
+            self._publish_response(RESPONSE_TOPIC_PREFIX + topic, {
+                "status": 400,
+                "error": str(error),
+            }, qos=self.response_qos[request_handlers[0].topic])
+
+    def _reject_request(self, request_handler, topic, response_topic):
+        """
+        Answers a request the worker threads have no room for, rather than letting the queue and the latency grow
+        """
+        self.logger.warning("Request queue full, rejecting the request on topic %s", topic)
+        self._publish_response(response_topic, {
+            "status": 503,
+            "error": "Device busy, request rejected",
+        }, qos=self.response_qos[request_handler.topic])
+        # the request is handled if it is sent again
+        if self.request_dedup is not None:
+            self.request_dedup.discard(topic)
+        if self.metrics is not None:
+            self.metrics.request_rejected(request_handler.topic)
+
+    def _expired(self, request_handlers, topic, deadline):
+        """
+        Returns True, after dropping the request, when the requester has stopped waiting for its response
+        """
+        if monotonic() < deadline:
+            return False
+
+        self.logger.debug("Dropping the request %s, past its deadline", topic)
+        # the request is handled if it is sent again with a new deadline
+        if self.request_dedup is not None:
+            self.request_dedup.discard(topic)
+        if self.metrics is not None:
+            for request_handler in request_handlers:
+                self.metrics.request_expired(request_handler.topic)
+        return True
+
+    def _deduplicate(self, request_handlers, topic, response_topic):
+        """
+        Returns True when the request was already received, after replaying its response if it has one
+        """
+        outcome, encoded_response = self.request_dedup.begin(topic)
+        if outcome == COMPLETED:
+            self.logger.debug("Replaying the response of the duplicate request %s", topic)
+            self._publish_encoded_response(response_topic, encoded_response,
+                                           self.response_qos[request_handlers[0].topic])
+        elif outcome == IN_PROGRESS:
+            self.logger.debug("Dropping the duplicate of the request in progress %s", topic)
+        else:
+            return False
+
+        if self.metrics is not None:
+            for request_handler in request_handlers:
+                self.metrics.request_deduplicated(request_handler.topic)
+        return True
+
+    def _notify_subscriptions(self, subscriptions, topic, payload):
+        try:
+            # an empty message clears a retained message
+            payload = self.codec.decode(payload) if payload else None
+        except ValueError:
+            self.logger.error("Message on topic %s is not valid JSON", topic)
+            return
+
+        for subscription in subscriptions:
+            try:
+                subscription.callback(topic, payload)
+            except Exception:
+                self.logger.exception("Subscription callback failed. Topic filter=%s", subscription.topic_filter)
+
+    def _handle_request(self, request_handler, topic, payload, response_topic, deadline=None, compress=False):
+        """
+        Invokes the request handler and publishes its response, on the MQTT thread or on a worker thread
+        """
+        # the request may have waited for a worker past its deadline
+        if deadline is not None and self._expired((request_handler,), topic, deadline):
+            return
+
+        started = perf_counter() if self.metrics is not None else None
+
+        if request_handler.response_ttl_s is not None:
+            cached_response = request_handler.cached_response
+            if cached_response is not None and monotonic() < cached_response[1]:
+                self._publish_encoded_response(response_topic,
+                                               cached_response[2] if compress else cached_response[0],
+                                               self.response_qos[request_handler.topic])
+                if self.request_dedup is not None:
+                    self.request_dedup.complete(topic, cached_response[0])
+                if started is not None:
+                    self.metrics.request_handled(request_handler.topic, 200, perf_counter() - started)
+                return
+
+        try:
+            response = request_handler.handler(topic, payload)
+        except Exception as e:
+            response = self._error_response(topic, e)
+
+        if isinstance(response, Future):
+            response.add_done_callback(
+                partial(self._complete_deferred_request, request_handler, topic, response_topic, started, compress))
+            return
+
+        self._complete_request(request_handler, topic, response_topic, response, started, compress)
+
+    def _complete_deferred_request(self, request_handler, topic, response_topic, started, compress, future):
+        if future.cancelled():
+            self.logger.debug("Request %s cancelled by its handler, not responding", topic)
+            if self.request_dedup is not None:
+                self.request_dedup.discard(topic)
+            return
+
+        try:
+            response = future.result()
+        except Exception as e:
+            response = self._error_response(topic, e)
+        self._complete_request(request_handler, topic, response_topic, response, started, compress)
+
+    def _error_response(self, topic, exception):
+        if isinstance(exception, DabMqttException):
+            self.logger.error("DAB error on topic %s: %s", topic, exception.message)
+            return {
+                "status": exception.error_code,
+                "error": exception.message,
+            }
+
+        self.logger.error("Internal DAB error on topic %s", topic, exc_info=exception)
+        return {
+            "status": 500,
+            "error": "Internal DAB error",
+        }
+
+    def _complete_request(self, request_handler, topic, response_topic, response, started, compress=False):
+        """
+        Publishes the response of a request handler, caches it and records the request metrics
+        """
+        encoded_response = self._publish_response(response_topic, response, compress,
+                                                  self.response_qos[request_handler.topic])
+        status = response.get("status") if isinstance(response, dict) else None
+
+        if self.request_dedup is not None:
+            self.request_dedup.complete(topic, encoded_response)
+
+        if request_handler.response_ttl_s is not None and status == 200:
+            # the response is compressed once for all the requests it answers
+            compressed_response = self.compression.deflate(encoded_response) if self.compression is not None else None
+            request_handler.cached_response = (encoded_response, monotonic() + request_handler.response_ttl_s,
+                                               compressed_response)
+
+        if started is not None:
+            self.metrics.request_handled(request_handler.topic, status, perf_counter() - started)
+
+    def _publish_response(self, response_topic, response, compress=False, qos=DEFAULT_RESPONSE_QOS):
+        """
+        Publishes a response, compressed when the requester accepts it, and returns it serialized and uncompressed,
+        as the duplicates of the request are answered whether their requester accepts compression or not
+        """
+        self.logger.debug("Responding on topic: %s, payload %s", response_topic, response)
+        encoded_response = self.codec.encode(response)
+        self._publish_encoded_response(
+            response_topic, self.compression.deflate(encoded_response) if compress else encoded_response, qos)
+        return encoded_response
+
+    def _publish_encoded_response(self, response_topic, encoded_response, qos=DEFAULT_RESPONSE_QOS):
+        self._mqtt_publish(
+            topic=response_topic,
+            payload=encoded_response,
+            qos=qos
+        )
+
+    def _mqtt_publish(self, topic, payload, qos=0, retain=False):
+        if self.tap is not None:
+            self.tap(TAP_OUTBOUND, topic, payload)
+        self.mqtt_client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
 
     def _mqtt_client_on_connect(self, client, userdata, flags, rc):
         """
         Callback when the client connects to the MQTT broker
         - subscribes to the request topics that this client handles
+        - subscribes to the response topic filter, and to the responses of the response client ID, when configured
+        - subscribes to the topic filters of the subscriptions made with the subscribe method
         - publishes the retained messages
         """
         del client, userdata, flags, rc
 
         self.logger.info("Connected to the MQTT broker")
+        # the broker delivers a message with the lower of the publish and the subscription QoS: the requests of an
+        # operation are received with the QoS its responses are published with, e.g. QoS 2 for the state changes
         for request_handler in self.request_handlers:
             topic_filter = self._topic_filter_from_dab_topic(request_handler.topic)
             self.mqtt_client.subscribe(
-                topic=topic_filter
+                topic=topic_filter,
+                qos=self.response_qos[request_handler.topic]
+            )
+
+        # the responses are received with the QoS the devices publish them with, at most DEFAULT_RESPONSE_QOS
+        if self.response_topic_filter is not None:
+            self.mqtt_client.subscribe(
+                topic=self.response_topic_filter,
+                qos=DEFAULT_RESPONSE_QOS
+            )
+        if self.response_client_id is not None:
+            self.mqtt_client.subscribe(
+                topic=RESPONSE_TOPIC_PREFIX + self.response_client_id + '/#',
+                qos=DEFAULT_RESPONSE_QOS
+            )
+
+        with self.subscriptions_lock:
+            subscribed_topic_filters = [(topic_filter, qos) for topic_filter, (qos, _)
+                                        in self.subscribed_topic_filters.items()]
+        for topic_filter, qos in subscribed_topic_filters:
+            self.mqtt_client.subscribe(
+                topic=topic_filter,
+                qos=qos
             )
 
         for retained_message in self.retained_messages:
-            self.mqtt_client.publish(
+            self._mqtt_publish(
                 topic=retained_message.topic,
-                payload=json.dumps(retained_message.message),
+                payload=self.codec.encode(retained_message.message),
                 qos=2,
                 retain=True
             )
@@ -199,8 +711,14 @@ class DabMqttClient:
         self.mqtt_connected_event.clear()
 
     def _mqtt_connect_and_start_loop(self, host, port):
-        self.mqtt_client.connect(host, port)
-        self.mqtt_client.loop_forever()
+        if self.request_executor is not None:
+            self.request_executor.start()
+        try:
+            self.mqtt_client.connect(host, port)
+            self.mqtt_client.loop_forever()
+        finally:
+            if self.request_executor is not None:
+                self.request_executor.shutdown()
 
     def connect(self, host, port):
         """
@@ -210,7 +728,7 @@ class DabMqttClient:
             raise DabMqttException(
                 'DAB MQTT client already connected to the broker, disconnect first before reconnecting', 400)
 
-        self.logger.info(f"Connecting to the MQTT broker at {host}:{port}")
+        self.logger.info("Connecting to the MQTT broker at %s:%s", host, port)
 
         self.thread = Thread(target=lambda: self._mqtt_connect_and_start_loop(host, port))
         self.thread.start()
@@ -243,7 +761,76 @@ class DabMqttClient:
 
         self.thread.join()
 
-    def request(self, topic, payload, timeout_s=5):
+    def publish(self, topic, payload, qos=0, retain=False, compress=False):
+        """
+        Publishes a message that is not part of a request / response exchange, e.g. a telemetry sample
+
+        :param topic: the MQTT topic to publish to
+        :param payload: an object to be serialized into JSON
+        :param qos: (optional) the QoS of the message (default 0)
+        :param retain: (optional) True to have the broker retain the message (default False)
+        :param compress: (optional) True to compress the message with the compression of the client, when its
+                         subscribers accept it, e.g. the telemetry of a stream started by a request carrying the
+                         COMPRESSION_KEY (default False)
+        """
+        encoded_payload = self.codec.encode(payload)
+        if compress and self.compression is not None:
+            encoded_payload = self.compression.deflate(encoded_payload)
+        self._mqtt_publish(topic=topic, payload=encoded_payload, qos=qos, retain=retain)
+
+    def subscribe(self, topic_filter, callback, qos=0):
+        """
+        Subscribes to the messages published on a topic filter, e.g. retained messages or telemetry.
+        The subscription is kept when the client reconnects, until it is closed
+
+        :param topic_filter: an MQTT topic filter, possibly containing + and # wildcards
+        :param callback: a function called from the MQTT thread with 2 parameters, topic: str and the deserialized
+                         payload: object, None when a retained message is cleared
+        :param qos: (optional) the maximum QoS of the messages received (default 0)
+        """
+        return self._subscribe(Subscription(self, topic_filter, callback), qos)
+
+    def _subscribe(self, subscription, qos):
+        topic_filter = subscription.topic_filter
+        with self.subscriptions_lock:
+            self.subscriptions.add(topic_filter, subscription)
+            subscribed_qos, count = self.subscribed_topic_filters.get(topic_filter, (qos, 0))
+            self.subscribed_topic_filters[topic_filter] = (max(qos, subscribed_qos), count + 1)
+
+        # subscribing again to a topic filter also has the broker send its retained messages again
+        if self.is_connected():
+            self.mqtt_client.subscribe(topic=topic_filter, qos=max(qos, subscribed_qos))
+
+        return subscription
+
+    def stream(self, topic_filter, qos=0, max_queued=1024):
+        """
+        Subscribes to the messages published on a topic filter and returns a SubscriptionStream to iterate over them
+        as (topic, payload) pairs, e.g. to read telemetry from another thread. The iteration ends when the stream
+        is closed
+
+        :param topic_filter: an MQTT topic filter, possibly containing + and # wildcards
+        :param qos: (optional) the maximum QoS of the messages received (default 0)
+        :param max_queued: (optional) how many messages are kept for the reader before the oldest are dropped
+                           (default 1024)
+        """
+        return self._subscribe(SubscriptionStream(self, topic_filter, max_queued), qos)
+
+    def unsubscribe(self, subscription):
+        """
+        Closes a subscription made with the subscribe method
+        """
+        with self.subscriptions_lock:
+            if not self.subscriptions.remove(subscription.topic_filter, subscription):
+                return
+            qos, count = self.subscribed_topic_filters.pop(subscription.topic_filter)
+            if count > 1:
+                self.subscribed_topic_filters[subscription.topic_filter] = (qos, count - 1)
+
+        if count == 1 and self.is_connected():
+            self.mqtt_client.unsubscribe(subscription.topic_filter)
+
+    def request(self, topic, payload, timeout_s=5, request_id=None):
         """
         Makes a request to the DAB-enabled device, using the request/response convention
         This method will automatically generate the request ID and append it to the request
@@ -252,38 +839,207 @@ class DabMqttClient:
         :param topic: DAB topic, with no trailing forward slash and without the request_id
         :param payload: an object to be serialized into JSON and sent to the DAB-enabled device
         :param timeout_s: (optional) request timeout, expressed in seconds (default value is 5 seconds)
+        :param request_id: (optional) the request ID, see send_request. When None (default) a new one is generated
+        """
+        self.logger.info("Request: topic=%s, payload=%s", topic, payload)
+
+        # released by the response or by the timeout, whichever comes first
+        waiter = Lock()
+        waiter.acquire()
+        message_in_flight = self.send_request(topic, payload, lambda response: _release_waiter(waiter), timeout_s,
+                                              request_id, on_timeout=partial(_release_waiter, waiter))
+
+        try:
+            waiter.acquire()
+            if message_in_flight.response is None:
+                if self.metrics is not None:
+                    self.metrics.request_timed_out(topic)
+                raise DabMqttTimeoutException(f"Operation timed out. Topic={topic}")
+
+            response = self.codec.decode(message_in_flight.response)
+            self.logger.info("response=%s", response)
+            return response
+        finally:
+            self.discard_request(message_in_flight)
+
+    def request_many(self, requests, timeout_s=5):
+        """
+        Makes a batch of requests to the DAB-enabled device. All the requests are published back-to-back
+        and the responses are awaited together, with a single deadline for the whole batch
+
+        Returns the deserialized responses in the order of the requests. A request that has not received a response
+        before the deadline is represented by a DAB error response with the 500 status
+
+        :param requests: a list of (topic, payload) pairs, as accepted by the request method
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        responses = [None] * len(requests)
+        for index, response in self.request_many_as_completed(requests, timeout_s):
+            responses[index] = response
+        return responses
+
+    def request_many_as_completed(self, requests, timeout_s=5):
+        """
+        Same as request_many, but yields (index, response) pairs as soon as each response arrives.
+        The requests still pending at the deadline are yielded last, as DAB error responses with the 500 status
+
+        :param requests: a list of (topic, payload) pairs, as accepted by the request method
+        :param timeout_s: (optional) batch timeout, expressed in seconds (default value is 5 seconds)
+        """
+        requests = list(requests)
+        self.logger.info("Request batch: %d requests", len(requests))
+
+        completed = SimpleQueue()
+        messages_in_flight = []
+        try:
+            for index, (topic, payload) in enumerate(requests):
+                messages_in_flight.append(self.send_request(
+                    topic, payload, lambda response, index=index: completed.put(index), timeout_s))
+
+            deadline = monotonic() + timeout_s
+            pending = set(range(len(messages_in_flight)))
+            while pending:
+                remaining_s = deadline - monotonic()
+                if remaining_s <= 0:
+                    break
+                try:
+                    index = completed.get(timeout=remaining_s)
+                except Empty:
+                    break
+
+                if index in pending:
+                    pending.remove(index)
+                    yield index, self.codec.decode(messages_in_flight[index].response)
+
+            for index in sorted(pending):
+                topic = requests[index][0]
+                if self.metrics is not None:
+                    self.metrics.request_timed_out(topic)
+                yield index, {
+                    "status": 500,
+                    "error": f"Operation timed out. Topic={topic}",
+                }
+        finally:
+            for message_in_flight in messages_in_flight:
+                self.discard_request(message_in_flight)
+
+    def send_request(self, topic, payload, on_response, timeout_s=None, request_id=None, on_timeout=None):
         """
-        self.logger.info(f"Request: topic={topic}, payload={payload}")
+        Registers a new message in flight and publishes the request without waiting for the response.
+        The caller owns the returned message in flight and must release it with discard_request
 
+        :param topic: DAB topic, with no trailing forward slash and without the request_id
+        :param payload: an object to be serialized into JSON and sent to the DAB-enabled device
+        :param on_response: a function called from the MQTT thread with the raw response payload
+        :param timeout_s: (optional) how long the caller waits for the response, in seconds. It is sent with the
+                          request, under the TIMEOUT_KEY of the payload, so that the device drops the request if it
+                          cannot start it in time. When None (default) no timeout is sent
+        :param request_id: (optional) the request ID appended to the topic. Retrying a request that timed out with
+                           its request ID sends it on the same topic, so that a device deduplicating the requests
+                           answers the retry with the response of the first attempt instead of executing it twice.
+                           When None (default) a new request ID is generated
+        :param on_timeout: (optional) a function with no parameters called from the TimerWheel thread when no
+                           response has been received timeout_s seconds after the request is sent, unless the request
+                           is discarded first. It lets many requests wait for their response without a thread each
+        """
         if not self.is_connected():
             raise DabMqttException(f"DAB MQTT client is not connected to the broker", 400)
 
         if topic.endswith('/'):
             raise DabMqttException(f'Request topic must not end with a forward slash. Topic={topic}', 400)
 
-        request_event = Event()
-        request_topic = topic + '/' + str(uuid4())
-        mqtt_payload = json.dumps(payload)
-        response_topic = "_response/" + request_topic
+        if request_id is None:
+            request_id = str(uuid4())
+        elif not is_topic_level(request_id):
+            raise DabMqttException(f"Request ID must be a single topic level. request_id={request_id}", 400)
+        request_topic = topic + '/' + request_id
+        peer_version = None
+        if self.compression is not None or self.response_client_id is not None:
+            peer_version = self._peer_version(topic)
+        client_response = self.response_client_id is not None and isinstance(payload, dict) and \
+            peer_version is not None and peer_version.get(CLIENT_RESPONSE_TOPICS) is True
+        if (timeout_s is not None or self.compression is not None or client_response) and isinstance(payload, dict):
+            payload = dict(payload)
+            if timeout_s is not None:
+                payload[TIMEOUT_KEY] = int(timeout_s * 1000)
+            if self.compression is not None:
+                payload[COMPRESSION_KEY] = ZLIB
+            if client_response:
+                payload[RESPONSE_CLIENT_KEY] = self.response_client_id
+        mqtt_payload = self.codec.encode(payload)
+        if self.compression is not None and peer_version is not None and ZLIB in peer_version.get("compression", ()):
+            mqtt_payload = self.compression.deflate(mqtt_payload)
+
+        if client_response:
+            response_topic = RESPONSE_TOPIC_PREFIX + self.response_client_id + '/' + request_topic
+        else:
+            response_topic = RESPONSE_TOPIC_PREFIX + request_topic
+            if self.response_topic_filter is not None and \
+                    not mqtt_matches_filter(response_topic, self.response_topic_filter):
+                raise DabMqttException(
+                    f"Response topic is not covered by the response topic filter. Topic={response_topic}", 400)
 
-        message_in_flight = MessageInFlight(response_topic, request_event)
-        self.messages_in_flight.append(message_in_flight)
+        message_in_flight = MessageInFlight(topic, request_id, response_topic, on_response)
+        with self.messages_in_flight_lock:
+            if request_id in self.messages_in_flight:
+                raise DabMqttException(f"Request ID already in flight. request_id={request_id}", 400)
+            self.messages_in_flight[request_id] = message_in_flight
 
         try:
-            self.logger.debug(f"Awaiting response on topic: {response_topic}")
-            self.mqtt_client.subscribe(response_topic)
-            self.logger.debug(f"Publishing message to topic: {request_topic}")
-            self.mqtt_client.publish(request_topic, mqtt_payload)
+            self.logger.debug("Awaiting response on topic: %s", response_topic)
+            qos = self._qos_of_request(topic)
+            if not client_response and self.response_topic_filter is None:
+                message_in_flight.subscribed = True
+                self.mqtt_client.subscribe(response_topic, qos=DEFAULT_RESPONSE_QOS)
+            self.logger.debug("Publishing message to topic: %s", request_topic)
+            if self.metrics is not None:
+                self.metrics.request_sent(topic)
+                message_in_flight.sent_at = perf_counter()
+            self._mqtt_publish(request_topic, mqtt_payload, qos=qos)
+            if on_timeout is not None and timeout_s is not None:
+                message_in_flight.timer = self.timer_wheel.schedule(
+                    timeout_s, partial(_time_out, message_in_flight, on_timeout))
+        except Exception:
+            self.discard_request(message_in_flight)
+            raise
 
-            if not request_event.wait(timeout_s):
-                raise DabMqttException(f"Operation timed out. Topic={topic}", 500)
+        return message_in_flight
 
-            response = json.loads(message_in_flight.response)
-            self.logger.info(f"response={response}")
-            return response
-        finally:
+    def _peer_version(self, topic):
+        """
+        Returns the dab/version message of the device a request topic is addressed to, telling the compression and
+        the response topics it supports, or None until it is received. The first request to a device subscribes to
+        the message, the requests sent before it arrives use neither
+        """
+        if topic.startswith('dab/'):
+            dab_root = 'dab/'
+        else:
+            index = topic.find('/dab/')
+            if index < 0:
+                return None
+            dab_root = topic[:index + 5]
+
+        try:
+            return self.peer_versions[dab_root]
+        except KeyError:
+            self.peer_versions[dab_root] = None
+            self.subscribe(dab_root + 'version', partial(self._on_dab_version, dab_root))
+            return None
+
+    def _on_dab_version(self, dab_root, topic, message):
+        del topic
+        self.peer_versions[dab_root] = message if isinstance(message, dict) else None
+
+    def discard_request(self, message_in_flight):
+        """
+        Stops awaiting the response of a message in flight, whether it has been received or not
+        """
+        with self.messages_in_flight_lock:
+            self.messages_in_flight.pop(message_in_flight.request_id, None)
+        if message_in_flight.timer is not None:
+            message_in_flight.timer.cancel()
+        if message_in_flight.subscribed:
             try:
-                self.mqtt_client.unsubscribe(response_topic)
-                self.messages_in_flight.remove(message_in_flight)
+                self.mqtt_client.unsubscribe(message_in_flight.response_topic)
             except Exception:
                 pass
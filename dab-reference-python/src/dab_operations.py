@@ -0,0 +1,292 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import inspect
+import logging
+import re
+
+from dab_mqtt_client import DabMqttException, RequestHandler
+from functools import partial
+
+_UPPER_CASE = re.compile(r'(?<!^)(?=[A-Z])')
+# the JSON names of the parameter types, for the error messages
+_TYPE_NAMES = {str: 'string', int: 'number', float: 'number', bool: 'boolean', list: 'list', dict: 'object'}
+
+
+def _argument_name(key):
+    # appId -> app_id
+    return _UPPER_CASE.sub('_', key).lower()
+
+
+def _type_names(types):
+    return ' or '.join(dict.fromkeys(_TYPE_NAMES.get(t, t.__name__) for t in types))
+
+
+class Parameter:
+    """
+    A parameter of a DAB operation: a key of the request payload, passed to the port as a keyword argument
+    """
+
+    __slots__ = ('key', 'types', 'required', 'default', 'argument', 'check', 'forwarded')
+
+    def __init__(self, key, types=None, required=False, default=None, argument=None, check=None, forwarded=True):
+        """
+        :param key: the key of the request payload, e.g. appId
+        :param types: (optional) the type, or tuple of types, of the value. When None (default) any value is accepted
+        :param required: (optional) True when the request must carry the parameter (default False)
+        :param default: (optional) the value of an absent parameter (default None)
+        :param argument: (optional) the keyword argument name. Defaults to the key in snake case, e.g. app_id
+        :param check: (optional) a function returning an error message when a value of the right type is invalid,
+                      None otherwise
+        :param forwarded: (optional) False when the parameter is used by the device and not passed to the port
+                          (default True)
+        """
+        self.key = key
+        self.types = (types,) if isinstance(types, type) else types
+        self.required = required
+        self.default = default
+        self.argument = argument if argument is not None else _argument_name(key)
+        self.check = check
+        self.forwarded = forwarded
+
+
+def compile_parameters(parameters):
+    """
+    Returns a function validating a request payload against the parameters and returning the keyword arguments,
+    or raising a DabMqttException with the 400 status. The parameters are turned into a tuple of plain values once,
+    so that a request costs a dictionary lookup and an isinstance check per parameter
+    """
+    plan = tuple((parameter.key, parameter.argument, parameter.types, parameter.required, parameter.default,
+                  parameter.check, parameter.types is not None and bool not in parameter.types)
+                 for parameter in parameters)
+
+    def bind(payload):
+        if not isinstance(payload, dict):
+            raise DabMqttException("Request payload must be an object", 400)
+
+        arguments = {}
+        for key, argument, types, required, default, check, reject_bool in plan:
+            value = payload.get(key)
+            if value is None:
+                if required:
+                    raise DabMqttException(f"parameter {key} is mandatory", 400)
+                arguments[argument] = default
+                continue
+            # booleans are integers to isinstance
+            if types is not None and (not isinstance(value, types) or (reject_bool and value.__class__ is bool)):
+                raise DabMqttException(f"parameter {key} must be a {_type_names(types)}", 400)
+            if check is not None:
+                error = check(value)
+                if error is not None:
+                    raise DabMqttException(f"parameter {key} {error}", 400)
+            arguments[argument] = value
+        return arguments
+
+    return bind
+
+
+class Operation:
+    """
+    A DAB operation: the request topic, the port method serving it and the schema of its parameters
+    """
+
+    __slots__ = ('topic', 'port', 'method', 'parameters', 'port_arguments', 'optional', 'requires', 'bind',
+                 '_checked')
+
+    def __init__(self, topic, method, parameters=(), port_arguments=(), optional=False, requires=()):
+        """
+        :param topic: the DAB request topic, e.g. dab/applications/launch
+        :param method: the port method, as <port>.<method>, e.g. applications.launch
+        :param parameters: (optional) the Parameter list of the request payload
+        :param port_arguments: (optional) the names of the keyword arguments of the port method supplied by the
+                               device rather than by the request, e.g. on_progress
+        :param optional: (optional) True for an extension of the specification, which is not served when the port
+                         does not implement its method (default False: the port must implement it)
+        :param requires: (optional) the other port methods the device calls to serve the operation, as
+                         (<port>.<method>, argument names) pairs, e.g. the telemetry sample methods. They are checked
+                         as the method of the operation is: an optional operation is not served when a port does not
+                         implement one of them
+        """
+        self.topic = topic
+        self.port, _, self.method = method.partition('.')
+        self.parameters = tuple(parameters)
+        self.port_arguments = tuple(port_arguments)
+        self.optional = optional
+        self.requires = tuple(requires)
+        self.bind = compile_parameters(self.parameters)
+        # the functions of the port methods already checked, e.g. for the many simulated devices of a farm
+        self._checked = set()
+
+    def port_method(self, ports):
+        """
+        Returns the port method of the operation, raising a TypeError when the port does not implement it with
+        keyword arguments matching the parameters, or does not implement the methods the operation requires
+        """
+        for required, arguments in self.requires:
+            port, _, method = required.partition('.')
+            self._checked_method(ports, port, method, arguments)
+
+        arguments = [parameter.argument for parameter in self.parameters if parameter.forwarded]
+        arguments.extend(self.port_arguments)
+        return self._checked_method(ports, self.port, self.method, arguments)
+
+    def unimplemented_methods(self, ports):
+        """
+        Returns the port methods, as <port>.<method>, the operation cannot be served without and the ports do not
+        implement: its own method and the methods it requires
+        """
+        methods = [self.port + '.' + self.method]
+        methods.extend(required for required, _ in self.requires)
+        unimplemented = []
+        for method in methods:
+            port, _, name = method.partition('.')
+            if not callable(getattr(ports.get(port), name, None)):
+                unimplemented.append(method)
+        return unimplemented
+
+    def _checked_method(self, ports, port_name, method_name, arguments):
+        port = ports.get(port_name)
+        if port is None:
+            raise TypeError(f"No {port_name} port for the operation {self.topic}")
+        method = getattr(port, method_name, None)
+        if not callable(method):
+            raise TypeError(f"{type(port).__name__} does not implement {method_name}, required by {self.topic}")
+        function = getattr(method, '__func__', None)
+        if function is not None and function in self._checked:
+            return method
+
+        try:
+            inspect.signature(method).bind(**dict.fromkeys(arguments))
+        except TypeError as e:
+            raise TypeError(f"{type(port).__name__}.{method_name}{inspect.signature(method)} does not accept the "
+                            f"arguments ({', '.join(arguments)}) of {self.topic}: {e}")
+        if function is not None:
+            self._checked.add(function)
+        return method
+
+
+class OperationRegistry:
+    """
+    The DAB operations a device serves, declared once with the schema of their parameters:
+
+        operations = OperationRegistry()
+        operations.declare(topics.SYSTEM_LANGUAGE_SET_TOPIC, "system.set_language",
+                           Parameter("language", str, required=True))
+
+    request_handlers checks the port methods when the device is created, so that a port missing a method or taking
+    other arguments fails at startup rather than with 500 responses, and returns the RequestHandlers validating
+    the request payloads and calling the port methods with keyword arguments. The optional operations whose method,
+    or a method they require, the ports do not implement are left out with a log line.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dab.operations')
+        self.operations = {}
+
+    def declare(self, topic, method, *parameters, port_arguments=(), optional=False, requires=()):
+        """
+        Declares an operation, see Operation
+        """
+        if topic in self.operations:
+            raise ValueError(f"Operation {topic} already declared")
+        self.operations[topic] = Operation(topic, method, parameters, port_arguments, optional, requires)
+        return self.operations[topic]
+
+    def __iter__(self):
+        return iter(self.operations.values())
+
+    def __len__(self):
+        return len(self.operations)
+
+    def request_handlers(self, ports, wrappers=None, topic=None, response_ttls=None):
+        """
+        Returns a RequestHandler per operation, after checking the ports implement them. Raises a TypeError when the
+        ports do not implement an operation that is not optional, or a method it requires
+
+        :param ports: a dictionary of port names to port objects, e.g. {"applications": applications}
+        :param wrappers: (optional) a dictionary of operation topics to functions serving the operation in place of
+                         the port method, called with the port method followed by the keyword arguments of the
+                         request, e.g. to update the state of the device after the port responds
+        :param topic: (optional) a function returning the request topic of an operation topic, e.g. adding the topic
+                      prefix of the device
+        :param response_ttls: (optional) a dictionary of operation topics to the response_ttl_s of their handlers
+        """
+        wrappers = wrappers or {}
+        response_ttls = response_ttls or {}
+        unknown = set(wrappers) - set(self.operations)
+        if unknown:
+            raise ValueError(f"Wrappers of undeclared operations: {', '.join(sorted(unknown))}")
+
+        request_handlers = []
+        for operation in self:
+            if operation.optional:
+                unimplemented = operation.unimplemented_methods(ports)
+                if unimplemented:
+                    self.logger.info("%s is not served, the ports do not implement %s", operation.topic,
+                                     ', '.join(unimplemented))
+                    continue
+            device_arguments = tuple(parameter.argument for parameter in operation.parameters
+                                     if not parameter.forwarded)
+            request_handlers.append(RequestHandler(
+                topic=topic(operation.topic) if topic is not None else operation.topic,
+                handler=_handler(operation.bind if operation.parameters else None, operation.port_method(ports),
+                                 wrappers.get(operation.topic), device_arguments),
+                response_ttl_s=response_ttls.get(operation.topic)))
+        return request_handlers
+
+
+def _handler(bind, method, wrapper, device_arguments):
+    # partial objects rather than closures, as a device farm holds the handlers of many devices
+    if bind is None:
+        # operations without parameters accept any payload, as an empty request may be sent as null
+        if wrapper is not None:
+            return partial(_call_wrapper, wrapper, method)
+        return partial(_call, method)
+
+    if wrapper is not None:
+        return partial(_call_wrapper_with_arguments, bind, wrapper, method)
+
+    if device_arguments:
+        return partial(_call_with_port_arguments, bind, method, device_arguments)
+
+    return partial(_call_with_arguments, bind, method)
+
+
+def _call(method, topic, payload):
+    return method()
+
+
+def _call_wrapper(wrapper, method, topic, payload):
+    return wrapper(method)
+
+
+def _call_wrapper_with_arguments(bind, wrapper, method, topic, payload):
+    return wrapper(method, **bind(payload))
+
+
+def _call_with_arguments(bind, method, topic, payload):
+    return method(**bind(payload))
+
+
+def _call_with_port_arguments(bind, method, device_arguments, topic, payload):
+    # the parameters not forwarded to the port are used by the device only
+    arguments = bind(payload)
+    for argument in device_arguments:
+        del arguments[argument]
+    return method(**arguments)
@@ -0,0 +1,118 @@
+"""
+Replays the requests of a traffic log recorded with a TrafficRecorder and reports the responses diverging from the
+recorded ones, and the latencies
+
+By default the requests are sent to a dummy port device created with new_dab_0_1_device in this process, over a
+LoopbackBroker; with --broker they are sent to the devices connected to an MQTT broker instead.
+
+Usage: python3 dab_replay.py incident.dablog [--broker HOST:PORT] [--speed 1 | --max-speed] [--ignore-key timestamp]
+                             [--json report.json]
+"""
+
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import argparse
+import json
+import logging
+
+from dab_device import new_dab_0_1_device
+from dab_mqtt_client import DabMqttClient
+from dab_traffic import TrafficLog, TrafficReplayer
+from dummy_port.applications import Applications
+from dummy_port.system import System
+from dummy_port.telemetry import Telemetry
+from loopback_broker import LoopbackBroker
+from uuid import uuid4
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='traffic log to replay')
+    parser.add_argument('--broker', metavar='HOST:PORT',
+                        help='MQTT broker to connect to (default an in-process LoopbackBroker and dummy port device)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='pace of the replay relative to the recording (default 1, the original pace)')
+    parser.add_argument('--max-speed', action='store_true', help='replay as fast as the in-flight limit allows')
+    parser.add_argument('--max-in-flight', type=int, default=256,
+                        help='maximum number of requests awaiting a response (default 256)')
+    parser.add_argument('--timeout-s', type=float, default=5, help='response timeout in seconds (default 5)')
+    parser.add_argument('--ignore-key', action='append', default=[],
+                        help='top level response key left out of the comparison, can be repeated')
+    parser.add_argument('--json', metavar='FILE', help='write the report to this file')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    dab_device = None
+    if args.broker is None:
+        broker = LoopbackBroker()
+        host, port = 'localhost', 1883
+        dab_device = new_dab_0_1_device(client_id='DAB replay device',
+                                        applications=Applications(),
+                                        system=System(),
+                                        telemetry=Telemetry(),
+                                        device_info={"manufacturer": "Amazon, Netflix, Google",
+                                                     "model": "DAB Reference Implementation"},
+                                        handler_workers=4,
+                                        transport=broker.transport('DAB replay device'))
+        dab_device.connect(host=host, port=port)
+        transport = broker.transport('DAB replay client')
+    else:
+        host, _, port = args.broker.rpartition(':')
+        host, port = host or 'localhost', int(port)
+        transport = None
+
+    dab_mqtt_client = DabMqttClient(client_id='DAB replay client',
+                                    response_client_id=uuid4().hex,
+                                    transport=transport)
+    dab_mqtt_client.connect(host=host, port=port)
+
+    try:
+        replayer = TrafficReplayer(dab_mqtt_client,
+                                   speed=None if args.max_speed else args.speed,
+                                   max_in_flight=args.max_in_flight,
+                                   timeout_s=args.timeout_s,
+                                   ignore_keys=args.ignore_key)
+        with TrafficLog(args.log) as traffic_log:
+            report = replayer.replay(traffic_log)
+
+        latency_ms = report["latency_ms"]
+        print(f"{report['requests']} requests in {report['duration_s']:.2f}s, responses {report['responses']}, "
+              f"failures {report['failures']}, timeouts {report['timeouts']}, divergences {report['divergences']}")
+        if latency_ms["p50"] is not None:
+            print(f"  latency ms  p50 {latency_ms['p50']:.3f}  p90 {latency_ms['p90']:.3f}  "
+                  f"p99 {latency_ms['p99']:.3f}  max {latency_ms['max']:.3f}")
+        for topic, topic_report in sorted(report["topics"].items()):
+            print(f"  {topic}: {topic_report['requests']} requests, {topic_report['failures']} failures, "
+                  f"{topic_report['timeouts']} timeouts, {topic_report['divergences']} divergences")
+        for divergence in report["diverging_responses"]:
+            print(f"  diverging {divergence['topic']}: expected {divergence['expected']}, got {divergence['actual']}")
+
+        if args.json is not None:
+            with open(args.json, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+    finally:
+        dab_mqtt_client.disconnect()
+        if dab_device is not None:
+            dab_device.disconnect()
+
+
+if __name__ == '__main__':
+    main()
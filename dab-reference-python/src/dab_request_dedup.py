@@ -0,0 +1,100 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# outcomes of RequestDeduplicator.begin
+NEW_REQUEST = 0
+IN_PROGRESS = 1
+COMPLETED = 2
+
+
+class RequestDeduplicator:
+    """
+    Remembers the requests a device received, keyed by their topic, which ends with the request ID, so that a request
+    delivered twice, e.g. a QoS redelivery or a client sending it again, is only executed once
+
+    A duplicate of a request still being handled is dropped, the response of the first one answers both.
+    A duplicate of a handled request is answered with the stored response.
+    The requests are forgotten ttl_s seconds after they complete, or when more than max_entries are remembered.
+    """
+
+    def __init__(self, ttl_s=60, max_entries=1024):
+        """
+        :param ttl_s: (optional) how long, in seconds, the response of a request is replayed for (default 60 seconds)
+        :param max_entries: (optional) the maximum number of requests remembered (default 1024)
+        """
+        if ttl_s <= 0:
+            raise ValueError(f"The time to live must be positive. ttl_s={ttl_s}")
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        # request topic -> (encoded response or None while in progress, expiry), oldest expiry first
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, request_topic):
+        """
+        Records a request as it arrives. Returns (NEW_REQUEST, None) when the request must be handled,
+        (IN_PROGRESS, None) when it is a duplicate of a request being handled, or (COMPLETED, encoded response)
+        when it is a duplicate of a handled request
+        """
+        now = monotonic()
+        with self._lock:
+            while self._entries:
+                oldest_topic, (_, expires_at) = next(iter(self._entries.items()))
+                if expires_at > now:
+                    break
+                del self._entries[oldest_topic]
+
+            entry = self._entries.get(request_topic)
+            if entry is not None:
+                encoded_response = entry[0]
+                if encoded_response is None:
+                    return IN_PROGRESS, None
+                return COMPLETED, encoded_response
+
+            # a request in progress for longer than the time to live is handled again when it is delivered again
+            self._entries[request_topic] = (None, now + self.ttl_s)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return NEW_REQUEST, None
+
+    def complete(self, request_topic, encoded_response):
+        """
+        Stores the response of a request recorded with begin, to replay it to the duplicates
+        """
+        with self._lock:
+            if request_topic not in self._entries:
+                # forgotten while it was handled
+                return
+            self._entries[request_topic] = (encoded_response, monotonic() + self.ttl_s)
+            self._entries.move_to_end(request_topic)
+
+    def discard(self, request_topic):
+        """
+        Forgets a request recorded with begin, so that it is handled if it is delivered again, e.g. once rejected
+        """
+        with self._lock:
+            self._entries.pop(request_topic, None)
@@ -0,0 +1,235 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import heapq
+import itertools
+import logging
+
+from collections import deque
+from mqtt_topic_filter import mqtt_matches_filter
+from queue import SimpleQueue
+from threading import Lock, Thread
+
+# priority classes, the tasks of a lower class run first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class _Lane:
+    """Tasks sharing a concurrency limit"""
+
+    __slots__ = ('limit', 'running', 'pending')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.pending = deque()
+
+
+class RequestExecutor:
+    """
+    Runs request handlers on a pool of worker threads, so that a slow handler does not stall the MQTT network loop
+
+    Topics can be given a concurrency limit. The limit applies to all the handler topics matching the same topic
+    filter, e.g. {"dab/input/#": 1} runs the key presses one at a time, in the order they were received, while
+    the topics without a limit can use every worker.
+
+    Topics can also be given a priority class: waiting tasks run by class first, then in the order they were
+    submitted, e.g. {"dab/health-check/get": PRIORITY_HIGH} answers the health checks ahead of the queued launches.
+    The number of waiting tasks is bounded; once it is reached, new tasks are rejected instead of queued so that
+    the latency stays bounded under a burst of requests. A task of a higher class still gets in, displacing the
+    latest waiting task of the lowest class, which is rejected in its place.
+    """
+
+    def __init__(self, max_workers, concurrency_limits=None, priorities=None, max_queued=256):
+        """
+        :param max_workers: the number of worker threads
+        :param concurrency_limits: (optional) a dictionary of topic filters to the maximum number of handlers
+                                   running concurrently for the topics matching the filter
+        :param priorities: (optional) a dictionary of topic filters to the priority class of the topics matching the
+                           filter, PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW. The other topics are
+                           PRIORITY_NORMAL
+        :param max_queued: (optional) the maximum number of tasks waiting for a worker (default 256)
+        """
+        if max_workers < 1:
+            raise ValueError(f"At least one worker is required. max_workers={max_workers}")
+        if max_queued < 1:
+            raise ValueError(f"The queue must hold at least one task. max_queued={max_queued}")
+
+        self.logger = logging.getLogger('dab.request.executor')
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._lanes = {topic_filter: _Lane(limit) for topic_filter, limit in (concurrency_limits or {}).items()}
+        self._priorities = priorities or {}
+        self._routes_by_topic = {}
+        self._lock = Lock()
+        # (priority, sequence, lane, task, reject) of the tasks ready to run, the tasks held back by the concurrency
+        # limit of their lane wait in its pending deque with the same entries
+        self._ready = []
+        self._sequence = itertools.count()
+        # one token per task pushed to the ready heap, and one None per worker to stop
+        self._wakeups = SimpleQueue()
+        self._queued = 0
+        self._running = 0
+        self._rejected = 0
+        self._workers = []
+
+    def _route(self, topic):
+        try:
+            return self._routes_by_topic[topic]
+        except KeyError:
+            lane = next((lane for topic_filter, lane in self._lanes.items()
+                         if mqtt_matches_filter(topic, topic_filter)), None)
+            priority = next((priority for topic_filter, priority in self._priorities.items()
+                             if mqtt_matches_filter(topic, topic_filter)), PRIORITY_NORMAL)
+            self._routes_by_topic[topic] = lane, priority
+            return lane, priority
+
+    def start(self):
+        """
+        Starts the worker threads, unless they are already running
+        """
+        with self._lock:
+            if self._workers:
+                return
+            self._workers = [Thread(target=self._work, name=f"dab-request-worker-{i}", daemon=True)
+                             for i in range(self.max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the tasks already submitted are complete
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._wakeups.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def stats(self):
+        """
+        Returns the number of tasks waiting for a worker, the number of tasks running and the number of tasks
+        rejected so far
+        """
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "running": self._running,
+                "rejected": self._rejected,
+            }
+
+    def submit(self, topic, task, reject=None):
+        """
+        Schedules the task, a function with no parameters, for execution on a worker thread.
+        Returns False, without scheduling it, when max_queued tasks are already waiting and none of them is
+        of a lower priority class
+
+        :param topic: the DAB topic of the handler, used to find its concurrency limit and its priority class
+        :param task: the function to run
+        :param reject: (optional) a function with no parameters called instead of the task if it is displaced
+                       from the queue by a task of a higher priority class
+        """
+        lane, priority = self._route(topic)
+        displaced = None
+        with self._lock:
+            if self._queued >= self.max_queued:
+                displaced = self._displace(priority)
+                if displaced is None:
+                    self._rejected += 1
+                    return False
+
+            self._queued += 1
+            entry = (priority, next(self._sequence), lane, task, reject)
+            if lane is not None and lane.running >= lane.limit:
+                lane.pending.append(entry)
+            else:
+                if lane is not None:
+                    lane.running += 1
+                heapq.heappush(self._ready, entry)
+                self._wakeups.put(True)
+
+        if displaced is not None:
+            self._reject(displaced)
+        return True
+
+    def _displace(self, priority):
+        # called with the lock held: removes the latest waiting task of the lowest class below priority, whether it
+        # is ready to run or held back in the pending deque of its lane
+        displaced = None
+        for entry in itertools.chain(self._ready, *(lane.pending for lane in self._lanes.values())):
+            if entry[0] > priority and (displaced is None or entry[:2] > displaced[:2]):
+                displaced = entry
+        if displaced is None:
+            return None
+
+        _, _, lane, _, reject = displaced
+        if lane is not None and displaced in lane.pending:
+            lane.pending.remove(displaced)
+        else:
+            self._ready.remove(displaced)
+            heapq.heapify(self._ready)
+            if lane is not None:
+                self._release(lane)
+        self._queued -= 1
+        self._rejected += 1
+        return reject
+
+    def _reject(self, reject):
+        if reject is None:
+            return
+        try:
+            reject()
+        except Exception:
+            self.logger.exception("Request rejection failed")
+
+    def _release(self, lane):
+        # called with the lock held
+        if not lane.pending:
+            lane.running -= 1
+            return
+        heapq.heappush(self._ready, lane.pending.popleft())
+        self._wakeups.put(True)
+
+    def _work(self):
+        while True:
+            if self._wakeups.get() is None:
+                return
+
+            with self._lock:
+                if not self._ready:
+                    # the task of this token was displaced
+                    continue
+                _, _, lane, task, _ = heapq.heappop(self._ready)
+                self._queued -= 1
+                self._running += 1
+
+            try:
+                task()
+            except Exception:
+                self.logger.exception("Request handler task failed")
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    if lane is not None:
+                        self._release(lane)
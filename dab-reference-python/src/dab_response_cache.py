@@ -0,0 +1,130 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import json
+
+import dab_topics as topics
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# time to live, in seconds, of the responses of the idempotent DAB reads. The state of an application also changes
+# without a request of the client, e.g. when it crashes, hence its short time to live
+DEFAULT_TTLS = {
+    topics.APPLICATIONS_LIST_TOPIC: 30,
+    topics.APPLICATIONS_GET_STATE_TOPIC: 2,
+    topics.SYSTEM_LANGUAGE_LIST_TOPIC: 300,
+    topics.SYSTEM_LANGUAGE_GET_TOPIC: 30,
+}
+
+# the cached topics whose responses a successful request on the key topic makes stale, None meaning all of them
+DEFAULT_INVALIDATIONS = {
+    topics.APPLICATIONS_LAUNCH_TOPIC: [topics.APPLICATIONS_GET_STATE_TOPIC],
+    topics.APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC: [topics.APPLICATIONS_GET_STATE_TOPIC],
+    topics.APPLICATIONS_EXIT_TOPIC: [topics.APPLICATIONS_GET_STATE_TOPIC],
+    topics.SYSTEM_LANGUAGE_SET_TOPIC: [topics.SYSTEM_LANGUAGE_GET_TOPIC],
+    topics.SYSTEM_RESTART_TOPIC: None,
+}
+
+
+class ResponseCache:
+    """
+    A least recently used cache of DAB responses, with a time to live per topic
+
+    Only the successful responses of the topics with a time to live are kept, one entry per topic and request payload.
+    The cached responses are shared between the callers and must be treated as read-only.
+    """
+
+    def __init__(self, ttls=None, invalidations=None, max_entries=256):
+        """
+        :param ttls: (optional) a dictionary of DAB topics to the time to live of their responses, in seconds.
+                     Defaults to DEFAULT_TTLS
+        :param invalidations: (optional) a dictionary of DAB topics to the list of cached topics a request
+                              on the topic makes stale, None meaning all of them. Defaults to DEFAULT_INVALIDATIONS
+        :param max_entries: (optional) the maximum number of responses kept (default 256)
+        """
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.invalidations = DEFAULT_INVALIDATIONS if invalidations is None else invalidations
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(topic, payload):
+        return topic, json.dumps(payload, sort_keys=True)
+
+    def get(self, topic, payload):
+        """
+        Returns the cached response of the request, None if it is missing or expired
+        """
+        key = self._key(topic, payload)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, topic, payload, response, ttl_s=None):
+        """
+        Caches the response of the request, if it is successful and its topic has a time to live
+
+        :param ttl_s: (optional) overrides the time to live of the topic, e.g. float('inf') for retained messages
+        """
+        if ttl_s is None:
+            ttl_s = self.ttls.get(topic)
+        if ttl_s is None or not isinstance(response, dict) or response.get("status", 200) != 200:
+            return
+
+        key = self._key(topic, payload)
+        with self._lock:
+            self._entries[key] = (response, monotonic() + ttl_s)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, topic=None):
+        """
+        Drops the cached responses of a topic, or all of them when topic is None
+        """
+        with self._lock:
+            if topic is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == topic]:
+                del self._entries[key]
+
+    def invalidate_for_request(self, topic):
+        """
+        Drops the cached responses made stale by a request on the topic
+        """
+        if topic not in self.invalidations:
+            return
+        stale_topics = self.invalidations[topic]
+        if stale_topics is None:
+            self.invalidate()
+            return
+        for stale_topic in stale_topics:
+            self.invalidate(stale_topic)
@@ -0,0 +1,362 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import inspect
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from dab_client import DabClient
+from dab_metrics import percentile
+from dab_mqtt_client import DabMqttException, DabMqttTimeoutException
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from uuid import uuid4
+
+try:
+    import yaml
+except ImportError:
+    # scenarios can still be written in JSON
+    yaml = None
+
+# DabClient operations answered by a retained message rather than by a request
+RETAINED_OPERATIONS = frozenset(('device_info', 'dab_version'))
+# the DabClient operations a step can run, which return a response: not batch nor the subscription of watch_app_states
+OPERATIONS = frozenset(name for name, _ in inspect.getmembers(DabClient, inspect.isfunction)
+                       if not name.startswith('_') and name not in ('batch', 'watch_app_states'))
+
+
+class ScenarioStep:
+    """
+    A DabClient operation of a scenario, or a pause when the operation is None
+    """
+
+    __slots__ = ('name', 'operation', 'args', 'timeout_s', 'retries', 'retry_delay_ms', 'expect',
+                 'continue_on_failure', 'sleep_ms')
+
+    def __init__(self, name, operation=None, args=None, timeout_s=5, retries=0, retry_delay_ms=0, expect=None,
+                 continue_on_failure=False, sleep_ms=0):
+        self.name = name
+        self.operation = operation
+        self.args = args or {}
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.retry_delay_ms = retry_delay_ms
+        self.expect = expect
+        self.continue_on_failure = continue_on_failure
+        self.sleep_ms = sleep_ms
+
+
+class Scenario:
+    """
+    A named list of steps run in order against a device. Build it with load_scenario or Scenario.from_dict:
+
+        {
+          "name": "launch-and-exit",
+          "timeout_s": 5,
+          "retries": 1,
+          "steps": [
+            {"operation": "launch_app", "args": {"app_id": "Netflix"}, "timeout_s": 10},
+            {"sleep_ms": 500},
+            {"operation": "key_press", "args": {"key_code": "KEY_ENTER"}},
+            {"operation": "exit_app", "args": {"app_id": "Netflix"}, "expect": {"state": "STOPPED"}}
+          ]
+        }
+
+    A step passes when its response contains the expected top level values, a 200 status by default for the
+    requests. A step failing after its retries ends the run, unless its continue_on_failure is set.
+    The timeout_s, retries and retry_delay_ms of the scenario are the defaults of its steps.
+
+    The runs of an exclusive scenario ("exclusive": true) on a device do not overlap, e.g. a scenario launching and
+    exiting applications, whose state its concurrent runs would change under each other.
+    """
+
+    def __init__(self, name, steps, exclusive=False):
+        self.name = name
+        self.steps = steps
+        self.exclusive = exclusive
+
+    @classmethod
+    def from_dict(cls, definition):
+        if not isinstance(definition, dict) or not isinstance(definition.get("steps"), list):
+            raise ValueError("A scenario is an object with a list of steps")
+
+        defaults = {
+            "timeout_s": definition.get("timeout_s", 5),
+            "retries": definition.get("retries", 0),
+            "retry_delay_ms": definition.get("retry_delay_ms", 0),
+        }
+        steps = [_parse_step(index, step, defaults) for index, step in enumerate(definition["steps"])]
+        return cls(definition.get("name", "scenario"), steps, exclusive=definition.get("exclusive", False))
+
+
+def _parse_step(index, step, defaults):
+    if not isinstance(step, dict):
+        raise ValueError(f"Step {index} is not an object")
+
+    if "sleep_ms" in step and "operation" not in step:
+        return ScenarioStep(step.get("name", "sleep"), sleep_ms=step["sleep_ms"])
+
+    operation = step.get("operation")
+    if operation not in OPERATIONS:
+        raise ValueError(
+            f"Step {index}: unsupported operation {operation}, choose among {', '.join(sorted(OPERATIONS))}")
+    args = step.get("args", {})
+    try:
+        inspect.signature(getattr(DabClient, operation)).bind(None, **args)
+    except TypeError as e:
+        raise ValueError(f"Step {index}: invalid arguments of {operation}: {e}")
+
+    expect = step.get("expect")
+    if expect is None and operation not in RETAINED_OPERATIONS:
+        expect = {"status": 200}
+    return ScenarioStep(step.get("name", operation),
+                        operation=operation,
+                        args=args,
+                        timeout_s=step.get("timeout_s", defaults["timeout_s"]),
+                        retries=step.get("retries", defaults["retries"]),
+                        retry_delay_ms=step.get("retry_delay_ms", defaults["retry_delay_ms"]),
+                        expect=expect or {},
+                        continue_on_failure=step.get("continue_on_failure", False))
+
+
+def load_scenario(path):
+    """
+    Loads a scenario from a JSON file, or from a YAML file (.yaml or .yml) when PyYAML is installed
+    """
+    with open(path) as scenario_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError(f"PyYAML is required to load {path}")
+            definition = yaml.safe_load(scenario_file)
+        else:
+            definition = json.load(scenario_file)
+    return Scenario.from_dict(definition)
+
+
+class _StepResults:
+    __slots__ = ('passed', 'failed', 'skipped', 'attempts', 'timeouts', 'latencies_ms')
+
+    def __init__(self):
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.attempts = 0
+        self.timeouts = 0
+        self.latencies_ms = []
+
+
+class _StepClient(DabClient):
+    """
+    A DabClient sending the request of a step with the timeout of the step and the request ID of its attempt
+    """
+
+    def __init__(self, dab_mqtt_client, topic_prefix, timeout_s, request_id):
+        super(_StepClient, self).__init__(dab_mqtt_client, topic_prefix)
+        self.timeout_s = timeout_s
+        self.request_id = request_id
+
+    def _request(self, topic, payload, timeout_s=5):
+        # the timeout of the step replaces the one of the operation
+        del timeout_s
+        return self.dab_mqtt_client.request(self._topic(topic), payload, self.timeout_s, self.request_id)
+
+
+class ScenarioRunner:
+    """
+    Runs scenarios concurrently on many DAB devices, over one shared DabMqttClient connection, and aggregates
+    the outcome of every step and the distribution of its latencies into a report
+
+    Each device runs one or more instances of the scenario; at most max_concurrency runs are in progress at a time,
+    each on its own thread, sending its steps one after the other. The instances of an exclusive scenario run one
+    after the other on a device.
+    """
+
+    def __init__(self, dab_mqtt_client, devices=None, max_concurrency=32, max_failures=50):
+        """
+        :param dab_mqtt_client: the connected DabMqttClient shared by all the runs. A client created with a
+                                response_client_id receives the responses of the devices through a single
+                                subscription, without a subscription per request
+        :param devices: (optional) a dictionary of device identifiers to topic prefixes, as a DabFleet takes.
+                        When None (default) the runs address the device serving the bare DAB topics
+        :param max_concurrency: (optional) the maximum number of runs in progress (default 32)
+        :param max_failures: (optional) the number of failed steps detailed in the report (default 50)
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1. max_concurrency={max_concurrency}")
+
+        self.logger = logging.getLogger('dab.scenario')
+        self.dab_mqtt_client = dab_mqtt_client
+        self.devices = dict(devices) if devices is not None else {"device": None}
+        self.max_concurrency = max_concurrency
+        self.max_failures = max_failures
+
+    def run(self, scenario, device_ids=None, instances=1):
+        """
+        Runs instances of the scenario on each device and returns the report: the number of runs passed and
+        failed and, per step, the outcomes, the attempts, the timeouts and the latency percentiles in milliseconds
+
+        :param scenario: a Scenario
+        :param device_ids: (optional) the devices to run the scenario on (default all the devices)
+        :param instances: (optional) the number of runs per device (default 1)
+        """
+        if device_ids is None:
+            device_ids = list(self.devices)
+
+        lock = Lock()
+        step_results = [_StepResults() for _ in scenario.steps]
+        failures = []
+        outcomes = {"passed": 0, "failed": 0}
+        device_locks = {device_id: Lock() for device_id in device_ids} if scenario.exclusive else None
+
+        def run_instance(device_id, instance):
+            if device_locks is None:
+                run_steps(device_id, instance)
+            else:
+                with device_locks[device_id]:
+                    run_steps(device_id, instance)
+
+        def run_steps(device_id, instance):
+            dab_client = DabClient(self.dab_mqtt_client, self.devices[device_id])
+            run_failed = False
+            stopped = False
+            for index, step in enumerate(scenario.steps):
+                if stopped:
+                    with lock:
+                        step_results[index].skipped += 1
+                    continue
+
+                error, attempts, timeouts, latencies_ms = self._run_step(dab_client, step)
+                with lock:
+                    results = step_results[index]
+                    results.attempts += attempts
+                    results.timeouts += timeouts
+                    results.latencies_ms.extend(latencies_ms)
+                    if error is None:
+                        results.passed += 1
+                    else:
+                        results.failed += 1
+                        if len(failures) < self.max_failures:
+                            failures.append({"device_id": device_id, "instance": instance,
+                                             "step": index, "name": step.name, "error": error})
+                if error is not None:
+                    self.logger.info("Step %s of %s failed on %s: %s", step.name, scenario.name, device_id, error)
+                    run_failed = True
+                    stopped = not step.continue_on_failure
+            with lock:
+                outcomes["failed" if run_failed else "passed"] += 1
+
+        self.logger.info("Running %s on %d devices, %d instances each", scenario.name, len(device_ids), instances)
+        started = monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='dab-scenario') as executor:
+            # the first instances of every device first, which keeps the runs of an exclusive scenario waiting for
+            # their device from holding the threads
+            runs = [executor.submit(run_instance, device_id, instance)
+                    for instance in range(instances) for device_id in device_ids]
+            for run in runs:
+                run.result()
+        duration_s = monotonic() - started
+
+        return self._report(scenario, step_results, outcomes, failures, len(device_ids), instances, duration_s)
+
+    def _run_step(self, dab_client, step):
+        """
+        Runs a step with its retries and returns (error or None, attempts, timeouts, latencies in milliseconds)
+        """
+        if step.operation is None:
+            sleep(step.sleep_ms / 1000)
+            return None, 0, 0, []
+
+        attempts = 0
+        timeouts = 0
+        latencies_ms = []
+        error = None
+        request_id = None
+        while attempts <= step.retries:
+            if attempts > 0 and step.retry_delay_ms:
+                sleep(step.retry_delay_ms / 1000)
+            attempts += 1
+            # the retry of a request without a response is sent with the same request ID, so that a device which
+            # received it answers with the response of the first attempt rather than executing it twice
+            if request_id is None:
+                request_id = str(uuid4())
+            started = perf_counter()
+            try:
+                response = self._call(dab_client, step, request_id)
+            except DabMqttTimeoutException as e:
+                timeouts += 1
+                error = e.message
+                continue
+            except DabMqttException as e:
+                error = e.message
+                continue
+            except Exception as e:
+                # a failure of the client rather than of the device, which a retry would not fix
+                self.logger.exception("Step %s failed", step.name)
+                return f"{type(e).__name__}: {e}", attempts, timeouts, latencies_ms
+            request_id = None
+            latencies_ms.append((perf_counter() - started) * 1000)
+
+            if not isinstance(response, dict):
+                error = f"Unexpected response {response}"
+                continue
+            mismatches = {key: response.get(key) for key, value in step.expect.items() if response.get(key) != value}
+            if not mismatches:
+                return None, attempts, timeouts, latencies_ms
+            error = f"Unexpected {mismatches}, expected {step.expect}"
+        return error, attempts, timeouts, latencies_ms
+
+    def _call(self, dab_client, step, request_id):
+        if step.operation in RETAINED_OPERATIONS:
+            return getattr(dab_client, step.operation)(timeout_s=step.timeout_s, **step.args)
+
+        step_client = _StepClient(self.dab_mqtt_client, dab_client.topic_prefix, step.timeout_s, request_id)
+        return getattr(step_client, step.operation)(**step.args)
+
+    def _report(self, scenario, step_results, outcomes, failures, device_count, instances, duration_s):
+        steps = []
+        for index, (step, results) in enumerate(zip(scenario.steps, step_results)):
+            latencies_ms = sorted(results.latencies_ms)
+            steps.append({
+                "index": index,
+                "name": step.name,
+                "passed": results.passed,
+                "failed": results.failed,
+                "skipped": results.skipped,
+                "attempts": results.attempts,
+                "timeouts": results.timeouts,
+                "latency_ms": {
+                    "p50": percentile(latencies_ms, 50),
+                    "p90": percentile(latencies_ms, 90),
+                    "p99": percentile(latencies_ms, 99),
+                    "max": latencies_ms[-1] if latencies_ms else None,
+                },
+            })
+        return {
+            "scenario": scenario.name,
+            "devices": device_count,
+            "instances": instances,
+            "exclusive": scenario.exclusive,
+            "runs": device_count * instances,
+            "passed": outcomes["passed"],
+            "failed": outcomes["failed"],
+            "duration_s": duration_s,
+            "steps": steps,
+            "failures": failures,
+        }
@@ -17,11 +17,42 @@ __license__ = """
     limitations under the License.
 """
 
+import logging
+import sys
+
 from dab_client import DabClient
 from dab_mqtt_client import DabMqttClient
 
+logging.basicConfig(
+    format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    level=logging.DEBUG,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
 if __name__ == '__main__':
-    dab_mqtt_client = DabMqttClient(client_id="DAB Test Client")
+    transport = None
+    dab_device = None
+
+    if '--in-process' in sys.argv[1:]:
+        # runs the dummy port device in this process, with no broker nor socket involved
+        from dab_device import new_dab_0_1_device
+        from dummy_port.applications import Applications
+        from dummy_port.system import System
+        from dummy_port.telemetry import Telemetry
+        from loopback_broker import LoopbackBroker
+
+        broker = LoopbackBroker()
+        dab_device = new_dab_0_1_device(client_id='DAB reference implementation',
+                                        applications=Applications(),
+                                        system=System(),
+                                        telemetry=Telemetry(),
+                                        device_info={"manufacturer": "Amazon, Netflix, Google",
+                                                     "model": "DAB Reference Implementation"},
+                                        transport=broker.transport('DAB reference implementation'))
+        dab_device.connect(host='localhost', port=1883)
+        transport = broker.transport("DAB Test Client")
+
+    dab_mqtt_client = DabMqttClient(client_id="DAB Test Client", transport=transport)
     try:
 
         dab_mqtt_client.connect('localhost', 1883)
@@ -35,8 +66,10 @@ if __name__ == '__main__':
         for app in apps:
             dab_client.launch_app(app_id=app['appId'])
             dab_client.key_press(key_code='KEY_ENTER')
-            dab_client.exit_app(app_id=app, force=True)
+            dab_client.exit_app(app_id=app['appId'], force=True)
 
     finally:
         if dab_mqtt_client.is_connected():
             dab_mqtt_client.disconnect()
+        if dab_device is not None and dab_device.is_connected():
+            dab_device.disconnect()
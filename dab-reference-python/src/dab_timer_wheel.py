@@ -0,0 +1,155 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import logging
+
+from math import ceil
+from threading import Condition, Thread
+from time import monotonic
+
+
+class Timer:
+    """
+    A callback scheduled on a TimerWheel, created with TimerWheel.schedule
+    """
+
+    __slots__ = ('wheel', 'callback', 'slot', 'rounds')
+
+    def __init__(self, wheel, callback, slot, rounds):
+        self.wheel = wheel
+        self.callback = callback
+        self.slot = slot
+        self.rounds = rounds
+
+    def cancel(self):
+        """
+        Cancels the timer, unless it has already fired. Returns True if it was cancelled
+        """
+        return self.wheel.cancel(self)
+
+
+class TimerWheel:
+    """
+    Runs callbacks after a delay, from a single thread, for any number of timers
+
+    The timers are hashed into a ring of slots by the tick they expire in; every tick, the thread visits one slot and
+    fires its timers whose rounds are over. Scheduling and cancelling a timer are O(1), so thousands of outstanding
+    requests cost neither a thread nor a heap operation each. The timers fire at the resolution of a tick, never early.
+    """
+
+    def __init__(self, tick_ms=10, slots=512):
+        """
+        :param tick_ms: (optional) the resolution of the timers, in milliseconds (default 10 milliseconds)
+        :param slots: (optional) the number of slots of the ring; delays longer than slots ticks take more than one
+                      round (default 512)
+        """
+        if tick_ms <= 0 or slots < 1:
+            raise ValueError(f"The tick and the number of slots must be positive. tick_ms={tick_ms}, slots={slots}")
+
+        self.logger = logging.getLogger('dab.timer.wheel')
+        self.tick_s = tick_ms / 1000
+        self._slots = [set() for _ in range(slots)]
+        self._condition = Condition()
+        self._origin = monotonic()
+        # the last tick visited by the thread
+        self._tick = 0
+        self._count = 0
+        self._thread = None
+        # the thread keeps ticking for a while once it has no timers, rather than being woken up for every new one
+        self._idle_ticks = max(1, int(1 / self.tick_s))
+        self._sleeping = False
+
+    def __len__(self):
+        return self._count
+
+    def _current_tick(self):
+        return int((monotonic() - self._origin) / self.tick_s)
+
+    def schedule(self, delay_s, callback):
+        """
+        Calls the callback, a function with no parameters, from the timer thread once delay_s seconds have elapsed.
+        Returns a Timer to cancel it
+        """
+        ticks = max(1, ceil(delay_s / self.tick_s))
+        with self._condition:
+            if self._count == 0:
+                # the thread does not visit the slots when there are no timers
+                self._tick = self._current_tick()
+            expires = self._current_tick() + ticks
+            slot = expires % len(self._slots)
+            timer = Timer(self, callback, slot, (expires - self._tick - 1) // len(self._slots))
+            self._slots[slot].add(timer)
+            self._count += 1
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='dab-timer-wheel', daemon=True)
+                self._thread.start()
+            elif self._sleeping:
+                self._sleeping = False
+                self._condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        with self._condition:
+            timers = self._slots[timer.slot]
+            if timer not in timers:
+                return False
+            timers.remove(timer)
+            self._count -= 1
+            return True
+
+    def _due_timers(self):
+        with self._condition:
+            idle_since = self._tick
+            while True:
+                if self._count == 0 and self._tick - idle_since >= self._idle_ticks:
+                    self._sleeping = True
+                    self._condition.wait()
+                    idle_since = self._tick
+                    continue
+
+                tick = self._current_tick()
+                if tick <= self._tick:
+                    self._condition.wait(timeout=(self._tick + 1) * self.tick_s - (monotonic() - self._origin))
+                    continue
+
+                due = []
+                while self._tick < tick:
+                    self._tick += 1
+                    timers = self._slots[self._tick % len(self._slots)]
+                    for timer in list(timers):
+                        if timer.rounds > 0:
+                            timer.rounds -= 1
+                        else:
+                            timers.remove(timer)
+                            due.append(timer)
+                self._count -= len(due)
+                if due:
+                    return due
+                if self._count > 0:
+                    idle_since = self._tick
+
+    def _run(self):
+        while True:
+            for timer in self._due_timers():
+                try:
+                    timer.callback()
+                except Exception:
+                    self.logger.exception("Timer callback failed")
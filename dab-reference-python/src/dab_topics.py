@@ -22,6 +22,8 @@ APPLICATIONS_LAUNCH_TOPIC = "dab/applications/launch"
 APPLICATIONS_LAUNCH_WITH_CONTENT_TOPIC = "dab/applications/launch-with-content"
 APPLICATIONS_EXIT_TOPIC = "dab/applications/exit"
 APPLICATIONS_GET_STATE_TOPIC = "dab/applications/get-state"
+# retained state of each application, published under <topic>/<appId> as it changes
+APPLICATIONS_STATE_TOPIC = "dab/applications/state"
 
 SYSTEM_RESTART_TOPIC = "dab/system/restart"
 SYSTEM_LANGUAGE_LIST_TOPIC = "dab/system/language/list"
@@ -30,12 +32,18 @@ SYSTEM_LANGUAGE_SET_TOPIC = "dab/system/language/set"
 
 DEVICE_TELEMETRY_START_TOPIC = "dab/device-telemetry/start"
 DEVICE_TELEMETRY_STOP_TOPIC = "dab/device-telemetry/stop"
+DEVICE_TELEMETRY_METRICS_TOPIC = "dab/device-telemetry/metrics"
 
 APPLICATION_TELEMETRY_START_TOPIC = "dab/app-telemetry/start"
 APPLICATION_TELEMETRY_STOP_TOPIC = "dab/app-telemetry/stop"
+# followed by /<appId>
+APPLICATION_TELEMETRY_METRICS_TOPIC = "dab/app-telemetry/metrics"
 
 INPUT_KEY_PRESS_TOPIC = "dab/input/key-press"
 INPUT_LONG_KEY_PRESS_TOPIC = "dab/input/long-key-press"
+INPUT_KEY_SEQUENCE_TOPIC = "dab/input/key-sequence"
+# followed by /<progressId>
+INPUT_KEY_SEQUENCE_PROGRESS_TOPIC = "dab/input/key-sequence-progress"
 
 HEALTH_CHECK_TOPIC = "dab/health-check/get"
 
@@ -0,0 +1,350 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import logging
+import mmap
+import struct
+
+from dab_compression import COMPRESSION_KEY, inflate
+from dab_metrics import percentile
+from dab_mqtt_client import RESPONSE_CLIENT_KEY, RESPONSE_TOPIC_PREFIX, TIMEOUT_KEY
+from threading import BoundedSemaphore, Event, Lock
+from time import monotonic, perf_counter, sleep, time
+
+# a traffic log starts with the magic and the time of its first record, in seconds since the epoch
+LOG_MAGIC = b'DABTRAF1'
+_LOG_HEADER = struct.Struct('<8sd')
+# every record: offset in seconds from the start of the log, direction, topic length, payload length
+_RECORD_HEADER = struct.Struct('<dBHI')
+# how long the replay awaits its last requests beyond their timeout, in seconds
+_WAIT_GRACE_S = 1
+
+
+class TrafficRecorder:
+    """
+    Appends the messages of a DabMqttClient to a binary traffic log, as the tap of the client:
+
+        recorder = TrafficRecorder("incident.dablog")
+        dab_mqtt_client = DabMqttClient(..., tap=recorder.record)
+
+    Every record is a fixed-size header with the time, the direction and the lengths of the topic and of the payload,
+    followed by the topic and the raw payload, so that recording costs a single buffered write per message.
+    Recording to an existing log appends to it.
+    """
+
+    def __init__(self, path, buffer_size=65536):
+        """
+        :param path: the path of the traffic log
+        :param buffer_size: (optional) the number of bytes buffered before they are written to the file
+        """
+        self.path = path
+        self._lock = Lock()
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            start_time = time()
+            self._file.write(_LOG_HEADER.pack(LOG_MAGIC, start_time))
+        else:
+            with open(path, 'rb') as log:
+                start_time = _read_header(log.read(_LOG_HEADER.size))
+        self._origin = monotonic() - (time() - start_time)
+
+    def record(self, direction, topic, payload):
+        """
+        Appends a message to the log, messages tapped after the recorder is closed are not recorded
+
+        :param direction: TAP_INBOUND or TAP_OUTBOUND
+        :param topic: the topic of the message
+        :param payload: the serialized payload, bytes or str
+        """
+        encoded_topic = topic.encode('utf-8')
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        header = _RECORD_HEADER.pack(monotonic() - self._origin, direction, len(encoded_topic), len(payload))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(header + encoded_topic + payload)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_header(header):
+    if len(header) < _LOG_HEADER.size:
+        raise ValueError("Not a DAB traffic log: the file is too short")
+    magic, start_time = _LOG_HEADER.unpack(header)
+    if magic != LOG_MAGIC:
+        raise ValueError(f"Not a DAB traffic log: unexpected magic {magic!r}")
+    return start_time
+
+
+class TrafficRecord:
+    """
+    A message of a traffic log. The payload is a memoryview of the mapped log, the log stays mapped while it is
+    referenced
+    """
+
+    __slots__ = ('offset_s', 'direction', 'topic', 'payload')
+
+    def __init__(self, offset_s, direction, topic, payload):
+        self.offset_s = offset_s
+        self.direction = direction
+        self.topic = topic
+        self.payload = payload
+
+
+class TrafficLog:
+    """
+    Reads a traffic log written by a TrafficRecorder, memory-mapped so that the payloads are not copied.
+    A record truncated by a crash of the recorder ends the log
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as log:
+            self.start_time = _read_header(log.read(_LOG_HEADER.size))
+            self._mmap = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def __iter__(self):
+        view = self._view
+        position = _LOG_HEADER.size
+        while position + _RECORD_HEADER.size <= len(view):
+            offset_s, direction, topic_length, payload_length = _RECORD_HEADER.unpack_from(view, position)
+            position += _RECORD_HEADER.size
+            end = position + topic_length + payload_length
+            if end > len(view):
+                return
+            topic = str(view[position:position + topic_length], 'utf-8')
+            yield TrafficRecord(offset_s, direction, topic, view[position + topic_length:end])
+            position = end
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # payloads of records still referenced keep the mapping alive, it is unmapped when they are collected
+            pass
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TrafficReplayer:
+    """
+    Sends the requests of a traffic log again through a DabMqttClient, e.g. to a new build of a device, and compares
+    the responses with the recorded ones
+
+    The requests replayed are the messages of the log answered by a recorded response, whether the log was recorded
+    by the client, the device or both. They are sent with their recorded payload, under new request IDs, at the pace
+    they were recorded, scaled by the speed, or as fast as the in-flight limit allows.
+    """
+
+    def __init__(self, dab_mqtt_client, speed=1.0, max_in_flight=256, timeout_s=5, ignore_keys=(),
+                 max_divergences=20):
+        """
+        :param dab_mqtt_client: the connected DabMqttClient the requests are sent through
+        :param speed: (optional) the pace of the replay relative to the recording, e.g. 2 replays twice as fast.
+                      None replays at the maximum speed (default 1, the original pace)
+        :param max_in_flight: (optional) the maximum number of requests awaiting a response (default 256)
+        :param timeout_s: (optional) how long a response is awaited, in seconds (default 5 seconds)
+        :param ignore_keys: (optional) top level keys of the responses left out of the comparison, e.g. timestamps
+        :param max_divergences: (optional) the number of diverging responses detailed in the report (default 20)
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError(f"The speed must be positive. speed={speed}")
+
+        self.logger = logging.getLogger('dab.traffic.replayer')
+        self.dab_mqtt_client = dab_mqtt_client
+        self.speed = speed
+        self.max_in_flight = max_in_flight
+        self.timeout_s = timeout_s
+        self.ignore_keys = frozenset(ignore_keys)
+        self.max_divergences = max_divergences
+
+    @staticmethod
+    def requests(traffic_log):
+        """
+        Returns the (offset in seconds, request topic, request payload, recorded response payload) of the answered
+        requests of a traffic log, in the order they were recorded
+        """
+        responses = {}
+        # a request recorded by both the client and the device is replayed once
+        candidates = {}
+        for record in traffic_log:
+            if record.topic.startswith(RESPONSE_TOPIC_PREFIX):
+                request_topic = record.topic[len(RESPONSE_TOPIC_PREFIX):]
+                responses.setdefault(request_topic, record.payload)
+                # the response may be published under the response client ID of the requester
+                responses.setdefault(request_topic.partition('/')[2], record.payload)
+            elif record.topic not in candidates:
+                candidates[record.topic] = record
+        return [(record.offset_s, topic, record.payload, responses[topic])
+                for topic, record in candidates.items() if topic in responses]
+
+    def _comparable(self, response):
+        if isinstance(response, dict) and self.ignore_keys:
+            return {key: value for key, value in response.items() if key not in self.ignore_keys}
+        return response
+
+    def replay(self, traffic_log):
+        """
+        Replays the answered requests of the traffic log and returns a report: the number of requests, responses,
+        failures (the requests that could not be sent), timeouts and divergences, the latency percentiles in
+        milliseconds and the first diverging responses
+        """
+        requests = self.requests(traffic_log)
+        codec = self.dab_mqtt_client.codec
+        self.logger.info("Replaying %d requests", len(requests))
+
+        slots = BoundedSemaphore(self.max_in_flight)
+        lock = Lock()
+        done = Event()
+        # index -> (message in flight, sent at) of the requests awaiting a response
+        pending = {}
+        # (response, latency in seconds) of the answered requests, None of the timed out ones
+        results = [None] * len(requests)
+        # index -> error of the requests that could not be sent
+        failures = {}
+        remaining = [len(requests)]
+
+        def complete():
+            slots.release()
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        def finish(index, response):
+            with lock:
+                entry = pending.pop(index, None)
+                if entry is None:
+                    return
+            message_in_flight, sent_at = entry
+            if response is not None:
+                results[index] = (response, perf_counter() - sent_at)
+            self.dab_mqtt_client.discard_request(message_in_flight)
+            complete()
+
+        if not requests:
+            done.set()
+
+        started = monotonic()
+        first_offset_s = requests[0][0] if requests else 0
+        for index, (offset_s, topic, payload, _) in enumerate(requests):
+            if self.speed is not None:
+                delay_s = started + (offset_s - first_offset_s) / self.speed - monotonic()
+                if delay_s > 0:
+                    sleep(delay_s)
+            slots.acquire()
+
+            try:
+                payload = codec.decode(inflate(bytes(payload)))
+                if isinstance(payload, dict):
+                    payload.pop(TIMEOUT_KEY, None)
+                    payload.pop(RESPONSE_CLIENT_KEY, None)
+                    # the replaying client only receives uncompressed responses
+                    payload.pop(COMPRESSION_KEY, None)
+                # the lock keeps the response from being handled before the request is pending
+                with lock:
+                    sent_at = perf_counter()
+                    message_in_flight = self.dab_mqtt_client.send_request(
+                        topic.rpartition('/')[0], payload,
+                        lambda response, index=index: finish(index, bytes(response)), self.timeout_s,
+                        on_timeout=lambda index=index: finish(index, None))
+                    pending[index] = (message_in_flight, sent_at)
+            except Exception as e:
+                self.logger.warning("Failed to replay the request %s: %s", topic, e)
+                failures[index] = str(e)
+                complete()
+
+        # every request sent times out after timeout_s, the grace covers a late timer
+        if not done.wait(self.timeout_s + _WAIT_GRACE_S):
+            with lock:
+                abandoned = list(pending.values())
+                pending.clear()
+            self.logger.warning("%d requests neither answered nor timed out, counted as timeouts", len(abandoned))
+            for message_in_flight, _ in abandoned:
+                self.dab_mqtt_client.discard_request(message_in_flight)
+        duration_s = monotonic() - started
+        return self._report(requests, results, failures, duration_s)
+
+    def _report(self, requests, results, failures, duration_s):
+        codec = self.dab_mqtt_client.codec
+        latencies_ms = []
+        timeouts = 0
+        divergences = []
+        divergence_count = 0
+        by_topic = {}
+        for index, ((_, topic, _, recorded_response), result) in enumerate(zip(requests, results)):
+            dab_topic = topic.rpartition('/')[0]
+            topic_report = by_topic.setdefault(dab_topic,
+                                               {"requests": 0, "failures": 0, "timeouts": 0, "divergences": 0})
+            topic_report["requests"] += 1
+            if index in failures:
+                topic_report["failures"] += 1
+                continue
+            if result is None:
+                timeouts += 1
+                topic_report["timeouts"] += 1
+                continue
+
+            response, latency_s = result
+            latencies_ms.append(latency_s * 1000)
+            expected = codec.decode(inflate(bytes(recorded_response)))
+            actual = codec.decode(response)
+            if self._comparable(expected) != self._comparable(actual):
+                divergence_count += 1
+                topic_report["divergences"] += 1
+                if len(divergences) < self.max_divergences:
+                    divergences.append({"topic": dab_topic, "expected": expected, "actual": actual})
+
+        latencies_ms.sort()
+        return {
+            "requests": len(requests),
+            "responses": len(latencies_ms),
+            "failures": len(failures),
+            "timeouts": timeouts,
+            "divergences": divergence_count,
+            "duration_s": duration_s,
+            "speed": self.speed,
+            "latency_ms": {
+                "p50": percentile(latencies_ms, 50),
+                "p90": percentile(latencies_ms, 90),
+                "p99": percentile(latencies_ms, 99),
+                "max": latencies_ms[-1] if latencies_ms else None,
+            },
+            "topics": by_topic,
+            "diverging_responses": divergences,
+        }
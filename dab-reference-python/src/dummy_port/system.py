@@ -65,6 +65,44 @@ class System:
             "status": 200
         }
 
+    def key_sequence(self, keys, delay_ms=0, stop_on_error=True, on_progress=None):
+        """
+        Presses the keys one after the other, waiting delay_ms, or the delayMs of the key, between two keys
+
+        :param keys: a list of dictionaries with a keyCode, and optionally a durationMs and a delayMs
+        :param on_progress: (optional) a function called with the result of each key
+        """
+        self.logger.info(f"request: input/key-sequence, keys={len(keys)}, delay_ms={delay_ms}")
+        results = []
+        for index, key in enumerate(keys):
+            delay = key.get("delayMs", delay_ms if index > 0 else 0)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+            if "durationMs" in key:
+                response = self.long_key_press(key_code=key["keyCode"], duration_ms=key["durationMs"])
+            else:
+                response = self.key_press(key_code=key["keyCode"])
+
+            result = {"keyCode": key["keyCode"], "status": response["status"]}
+            if "error" in response:
+                result["error"] = response["error"]
+            results.append(result)
+            if on_progress is not None:
+                on_progress(dict(result, index=index, total=len(keys)))
+
+            if response["status"] != 200 and stop_on_error:
+                return {
+                    "status": response["status"],
+                    "error": f"key {index} ({key['keyCode']}) failed",
+                    "results": results
+                }
+
+        return {
+            "status": 200,
+            "results": results
+        }
+
     def health_check(self):
         self.logger.info("request: health-check/get")
         return {
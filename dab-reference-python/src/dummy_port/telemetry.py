@@ -18,6 +18,8 @@ __license__ = """
 """
 
 import logging
+import random
+import time
 
 
 class Telemetry:
@@ -48,3 +50,24 @@ class Telemetry:
         return {
             'status': 200
         }
+
+    def device_metrics(self):
+        """
+        Returns a device telemetry sample, published at the frequency requested with device-telemetry/start
+        """
+        return {
+            "timestamp": int(time.time() * 1000),
+            "metric": "cpu",
+            "value": random.randint(0, 100)
+        }
+
+    def app_metrics(self, app_id):
+        """
+        Returns a telemetry sample of the application, published at the frequency requested with app-telemetry/start
+        """
+        return {
+            "timestamp": int(time.time() * 1000),
+            "metric": "memory",
+            "value": random.randint(100, 500),
+            "appId": app_id
+        }
@@ -0,0 +1,268 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import heapq
+import itertools
+import logging
+
+from functools import partial
+from mqtt_topic_filter import TopicRouter, TopicTree
+from queue import SimpleQueue
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+class LoopbackMessage:
+    """A message delivered by the LoopbackBroker, with the attributes of paho.mqtt.client.MQTTMessage"""
+
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid')
+
+    def __init__(self, topic, payload, qos, retain, mid):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+
+class LoopbackMessageInfo:
+    """The result of LoopbackTransport.publish, with the attributes of paho.mqtt.client.MQTTMessageInfo"""
+
+    __slots__ = ('rc', 'mid')
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+    def is_published(self):
+        return self.rc == MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout=None):
+        del timeout
+
+
+class _DelayLine:
+    """
+    Runs actions once their delay has elapsed, in the order they are due, from a single thread
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay_s, action):
+        with self._condition:
+            heapq.heappush(self._heap, (monotonic() + delay_s, next(self._sequence), action))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='dab-loopback-link', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > monotonic():
+                    self._condition.wait(self._heap[0][0] - monotonic() if self._heap else None)
+                now = monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+            for action in due:
+                action()
+
+
+class LoopbackBroker:
+    """
+    An in-process broker implementing the MQTT 3.1.1 message semantics, without any socket
+
+    It supports the + and # wildcards, retained messages and the QoS levels as flags: a message is delivered with
+    the lower of the publish and the subscription QoS, and is never lost nor duplicated, whatever its QoS.
+    A network link between the clients and the broker can be simulated with a latency, to measure the cost of the
+    QoS levels. A DabMqttClient is wired to the broker through a LoopbackTransport:
+
+        broker = LoopbackBroker()
+        device = new_dab_0_1_device(..., transport=broker.transport("device"))
+        client = DabMqttClient("client", transport=broker.transport("client"))
+    """
+
+    def __init__(self, link_latency_ms=0):
+        """
+        :param link_latency_ms: (optional) the one-way latency, in milliseconds, of the simulated link between each
+                                client and the broker. A message reaches the broker after one trip at QoS 0 and 1,
+                                and after three at QoS 2, as brokers release a QoS 2 message to the subscribers once
+                                the PUBLISH, PUBREC and PUBREL packets are exchanged; it then reaches each subscriber
+                                after one more trip. When 0 (default) the messages are delivered immediately
+        """
+        self.logger = logging.getLogger('dab.loopback.broker')
+        self.link_latency_s = link_latency_ms / 1000
+        self._link = _DelayLine() if link_latency_ms > 0 else None
+        self._lock = Lock()
+        self._subscriptions = TopicRouter()
+        # the retained messages, (payload, qos) by topic, indexed by level to serve the subscriptions of many devices
+        self._retained = TopicTree()
+        self._mids = itertools.count(1)
+
+    def transport(self, client_id):
+        """
+        Returns a new transport for a DabMqttClient, connected to this broker
+        """
+        return LoopbackTransport(self, client_id)
+
+    def next_mid(self):
+        return next(self._mids)
+
+    def subscribe(self, transport, topic_filter, qos):
+        with self._lock:
+            if topic_filter not in transport.subscriptions:
+                self._subscriptions.add(topic_filter, (transport, topic_filter))
+            transport.subscriptions[topic_filter] = qos
+            retained = self._retained.match(topic_filter)
+
+        for topic, (payload, retained_qos) in retained:
+            self._deliver(transport, LoopbackMessage(topic, payload, min(qos, retained_qos), True, self.next_mid()))
+
+    def _deliver(self, transport, message):
+        if self._link is None:
+            transport.deliver(message)
+        else:
+            self._link.call_later(self.link_latency_s, partial(transport.deliver, message))
+
+    def unsubscribe(self, transport, topic_filter):
+        with self._lock:
+            if transport.subscriptions.pop(topic_filter, None) is not None:
+                self._subscriptions.remove(topic_filter, (transport, topic_filter))
+
+    def unsubscribe_all(self, transport):
+        with self._lock:
+            for topic_filter in transport.subscriptions:
+                self._subscriptions.remove(topic_filter, (transport, topic_filter))
+            transport.subscriptions.clear()
+
+    def publish(self, topic, payload, qos, retain):
+        if self._link is None:
+            self._route(topic, payload, qos, retain)
+        else:
+            self._link.call_later(self.link_latency_s * (3 if qos == 2 else 1),
+                                  partial(self._route, topic, payload, qos, retain))
+
+    def _route(self, topic, payload, qos, retain):
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained.put(topic, (payload, qos))
+                else:
+                    self._retained.pop(topic, None)
+
+            # a client with overlapping subscriptions receives a single copy, with the highest subscription QoS
+            granted = {}
+            for transport, topic_filter in self._subscriptions.match(topic):
+                granted[transport] = max(granted.get(transport, 0), transport.subscriptions[topic_filter])
+
+        for transport, subscription_qos in granted.items():
+            message = LoopbackMessage(topic, payload, min(qos, subscription_qos), False, self.next_mid())
+            self._deliver(transport, message)
+
+
+class LoopbackTransport:
+    """
+    A DabMqttClient transport connected to a LoopbackBroker
+
+    It offers the subset of the paho.mqtt.client.Client interface used by the DabMqttClient. As with paho,
+    the callbacks run on the thread calling loop_forever, and the other methods can be called from any thread.
+    """
+
+    _DISCONNECT = object()
+
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.subscriptions = {}
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self._inbox = SimpleQueue()
+        self._connected = Event()
+
+    def connect(self, host=None, port=None):
+        """
+        Connects to the broker. The host and port are ignored, the broker lives in this process
+        """
+        del host, port
+        self._connected.set()
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, MQTT_ERR_SUCCESS)
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        self._inbox.put(self._DISCONNECT)
+        return MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def loop_forever(self):
+        """
+        Delivers the incoming messages to the on_message callback until the transport disconnects
+        """
+        while True:
+            message = self._inbox.get()
+            if message is self._DISCONNECT:
+                break
+            if self.on_message is not None:
+                self.on_message(self, None, message)
+
+        self._connected.clear()
+        self.broker.unsubscribe_all(self)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, MQTT_ERR_SUCCESS)
+
+    def deliver(self, message):
+        self._inbox.put(message)
+
+    def subscribe(self, topic, qos=0):
+        if not self.is_connected():
+            return MQTT_ERR_NO_CONN, None
+        self.broker.subscribe(self, topic, qos)
+        return MQTT_ERR_SUCCESS, self.broker.next_mid()
+
+    def unsubscribe(self, topic):
+        if not self.is_connected():
+            return MQTT_ERR_NO_CONN, None
+        self.broker.unsubscribe(self, topic)
+        return MQTT_ERR_SUCCESS, self.broker.next_mid()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.is_connected():
+            return LoopbackMessageInfo(MQTT_ERR_NO_CONN, None)
+
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode('ascii')
+
+        self.broker.publish(topic, payload, qos, retain)
+        return LoopbackMessageInfo(MQTT_ERR_SUCCESS, self.broker.next_mid())
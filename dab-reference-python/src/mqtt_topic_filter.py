@@ -49,3 +49,250 @@ def mqtt_matches_filter(topic, topic_filter):
             return False
 
     return len(topic_parts) == len(topic_filter_parts)
+
+
+def is_topic_level(level):
+    """
+    Returns True when level is a non-empty string usable as a single level of a topic: no / separator and no wildcard
+    """
+    return isinstance(level, str) and level != '' and '/' not in level and '+' not in level and '#' not in level
+
+
+class _TopicNode:
+    """A single level of the TopicRouter trie"""
+
+    __slots__ = ('children', 'values', 'multi_level_values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+        self.multi_level_values = []
+
+
+class TopicRouter:
+    """
+    A compiled index of MQTT topic filters, organised as a trie with one node per topic level
+
+    Filters are added once, usually at construction time, and matching a topic costs a dictionary lookup
+    per topic level (times the number of + branches that are alive), independent of the number of filters.
+    The matching semantics are the same as the MQTT 3.1.1 protocol:
+
+    # (multi-level wildcard) matches any number of levels within a topic, including the parent level
+    + (single-level wildcard) matches only one topic level
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _validate_filter(topic_filter):
+        levels = topic_filter.split('/')
+        for i, level in enumerate(levels):
+            if level == '#' and i != len(levels) - 1:
+                raise ValueError(f"Multi-level wildcard must be the last level of the filter. Filter={topic_filter}")
+            if level not in ('+', '#') and ('+' in level or '#' in level):
+                raise ValueError(f"Wildcards must occupy an entire topic level. Filter={topic_filter}")
+        return levels
+
+    def add(self, topic_filter, value):
+        """
+        Registers a value under the topic filter. The same filter can hold multiple values
+
+        :param topic_filter: an MQTT topic filter, possibly containing + and # wildcards
+        :param value: an object that will be returned by match for every topic matching the filter
+        """
+        levels = self._validate_filter(topic_filter)
+
+        node = self._root
+        for level in levels:
+            if level == '#':
+                node.multi_level_values.append(value)
+                self._size += 1
+                return
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicNode()
+            node = child
+
+        node.values.append(value)
+        self._size += 1
+
+    def remove(self, topic_filter, value):
+        """
+        Unregisters a value previously added under the topic filter. Returns False if it was not registered
+        """
+        levels = self._validate_filter(topic_filter)
+
+        path = []
+        node = self._root
+        for level in levels:
+            if level == '#':
+                break
+            child = node.children.get(level)
+            if child is None:
+                return False
+            path.append((node, level))
+            node = child
+
+        values = node.multi_level_values if levels[-1] == '#' else node.values
+        try:
+            values.remove(value)
+        except ValueError:
+            return False
+        self._size -= 1
+
+        # prune the levels left without any values, so that short-lived filters do not accumulate
+        while path and not node.children and not node.values and not node.multi_level_values:
+            parent, level = path.pop()
+            del parent.children[level]
+            node = parent
+
+        return True
+
+    def match(self, topic):
+        """
+        Returns the list of values whose topic filters match the topic, in insertion order per filter
+        """
+        levels = topic.split('/')
+        matches = []
+        nodes = [self._root]
+
+        # topics starting with $ are reserved and are not matched by wildcards at the first level
+        wildcards_allowed = not topic.startswith('$')
+
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if wildcards_allowed:
+                    if node.multi_level_values:
+                        matches.extend(node.multi_level_values)
+                    child = node.children.get('+')
+                    if child is not None:
+                        next_nodes.append(child)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+
+            if not next_nodes:
+                return matches
+            nodes = next_nodes
+            wildcards_allowed = True
+
+        for node in nodes:
+            matches.extend(node.values)
+            matches.extend(node.multi_level_values)
+
+        return matches
+
+
+class _TopicTreeNode:
+    """A single level of the TopicTree trie"""
+
+    __slots__ = ('children', 'entry')
+
+    def __init__(self):
+        self.children = {}
+        # (topic, value) when a topic ends at this level
+        self.entry = None
+
+
+class TopicTree:
+    """
+    An index of MQTT topics to values, organised as a trie with one node per topic level, e.g. the retained messages
+    of a broker
+
+    Finding the topics matching a filter walks the levels of the filter, so its cost depends on the topics matching
+    rather than on the number of topics held. The matching semantics are those of TopicRouter.
+    """
+
+    def __init__(self):
+        self._root = _TopicTreeNode()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, topic, value):
+        """
+        Sets the value of a topic, replacing the previous one
+        """
+        node = self._root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TopicTreeNode()
+            node = child
+
+        if node.entry is None:
+            self._size += 1
+        node.entry = (topic, value)
+
+    def pop(self, topic, default=None):
+        """
+        Removes a topic and returns its value, or default when the topic is not held
+        """
+        path = []
+        node = self._root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                return default
+            path.append((node, level))
+            node = child
+
+        if node.entry is None:
+            return default
+        value = node.entry[1]
+        node.entry = None
+        self._size -= 1
+
+        # prune the levels left without any topic
+        while path and not node.children and node.entry is None:
+            parent, level = path.pop()
+            del parent.children[level]
+            node = parent
+
+        return value
+
+    def match(self, topic_filter):
+        """
+        Returns the list of (topic, value) of the topics matching the topic filter
+        """
+        levels = TopicRouter._validate_filter(topic_filter)
+        matches = []
+        nodes = [self._root]
+        for index, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if level == '#':
+                    # the multi-level wildcard matches the parent level too
+                    if node.entry is not None and index > 0:
+                        matches.append(node.entry)
+                    self._collect(node, index == 0, matches)
+                elif level == '+':
+                    # topics starting with $ are reserved and are not matched by wildcards at the first level
+                    next_nodes.extend(child for child_level, child in node.children.items()
+                                      if index > 0 or not child_level.startswith('$'))
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        next_nodes.append(child)
+            if not next_nodes:
+                return matches
+            nodes = next_nodes
+
+        matches.extend(node.entry for node in nodes if node.entry is not None)
+        return matches
+
+    @staticmethod
+    def _collect(node, first_level, matches):
+        stack = [child for level, child in node.children.items() if not first_level or not level.startswith('$')]
+        while stack:
+            node = stack.pop()
+            if node.entry is not None:
+                matches.append(node.entry)
+            stack.extend(node.children.values())
@@ -0,0 +1,66 @@
+"""
+Simulates many DAB devices, served under <topic prefix>/<device id>/dab/..., to load test a controller
+
+Usage: python3 run_dab_device_farm.py [--broker HOST:PORT] [--devices 1000] [--latency-ms 50] [--failure-rate 0.01]
+"""
+
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import argparse
+import logging
+
+from dab_device_farm import DabDeviceFarm
+
+logging.basicConfig(
+    format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--broker', metavar='HOST:PORT', default='localhost:1883',
+                        help='MQTT broker to connect to (default localhost:1883)')
+    parser.add_argument('--devices', type=int, default=1000, help='number of devices (default 1000)')
+    parser.add_argument('--topic-prefix', default='farm', help='topic prefix of the devices (default farm)')
+    parser.add_argument('--handler-workers', type=int, default=4,
+                        help='worker threads running the requests (default 4)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='response time of the devices (default 0)')
+    parser.add_argument('--jitter-ms', type=float, default=0,
+                        help='random time added to the response time (default 0)')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='probability of a request failing with the 500 status (default 0)')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='probability of a request never being answered (default 0)')
+    parser.add_argument('--seed', type=int, help='seed of the injected latencies and failures')
+    args = parser.parse_args()
+
+    host, _, port = args.broker.rpartition(':')
+    farm = DabDeviceFarm(count=args.devices,
+                         topic_prefix=args.topic_prefix,
+                         handler_workers=args.handler_workers,
+                         latency_ms=args.latency_ms,
+                         jitter_ms=args.jitter_ms,
+                         failure_rate=args.failure_rate,
+                         drop_rate=args.drop_rate,
+                         seed=args.seed)
+    farm.connect(host=host, port=int(port))
+    logging.getLogger('dab.device.farm').info("Serving %d devices under %s/+/dab", len(farm), args.topic_prefix)
+    farm.dab_mqtt_client.wait()
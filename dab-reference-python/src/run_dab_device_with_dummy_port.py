@@ -19,16 +19,25 @@ __license__ = """
     limitations under the License.
 """
 
+import logging
+
 from dummy_port.applications import Applications
 from dummy_port.system import System
 from dummy_port.telemetry import Telemetry
 
+logging.basicConfig(
+    format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    level=logging.DEBUG,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
 if __name__ == '__main__':
     dab_device = new_dab_0_1_device(client_id='DAB reference implementation',
                                     applications=Applications(),
                                     system=System(),
                                     telemetry=Telemetry(),
                                     device_info={"manufacturer": "Amazon, Netflix, Google",
-                                                 "model": "DAB Reference Implementation"})
+                                                 "model": "DAB Reference Implementation"},
+                                    handler_workers=4)
     dab_device.connect(host='localhost', port=1883)
     dab_device.wait()
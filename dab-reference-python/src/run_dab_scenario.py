@@ -0,0 +1,137 @@
+"""
+Runs a scenario of DAB operations concurrently on many devices and reports the outcome and the latencies of its steps
+
+Without --device, the scenario runs on a DabDeviceFarm started in this process; without --broker, over a
+LoopbackBroker.
+
+Usage: python3 run_dab_scenario.py scenarios/launch_apps.json [--broker HOST:PORT] [--device tv-1=lab/tv-1]
+                                   [--farm-devices 100] [--instances 1] [--max-concurrency 32] [--json report.json]
+"""
+
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import argparse
+import json
+import logging
+
+from dab_device_farm import DabDeviceFarm
+from dab_mqtt_client import DabMqttClient
+from dab_scenario import ScenarioRunner, load_scenario
+from loopback_broker import LoopbackBroker
+from uuid import uuid4
+
+logging.basicConfig(
+    format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    level=logging.WARNING,
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+
+def parse_device(device):
+    device_id, _, topic_prefix = device.partition('=')
+    return device_id, topic_prefix or None
+
+
+def print_report(report):
+    def ms(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    print(f"{report['scenario']}: {report['runs']} runs on {report['devices']} devices in {report['duration_s']:.2f}s, "
+          f"passed {report['passed']}, failed {report['failed']}")
+    for step in report["steps"]:
+        latency = step["latency_ms"]
+        print(f"  {step['index']:>3} {step['name']:<24} passed {step['passed']:>6}  failed {step['failed']:>6}  "
+              f"skipped {step['skipped']:>6}  attempts {step['attempts']:>6}  timeouts {step['timeouts']:>6}  "
+              f"p50 {ms(latency['p50'])}  p90 {ms(latency['p90'])}  p99 {ms(latency['p99'])}  max {ms(latency['max'])}")
+    for failure in report["failures"]:
+        print(f"  failed {failure['device_id']}#{failure['instance']} step {failure['step']} {failure['name']}: "
+              f"{failure['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', help='scenario file, JSON or YAML')
+    parser.add_argument('--broker', metavar='HOST:PORT',
+                        help='MQTT broker to connect to (default an in-process LoopbackBroker)')
+    parser.add_argument('--device', type=parse_device, action='append', metavar='ID=TOPIC_PREFIX',
+                        help='device to run the scenario on, can be repeated; an empty prefix addresses the bare '
+                             'DAB topics (default the devices of an in-process DabDeviceFarm)')
+    parser.add_argument('--farm-devices', type=int, default=100,
+                        help='number of devices of the in-process farm (default 100)')
+    parser.add_argument('--farm-latency-ms', type=float, default=0,
+                        help='response time of the devices of the farm (default 0)')
+    parser.add_argument('--farm-failure-rate', type=float, default=0,
+                        help='probability of a request to the farm failing with the 500 status (default 0)')
+    parser.add_argument('--instances', type=int, default=1,
+                        help='runs of the scenario per device, one after the other for an exclusive scenario '
+                             '(default 1)')
+    parser.add_argument('--max-concurrency', type=int, default=32,
+                        help='maximum number of runs in progress (default 32)')
+    parser.add_argument('--json', metavar='FILE', help='write the report to FILE')
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+
+    if args.broker is None:
+        broker = LoopbackBroker()
+        host, port = 'localhost', 1883
+
+        def transport(client_id):
+            return broker.transport(client_id)
+    else:
+        host, _, port = args.broker.rpartition(':')
+        host, port = host or 'localhost', int(port)
+
+        def transport(client_id):
+            del client_id
+            return None
+
+    farm = None
+    if args.device is None:
+        farm = DabDeviceFarm(count=args.farm_devices,
+                             handler_workers=4,
+                             latency_ms=args.farm_latency_ms,
+                             failure_rate=args.farm_failure_rate,
+                             transport=transport('DAB scenario farm'))
+        farm.connect(host=host, port=port)
+        devices = farm.fleet_devices()
+    else:
+        devices = dict(args.device)
+
+    dab_mqtt_client = DabMqttClient(client_id='DAB scenario runner',
+                                    response_client_id=uuid4().hex,
+                                    transport=transport('DAB scenario runner'))
+    dab_mqtt_client.connect(host=host, port=port)
+
+    try:
+        runner = ScenarioRunner(dab_mqtt_client, devices, max_concurrency=args.max_concurrency)
+        report = runner.run(scenario, instances=args.instances)
+        print_report(report)
+        if args.json is not None:
+            with open(args.json, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+    finally:
+        dab_mqtt_client.disconnect()
+        if farm is not None:
+            farm.disconnect()
+
+
+if __name__ == '__main__':
+    main()
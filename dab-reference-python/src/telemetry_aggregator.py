@@ -0,0 +1,216 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+from array import array
+from threading import Lock
+from time import time
+
+from dab_metrics import percentile
+from mqtt_topic_filter import mqtt_matches_filter
+
+try:
+    import numpy
+except ImportError:
+    # the aggregator falls back to the standard library arrays
+    numpy = None
+
+
+class _Column:
+    """
+    A fixed-size ring buffer of floats, backed by a numpy array when numpy is installed and by an array otherwise
+    """
+
+    __slots__ = ('data', 'capacity', 'start', 'count')
+
+    def __init__(self, capacity):
+        self.data = numpy.zeros(capacity) if numpy is not None else array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.start = 0
+        self.count = 0
+
+    def append(self, value):
+        if self.count == self.capacity:
+            self.data[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.data[(self.start + self.count) % self.capacity] = value
+            self.count += 1
+
+    def values(self):
+        """
+        Returns the values, oldest first
+        """
+        end = self.start + self.count
+        if end <= self.capacity:
+            return self.data[self.start:end]
+        if numpy is not None:
+            return numpy.concatenate((self.data[self.start:], self.data[:end - self.capacity]))
+        return self.data[self.start:] + self.data[:end - self.capacity]
+
+
+class TelemetrySeries:
+    """
+    The latest samples of a metric of a telemetry topic, as a column of timestamps and a column of values
+    """
+
+    __slots__ = ('topic', 'metric', 'timestamps', 'values')
+
+    def __init__(self, topic, metric, capacity):
+        self.topic = topic
+        self.metric = metric
+        self.timestamps = _Column(capacity)
+        self.values = _Column(capacity)
+
+    def append(self, timestamp, value):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def window(self, since):
+        """
+        Returns the values of the samples taken at or after the since timestamp, in seconds
+        """
+        timestamps = self.timestamps.values()
+        values = self.values.values()
+        if numpy is not None:
+            return values[timestamps >= since]
+        # the samples of a series mostly arrive in order, the window is its tail
+        first = len(timestamps)
+        while first > 0 and timestamps[first - 1] >= since:
+            first -= 1
+        return values[first:]
+
+
+class TelemetryAggregator:
+    """
+    Collects the telemetry samples of many devices and applications into columnar buffers and computes rolling
+    window statistics over them, e.g. for a dashboard
+
+    The aggregator is a subscription callback:
+
+        aggregator = TelemetryAggregator()
+        dab_mqtt_client.subscribe("+/dab/device-telemetry/metrics", aggregator.on_message)
+        aggregator.stats("+/dab/device-telemetry/metrics", metric="cpu", window_s=10)
+
+    The samples are stored as floats, one series per topic and metric, each keeping the latest capacity samples.
+    """
+
+    def __init__(self, capacity=4096, window_s=60):
+        """
+        :param capacity: (optional) the number of samples kept per series (default 4096)
+        :param window_s: (optional) the default window of the statistics, in seconds (default 60 seconds)
+        """
+        if capacity < 1:
+            raise ValueError(f"The capacity must be positive. capacity={capacity}")
+        self.capacity = capacity
+        self.window_s = window_s
+        self.series = {}
+        self.lock = Lock()
+
+    def on_message(self, topic, payload):
+        """
+        Adds the samples of a telemetry message: a single sample or a batch {"samples": [...]}, possibly downsampled,
+        in which case the mean of the window is used as its value. Samples without a numeric value are ignored
+        """
+        if not isinstance(payload, dict):
+            return
+        samples = payload.get("samples")
+        if samples is None:
+            samples = (payload,)
+
+        received_at = time()
+        with self.lock:
+            for sample in samples:
+                value = sample.get("value", sample.get("mean"))
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                timestamp = sample.get("timestamp")
+                timestamp = timestamp / 1000 if isinstance(timestamp, (int, float)) else received_at
+                key = (topic, sample.get("metric"))
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = TelemetrySeries(topic, key[1], self.capacity)
+                series.append(timestamp, value)
+
+    def stats(self, topic_filter='#', metric=None, window_s=None, percentiles=(50, 90, 99), now=None):
+        """
+        Returns the statistics of the samples of the series matching the topic filter and the metric over the last
+        window_s seconds, as a dictionary with count, rate (samples per second), min, max, mean and percentiles.
+        The values are None when there are no samples
+
+        :param topic_filter: (optional) a topic filter selecting the series, e.g. +/dab/app-telemetry/metrics/#
+                             (default #, all the series)
+        :param metric: (optional) the metric of the samples. When None (default) all the metrics are included
+        :param window_s: (optional) the window, in seconds. Defaults to the window of the aggregator
+        :param percentiles: (optional) the percentiles to compute (default 50, 90 and 99)
+        :param now: (optional) the end of the window, as a timestamp in seconds (default the current time)
+        """
+        window_s = self.window_s if window_s is None else window_s
+        since = (time() if now is None else now) - window_s
+        with self.lock:
+            columns = [series.window(since) for series in self.series.values()
+                       if (metric is None or series.metric == metric) and
+                       mqtt_matches_filter(series.topic, topic_filter)]
+
+        if numpy is not None:
+            values = numpy.concatenate(columns) if columns else numpy.zeros(0)
+            count = len(values)
+            if count == 0:
+                return self._empty_stats(percentiles)
+            return {
+                "count": count,
+                "rate": count / window_s,
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "mean": float(values.mean()),
+                "percentiles": dict(zip(percentiles, (float(value) for value in
+                                                      numpy.percentile(values, percentiles)))),
+            }
+
+        values = sorted(value for column in columns for value in column)
+        count = len(values)
+        if count == 0:
+            return self._empty_stats(percentiles)
+        return {
+            "count": count,
+            "rate": count / window_s,
+            "min": values[0],
+            "max": values[-1],
+            "mean": sum(values) / count,
+            "percentiles": {percent: percentile(values, percent) for percent in percentiles},
+        }
+
+    @staticmethod
+    def _empty_stats(percentiles):
+        return {
+            "count": 0,
+            "rate": 0.0,
+            "min": None,
+            "max": None,
+            "mean": None,
+            "percentiles": {percent: None for percent in percentiles},
+        }
+
+    def topics(self, topic_filter='#'):
+        """
+        Returns the topics with samples matching the topic filter, e.g. to list the devices reporting telemetry
+        """
+        with self.lock:
+            return sorted({series.topic for series in self.series.values()
+                           if mqtt_matches_filter(series.topic, topic_filter)})
@@ -0,0 +1,195 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+class SampleRing:
+    """
+    A fixed-size ring buffer of telemetry samples. When it is full, a new sample overwrites the oldest one, so the
+    memory of a stream stays bounded however long it runs and however long its samples cannot be published
+    """
+
+    __slots__ = ('_slots', '_start', '_count', 'dropped')
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"The ring buffer capacity must be positive. capacity={capacity}")
+        self._slots = [None] * capacity
+        self._start = 0
+        self._count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return len(self._slots)
+
+    def append(self, sample):
+        capacity = len(self._slots)
+        if self._count == capacity:
+            self._slots[self._start] = sample
+            self._start = (self._start + 1) % capacity
+            self.dropped += 1
+        else:
+            self._slots[(self._start + self._count) % capacity] = sample
+            self._count += 1
+
+    def samples(self):
+        """
+        Returns the buffered samples, oldest first, without removing them
+        """
+        capacity = len(self._slots)
+        return [self._slots[(self._start + i) % capacity] for i in range(self._count)]
+
+    def clear(self):
+        for i in range(len(self._slots)):
+            self._slots[i] = None
+        self._start = 0
+        self._count = 0
+        self.dropped = 0
+
+
+class Downsampler:
+    """
+    Reduces the samples of a window to a single sample carrying the min, max and mean of their "value".
+    The reduced sample keeps the other fields, e.g. the timestamp, of the first sample of the window
+    """
+
+    __slots__ = ('window_samples', '_first', '_count', '_min', '_max', '_sum')
+
+    def __init__(self, window_samples):
+        self.window_samples = window_samples
+        self._first = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, sample):
+        """
+        Adds a sample to the window. Returns the reduced sample when the window is complete, None otherwise
+        """
+        value = sample["value"]
+        if self._count == 0:
+            self._first = sample
+            self._min = self._max = self._sum = value
+        else:
+            self._min = min(self._min, value)
+            self._max = max(self._max, value)
+            self._sum += value
+        self._count += 1
+        if self._count >= self.window_samples:
+            return self.reduce()
+        return None
+
+    def reduce(self):
+        """
+        Returns the reduced sample of the samples added so far and starts a new window, None if there are none
+        """
+        if self._count == 0:
+            return None
+        reduced = {key: value for key, value in self._first.items() if key != "value"}
+        reduced["min"] = self._min
+        reduced["max"] = self._max
+        reduced["mean"] = self._sum / self._count
+        reduced["count"] = self._count
+        self._first = None
+        self._count = 0
+        return reduced
+
+
+class TelemetryBatching:
+    """
+    How the samples of a telemetry stream are batched before being published.
+    Each stream started with it gets its own TelemetryBatch
+    """
+
+    def __init__(self, max_samples=64, flush_interval_ms=1000, downsample_window_ms=None):
+        """
+        :param max_samples: (optional) the capacity of the ring buffer of each stream; a batch is published as soon
+                            as it holds this many samples (default 64)
+        :param flush_interval_ms: (optional) the maximum time, in milliseconds, a sample waits in the buffer before
+                                  its batch is published (default 1000 milliseconds)
+        :param downsample_window_ms: (optional) when set, the samples of each window of this length are reduced on
+                                     the device to their min, max and mean. The samples must carry a numeric "value".
+                                     When None (default) every sample is published
+        """
+        if max_samples < 1:
+            raise ValueError(f"max_samples must be positive. max_samples={max_samples}")
+        if flush_interval_ms <= 0:
+            raise ValueError(f"flush_interval_ms must be positive. flush_interval_ms={flush_interval_ms}")
+        if downsample_window_ms is not None and downsample_window_ms <= 0:
+            raise ValueError(f"downsample_window_ms must be positive. downsample_window_ms={downsample_window_ms}")
+        self.max_samples = max_samples
+        self.flush_interval_ms = flush_interval_ms
+        self.downsample_window_ms = downsample_window_ms
+
+    def new_batch(self, interval_ms):
+        downsampler = None
+        if self.downsample_window_ms is not None:
+            downsampler = Downsampler(max(1, round(self.downsample_window_ms / interval_ms)))
+        return TelemetryBatch(SampleRing(self.max_samples), self.flush_interval_ms / 1000, downsampler)
+
+
+class TelemetryBatch:
+    """
+    The buffered samples of a telemetry stream, published as a single message
+    {"samples": [...], "dropped": <samples overwritten since the last batch>}
+    """
+
+    __slots__ = ('ring', 'flush_interval_s', 'downsampler', 'oldest_at')
+
+    def __init__(self, ring, flush_interval_s, downsampler=None):
+        self.ring = ring
+        self.flush_interval_s = flush_interval_s
+        self.downsampler = downsampler
+        self.oldest_at = None
+
+    def add(self, sample, now):
+        """
+        Buffers a sample taken at the monotonic time now. Returns True when the batch should be published
+        """
+        if self.downsampler is not None:
+            sample = self.downsampler.add(sample)
+        if sample is not None:
+            if len(self.ring) == 0:
+                self.oldest_at = now
+            self.ring.append(sample)
+        return len(self.ring) >= self.ring.capacity or \
+            (self.oldest_at is not None and now - self.oldest_at >= self.flush_interval_s)
+
+    def pending(self):
+        return len(self.ring) > 0 or (self.downsampler is not None and len(self.downsampler) > 0)
+
+    def close_window(self):
+        """
+        Buffers the reduced sample of the incomplete downsampling window, e.g. when the stream stops
+        """
+        if self.downsampler is not None:
+            sample = self.downsampler.reduce()
+            if sample is not None:
+                self.ring.append(sample)
+
+    def payload(self):
+        return {"samples": self.ring.samples(), "dropped": self.ring.dropped}
+
+    def clear(self):
+        self.ring.clear()
+        self.oldest_at = None
@@ -0,0 +1,206 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+
+import heapq
+import itertools
+import logging
+
+from threading import Condition, Thread
+from time import monotonic
+
+
+class TelemetryStream:
+    """
+    A telemetry stream publishing a sample on a topic at a fixed interval
+    """
+
+    __slots__ = ('stream_id', 'topic', 'interval_ticks', 'sample', 'batch', 'next_tick', 'active')
+
+    def __init__(self, stream_id, topic, interval_ticks, sample, batch=None):
+        self.stream_id = stream_id
+        self.topic = topic
+        self.interval_ticks = interval_ticks
+        self.sample = sample
+        self.batch = batch
+        self.next_tick = 0
+        self.active = True
+
+    def pending(self):
+        return self.batch is not None and self.batch.pending()
+
+
+class TelemetryScheduler:
+    """
+    Publishes the samples of any number of telemetry streams from a single thread
+
+    The streams are kept in a heap ordered by their next due tick. The thread sleeps until the earliest tick and
+    then publishes every stream due in that tick in one pass, so streams sharing a tick cost a single wake-up.
+    A stream that falls behind skips the ticks it missed rather than publishing a burst of late samples.
+
+    A stream started with a TelemetryBatching buffers its samples and publishes them as batches instead. The
+    batches are only touched by the scheduler thread; a stopped stream publishes its last batch when it comes up.
+    """
+
+    def __init__(self, publish, tick_ms=10):
+        """
+        :param publish: a function accepting a topic and a payload object, e.g. DabMqttClient.publish
+        :param tick_ms: (optional) the scheduling resolution in milliseconds; intervals are rounded to a multiple
+                        of it (default 10 milliseconds)
+        """
+        self.logger = logging.getLogger('dab.telemetry.scheduler')
+        self.publish = publish
+        self.tick_s = tick_ms / 1000
+        self._condition = Condition()
+        self._heap = []
+        self._streams = {}
+        self._sequence = itertools.count()
+        self._origin = monotonic()
+        self._thread = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._streams)
+
+    def _current_tick(self):
+        return int((monotonic() - self._origin) / self.tick_s)
+
+    def start_stream(self, stream_id, topic, interval_ms, sample, batching=None):
+        """
+        Starts publishing sample() on the topic every interval_ms milliseconds, replacing the stream with the
+        same identifier if there is one. The first sample is published on the next tick
+
+        :param stream_id: a hashable identifying the stream, e.g. ("app", app_id)
+        :param topic: the topic the samples are published on
+        :param interval_ms: the interval between two samples, in milliseconds
+        :param sample: a function with no parameters returning the payload to publish
+        :param batching: (optional) a TelemetryBatching buffering the samples and publishing them in batches.
+                         When None (default) every sample is published as its own message
+        """
+        if interval_ms <= 0:
+            raise ValueError(f"The telemetry interval must be positive. interval_ms={interval_ms}")
+
+        batch = batching.new_batch(interval_ms) if batching is not None else None
+        stream = TelemetryStream(stream_id, topic, max(1, round(interval_ms / 1000 / self.tick_s)), sample, batch)
+        with self._condition:
+            previous = self._streams.get(stream_id)
+            if previous is not None:
+                previous.active = False
+            self._streams[stream_id] = stream
+            stream.next_tick = self._current_tick() + 1
+            heapq.heappush(self._heap, (stream.next_tick, next(self._sequence), stream))
+            self._start()
+            self._condition.notify()
+
+    def stop_stream(self, stream_id):
+        """
+        Stops a stream. Returns False if there is no stream with this identifier
+        """
+        with self._condition:
+            stream = self._streams.pop(stream_id, None)
+            if stream is None:
+                return False
+            # the stream is dropped from the heap when it comes up, after publishing its buffered samples
+            stream.active = False
+            return True
+
+    def stop_all(self):
+        with self._condition:
+            for stream in self._streams.values():
+                stream.active = False
+            self._streams.clear()
+
+    def _start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = Thread(target=self._run, name='dab-telemetry-scheduler', daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        """
+        Stops all the streams and the scheduler thread
+        """
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._running = False
+            self._condition.notify()
+        self.stop_all()
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            self._heap.clear()
+
+    def _due_streams(self):
+        with self._condition:
+            while self._running:
+                while self._heap and not self._heap[0][2].active and not self._heap[0][2].pending():
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                tick = self._current_tick()
+                next_tick = self._heap[0][0]
+                if next_tick > tick:
+                    self._condition.wait(timeout=(next_tick * self.tick_s) - (monotonic() - self._origin))
+                    continue
+
+                due = []
+                while self._heap and self._heap[0][0] <= tick:
+                    _, _, stream = heapq.heappop(self._heap)
+                    if not stream.active:
+                        if stream.pending():
+                            due.append(stream)
+                        continue
+                    due.append(stream)
+                    stream.next_tick += stream.interval_ticks
+                    if stream.next_tick <= tick:
+                        missed = (tick - stream.next_tick) // stream.interval_ticks + 1
+                        stream.next_tick += missed * stream.interval_ticks
+                    heapq.heappush(self._heap, (stream.next_tick, next(self._sequence), stream))
+                return due
+            return None
+
+    def _run(self):
+        while True:
+            due = self._due_streams()
+            if due is None:
+                return
+
+            for stream in due:
+                try:
+                    if stream.batch is None:
+                        self.publish(stream.topic, stream.sample())
+                    else:
+                        self._batch(stream)
+                except Exception:
+                    self.logger.exception("Telemetry stream %s failed", stream.stream_id)
+
+    def _batch(self, stream):
+        batch = stream.batch
+        if stream.active:
+            flush = batch.add(stream.sample(), monotonic())
+        else:
+            batch.close_window()
+            flush = batch.pending()
+        if flush:
+            # the samples stay in the ring buffer if they cannot be published
+            self.publish(stream.topic, batch.payload())
+            batch.clear()
@@ -0,0 +1,1632 @@
+__copyright__ = """
+    Copyright 2021 Amazon.com, Inc. or its affiliates.
+    Copyright 2021 Netflix Inc.
+    Copyright 2021 Google LLC
+"""
+__license__ = """
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+import asyncio
+import threading
+import time
+import zlib
+
+import pytest
+
+from app_state_tracker import AppStateTracker, BACKGROUND, FOREGROUND, STOPPED
+from async_dab_client import AsyncDabClient
+from async_dab_mqtt_client import AsyncDabMqttClient
+from dab_client import DabClient, DabClientBatch
+from dab_compression import PayloadCompression, inflate
+from dab_device import CACHEABLE_RESPONSE_TTLS, new_dab_0_1_device
+from dab_device_farm import DabDeviceFarm
+from dab_fleet import DabFleet
+from dab_metrics import DabMetrics, UNKNOWN_STATUS, percentile
+from dab_mqtt_client import DabMqttClient, DabMqttException, RESPONSE_TOPIC_PREFIX, TAP_INBOUND, TAP_OUTBOUND
+from dab_operations import OperationRegistry
+from dab_scenario import OPERATIONS, Scenario, ScenarioRunner
+from dab_timer_wheel import TimerWheel
+from dab_traffic import TrafficLog, TrafficRecorder, TrafficReplayer
+from dab_request_dedup import COMPLETED, IN_PROGRESS, NEW_REQUEST, RequestDeduplicator
+from dab_request_executor import PRIORITY_HIGH, PRIORITY_LOW, RequestExecutor
+from dab_response_cache import ResponseCache
+from dummy_port.applications import Applications
+from dummy_port.system import System
+from dummy_port.telemetry import Telemetry
+from loopback_broker import LoopbackBroker
+from mqtt_topic_filter import TopicRouter, TopicTree, mqtt_matches_filter
+from telemetry_aggregator import TelemetryAggregator
+from telemetry_buffer import Downsampler, SampleRing, TelemetryBatching
+
+
+@pytest.fixture
+def broker():
+    return LoopbackBroker()
+
+
+@pytest.fixture
+def device(broker):
+    device = new_dab_0_1_device("device", Applications(), System(), Telemetry(), {"model": "test"},
+                                handler_workers=2, transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    yield device
+    device.disconnect()
+
+
+@pytest.fixture
+def client(broker):
+    client = DabMqttClient("client", transport=broker.transport("client"))
+    client.connect("localhost", 1883)
+    yield client
+    client.disconnect()
+
+
+def run_async_client(broker, scenario):
+    """
+    Runs the scenario coroutine with a connected AsyncDabMqttClient, disconnecting it afterwards
+    """
+
+    async def main():
+        client = AsyncDabMqttClient("async-client", transport=broker.transport("async-client"))
+        await client.connect("localhost", 1883)
+        try:
+            return await scenario(client)
+        finally:
+            client.disconnect()
+
+    return asyncio.run(main())
+
+
+# TopicRouter
+
+@pytest.mark.parametrize("topic, topic_filter", [
+    ("dab/applications/list", "dab/applications/list"),
+    ("dab/applications/list", "dab/+/list"),
+    ("dab/applications/list", "dab/#"),
+    ("farm/device-1/dab/health-check/get", "farm/+/dab/#"),
+    ("dab/applications/list", "#"),
+])
+def test_topic_router_matches_like_mqtt_matches_filter(topic, topic_filter):
+    router = TopicRouter()
+    router.add(topic_filter, "handler")
+    assert router.match(topic) == ["handler"]
+    assert mqtt_matches_filter(topic, topic_filter)
+
+
+@pytest.mark.parametrize("topic, topic_filter", [
+    ("dab/applications/list", "dab/applications"),
+    ("dab/applications", "dab/applications/list"),
+    ("dab/applications/list", "dab/+"),
+    ("dab/applications/list", "+/list"),
+    ("$SYS/broker/uptime", "#"),
+    ("$SYS/broker/uptime", "+/broker/uptime"),
+])
+def test_topic_router_does_not_match(topic, topic_filter):
+    router = TopicRouter()
+    router.add(topic_filter, "handler")
+    assert router.match(topic) == []
+
+
+def test_topic_router_multi_level_wildcard_matches_the_parent_level():
+    router = TopicRouter()
+    router.add("dab/#", "handler")
+    assert router.match("dab") == ["handler"]
+
+
+def test_topic_router_returns_every_matching_value():
+    router = TopicRouter()
+    router.add("dab/applications/launch/+", "launch")
+    router.add("dab/applications/+/+", "applications")
+    router.add("dab/#", "all")
+    router.add("dab/applications/launch/+", "launch again")
+
+    assert sorted(router.match("dab/applications/launch/1234")) == ["all", "applications", "launch", "launch again"]
+    assert router.match("dab/system/restart/1234") == ["all"]
+    assert len(router) == 4
+
+
+def test_topic_router_remove_prunes_the_filter():
+    router = TopicRouter()
+    router.add("_response/dab/health-check/get/1234", "waiter")
+    router.add("_response/dab/#", "subscription")
+
+    assert router.remove("_response/dab/health-check/get/1234", "waiter")
+    assert not router.remove("_response/dab/health-check/get/1234", "waiter")
+    assert router.match("_response/dab/health-check/get/1234") == ["subscription"]
+    assert "health-check" not in router._root.children["_response"].children["dab"].children
+
+    assert router.remove("_response/dab/#", "subscription")
+    assert len(router) == 0
+    assert not router._root.children
+
+
+@pytest.mark.parametrize("topic_filter", ["dab/#/list", "dab/app+/list", "dab/#applications"])
+def test_topic_router_rejects_invalid_filters(topic_filter):
+    with pytest.raises(ValueError):
+        TopicRouter().add(topic_filter, "handler")
+
+
+# TopicTree and LoopbackBroker
+
+def test_topic_tree_matches_the_topics_of_a_filter():
+    tree = TopicTree()
+    for topic in ("a", "a/b", "a/c", "a/b/c", "b/b", "$SYS/a"):
+        tree.put(topic, topic.upper())
+
+    def matched(topic_filter):
+        return sorted(topic for topic, _ in tree.match(topic_filter))
+
+    assert matched("a/b") == ["a/b"]
+    assert matched("a/+") == ["a/b", "a/c"]
+    assert matched("+/b") == ["a/b", "b/b"]
+    assert matched("a/#") == ["a", "a/b", "a/b/c", "a/c"]
+    assert matched("#") == ["a", "a/b", "a/b/c", "a/c", "b/b"]
+    assert matched("$SYS/#") == ["$SYS/a"]
+    assert matched("c/#") == []
+    assert dict(tree.match("a/b/+")) == {"a/b/c": "A/B/C"}
+
+
+def test_topic_tree_replaces_and_removes_the_topics():
+    tree = TopicTree()
+    tree.put("a/b", 1)
+    tree.put("a/b", 2)
+    tree.put("a/b/c", 3)
+
+    assert len(tree) == 2
+    assert tree.match("a/b") == [("a/b", 2)]
+    assert tree.pop("a/b/c") == 3
+    assert tree.pop("a/b/c") is None
+    assert tree.pop("a") is None
+    assert tree.match("#") == [("a/b", 2)]
+    assert len(tree) == 1
+
+
+def broker_subscriber(broker, client_id, topic_filter, qos):
+    transport = broker.transport(client_id)
+    messages = []
+    transport.deliver = messages.append
+    transport.connect()
+    transport.subscribe(topic_filter, qos)
+    return messages
+
+
+def test_broker_delivers_the_retained_messages_to_the_new_subscriptions():
+    broker = LoopbackBroker()
+    publisher = broker.transport("publisher")
+    publisher.connect()
+    publisher.publish("lab/tv-1/dab/version", b"1", qos=2, retain=True)
+    publisher.publish("lab/tv-2/dab/version", b"2", qos=1, retain=True)
+    publisher.publish("lab/tv-3/dab/version", b"3", qos=2, retain=True)
+    publisher.publish("lab/tv-3/dab/version", b"", qos=2, retain=True)
+    publisher.publish("lab/tv-1/dab/health-check/get", b"{}", qos=0)
+
+    messages = broker_subscriber(broker, "subscriber", "lab/+/dab/version", 2)
+
+    assert sorted((message.topic, message.payload, message.qos, message.retain) for message in messages) == [
+        ("lab/tv-1/dab/version", b"1", 2, True),
+        ("lab/tv-2/dab/version", b"2", 1, True),
+    ]
+
+
+def test_broker_delivers_with_the_lower_of_the_publish_and_subscription_qos():
+    broker = LoopbackBroker()
+    qos_1 = broker_subscriber(broker, "qos-1", "dab/#", 1)
+    qos_0 = broker_subscriber(broker, "qos-0", "dab/+", 0)
+    publisher = broker.transport("publisher")
+    publisher.connect()
+
+    for qos in (0, 1, 2):
+        publisher.publish("dab/topic", b"{}", qos=qos)
+    publisher.publish("other/topic", b"{}", qos=2)
+
+    assert [message.qos for message in qos_1] == [0, 1, 1]
+    assert [message.qos for message in qos_0] == [0, 0, 0]
+    assert all(not message.retain for message in qos_1)
+
+
+def test_broker_sends_a_single_copy_to_overlapping_subscriptions_with_the_highest_qos():
+    broker = LoopbackBroker()
+    transport = broker.transport("client")
+    messages = []
+    transport.deliver = messages.append
+    transport.connect()
+    transport.subscribe("dab/+", 0)
+    transport.subscribe("dab/#", 2)
+    publisher = broker.transport("publisher")
+    publisher.connect()
+
+    publisher.publish("dab/topic", b"{}", qos=2)
+
+    assert [(message.topic, message.qos) for message in messages] == [("dab/topic", 2)]
+
+
+def test_broker_link_latency_adds_the_trips_of_each_qos():
+    broker = LoopbackBroker(link_latency_ms=20)
+    received = {}
+    done = threading.Event()
+    transport = broker.transport("client")
+
+    def deliver(message):
+        received[message.qos] = time.monotonic()
+        if len(received) == 2:
+            done.set()
+
+    transport.deliver = deliver
+    transport.connect()
+    transport.subscribe("dab/#", 2)
+    publisher = broker.transport("publisher")
+    publisher.connect()
+
+    sent = time.monotonic()
+    publisher.publish("dab/qos-0", b"{}", qos=0)
+    publisher.publish("dab/qos-2", b"{}", qos=2)
+
+    assert done.wait(5)
+    # one trip to the broker and one to the subscriber at QoS 0, three trips to the broker at QoS 2
+    assert received[0] - sent >= 0.04
+    assert received[2] - sent >= 0.08
+    assert received[2] > received[0]
+
+
+# AsyncDabMqttClient
+
+def test_async_client_concurrent_requests(broker, device):
+    async def scenario(client):
+        dab = AsyncDabClient(client)
+        responses = await asyncio.gather(*(dab.health_check() for _ in range(50)))
+        return responses, len(client.messages_in_flight)
+
+    responses, in_flight = run_async_client(broker, scenario)
+    assert [response["status"] for response in responses] == [200] * 50
+    assert in_flight == 0
+
+
+def test_async_client_request_times_out(broker, device):
+    async def scenario(client):
+        with pytest.raises(DabMqttException) as error:
+            await client.request("dab/unknown/operation", {}, timeout_s=0.2)
+        return error.value, len(client.messages_in_flight)
+
+    error, in_flight = run_async_client(broker, scenario)
+    assert error.error_code == 500
+    assert in_flight == 0
+
+
+def test_async_client_request_many_keeps_the_request_order(broker, device):
+    async def scenario(client):
+        return await client.request_many([
+            ("dab/health-check/get", {}),
+            ("dab/unknown/operation", {}),
+            ("dab/applications/list", {}),
+        ], timeout_s=0.5)
+
+    responses = run_async_client(broker, scenario)
+    assert responses[0]["status"] == 200
+    assert responses[1]["status"] == 500
+    assert responses[2]["status"] == 200
+    assert "applications" in responses[2]
+
+
+# RequestExecutor
+
+@pytest.fixture
+def executors():
+    """
+    Creates started executors, shut down at the end of the test
+    """
+    created = []
+
+    def create(*args, **kwargs):
+        executor = RequestExecutor(*args, **kwargs)
+        executor.start()
+        created.append(executor)
+        return executor
+
+    yield create
+    for executor in created:
+        executor.shutdown(wait=False)
+
+
+def block_worker(executor, topic="dab/blocking"):
+    """
+    Submits a task holding its worker until the returned event is set
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def task():
+        started.set()
+        release.wait(5)
+
+    assert executor.submit(topic, task)
+    assert started.wait(5)
+    return release
+
+
+def test_executor_lane_runs_its_tasks_one_at_a_time_in_order(executors):
+    executor = executors(4, concurrency_limits={"dab/input/#": 1})
+    lock = threading.Lock()
+    state = {"running": 0, "max_running": 0}
+    order = []
+    done = threading.Event()
+
+    def task(index):
+        with lock:
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+        time.sleep(0.01)
+        with lock:
+            state["running"] -= 1
+            order.append(index)
+            if len(order) == 5:
+                done.set()
+
+    for index in range(5):
+        assert executor.submit("dab/input/key-press", lambda index=index: task(index))
+
+    assert done.wait(5)
+    assert order == [0, 1, 2, 3, 4]
+    assert state["max_running"] == 1
+
+
+def test_executor_saturated_lane_does_not_block_the_other_topics(executors):
+    executor = executors(2, concurrency_limits={"dab/input/#": 1})
+    release = block_worker(executor, "dab/input/key-press")
+    queued_key_press = threading.Event()
+    health_check = threading.Event()
+
+    assert executor.submit("dab/input/key-press", queued_key_press.set)
+    assert executor.submit("dab/health-check/get", health_check.set)
+
+    assert health_check.wait(5)
+    assert not queued_key_press.is_set()
+    release.set()
+    assert queued_key_press.wait(5)
+
+
+def test_executor_rejects_tasks_beyond_max_queued(executors):
+    executor = executors(1, max_queued=2)
+    release = block_worker(executor)
+
+    assert executor.submit("dab/applications/list", lambda: None)
+    assert executor.submit("dab/applications/list", lambda: None)
+    assert not executor.submit("dab/applications/list", lambda: None)
+    assert executor.stats() == {"queued": 2, "running": 1, "rejected": 1}
+    release.set()
+
+
+def test_executor_runs_the_waiting_tasks_by_priority_class(executors):
+    executor = executors(1, priorities={"dab/health-check/get": PRIORITY_HIGH, "dab/system/#": PRIORITY_LOW})
+    release = block_worker(executor)
+    order = []
+    done = threading.Event()
+
+    def task(name):
+        order.append(name)
+        if len(order) == 3:
+            done.set()
+
+    executor.submit("dab/system/restart", lambda: task("low"))
+    executor.submit("dab/applications/list", lambda: task("normal"))
+    executor.submit("dab/health-check/get", lambda: task("high"))
+    release.set()
+
+    assert done.wait(5)
+    assert order == ["high", "normal", "low"]
+
+
+def test_executor_displaces_the_tasks_held_back_by_a_saturated_lane(executors):
+    executor = executors(2, concurrency_limits={"dab/input/#": 1}, max_queued=3,
+                         priorities={"dab/health-check/get": PRIORITY_HIGH, "dab/input/#": PRIORITY_LOW})
+    release = block_worker(executor, "dab/input/key-press")
+    order = []
+    rejected = []
+    done = threading.Event()
+
+    def task(name):
+        order.append(name)
+        if len(order) == 3:
+            done.set()
+
+    for index in range(3):
+        assert executor.submit("dab/input/key-press", lambda index=index: task(f"key {index}"),
+                               reject=lambda index=index: rejected.append(f"key {index}"))
+    assert not executor.submit("dab/input/key-press", lambda: task("key 3"))
+
+    # the key presses all wait for the lane, the health check takes the place of the latest one
+    health_check = threading.Event()
+    assert executor.submit("dab/health-check/get", health_check.set)
+    assert health_check.wait(5)
+    assert rejected == ["key 2"]
+
+    release.set()
+    executor.submit("dab/input/key-press", lambda: task("key 4"))
+    assert done.wait(5)
+    assert order == ["key 0", "key 1", "key 4"]
+    assert executor.stats()["rejected"] == 2
+
+
+# request_many and DabClientBatch
+
+def test_request_many_keeps_the_request_order(client, device):
+    responses = client.request_many([
+        ("dab/applications/list", {}),
+        ("dab/unknown/operation", {}),
+        ("dab/health-check/get", {}),
+    ], timeout_s=0.5)
+
+    assert [response["status"] for response in responses] == [200, 500, 200]
+    assert "applications" in responses[0]
+    assert not client.messages_in_flight
+
+
+def test_request_many_as_completed_yields_the_timeouts_last(client, device):
+    completed = list(client.request_many_as_completed([
+        ("dab/unknown/operation", {}),
+        ("dab/health-check/get", {}),
+        ("dab/applications/list", {}),
+    ], timeout_s=0.5))
+
+    assert sorted(index for index, _ in completed[:2]) == [1, 2]
+    assert completed[2][0] == 0
+    assert completed[2][1]["status"] == 500
+
+
+def test_dab_client_batch_records_then_pipelines_the_operations(client, device):
+    batch = DabClientBatch(client)
+    assert batch.health_check() == 0
+    assert batch.list_apps() == 1
+    assert not client.messages_in_flight
+
+    health_check, list_apps = batch.execute(timeout_s=5)
+    assert health_check["status"] == 200
+    assert list_apps["status"] == 200
+    assert "applications" in list_apps
+
+
+# DabFleet
+
+def test_fleet_broadcast_sends_once_to_a_duplicate_device(client, device):
+    fleet = DabFleet(client, {"device": None, "missing": "lab/missing"})
+
+    responses = list(fleet.broadcast("health_check", device_ids=["device", "missing", "device"], timeout_s=0.3))
+
+    assert sorted(device_id for device_id, _ in responses) == ["device", "missing"]
+    assert dict(responses)["device"]["status"] == 200
+    assert dict(responses)["missing"]["status"] == 500
+    assert not client.messages_in_flight
+
+
+# QoS
+
+def recording_transport(broker, client_id, delivered):
+    transport = broker.transport(client_id)
+    deliver = transport.deliver
+
+    def record(message):
+        delivered[message.topic.rpartition('/')[0]] = message.qos
+        deliver(message)
+
+    transport.deliver = record
+    return transport
+
+
+def test_requests_and_responses_are_delivered_with_their_qos(broker):
+    device_delivered = {}
+    client_delivered = {}
+    device = new_dab_0_1_device("device", Applications(), System(), Telemetry(), {"model": "test"},
+                                transport=recording_transport(broker, "device", device_delivered))
+    client = DabMqttClient("client", transport=recording_transport(broker, "client", client_delivered),
+                           qos_policy={"dab/applications/launch": 2})
+    device.connect("localhost", 1883)
+    client.connect("localhost", 1883)
+    try:
+        assert client.request("dab/applications/launch", {"appId": "Netflix"})["status"] == 200
+        assert client.request("dab/system/language/set", {"language": "fr"})["status"] == 200
+        assert client.request("dab/health-check/get", {})["status"] == 200
+    finally:
+        client.disconnect()
+        device.disconnect()
+
+    # the requests are received with the QoS they are sent with, up to the QoS of their responses
+    assert device_delivered["dab/applications/launch"] == 2
+    assert device_delivered["dab/system/language/set"] == 0
+    assert device_delivered["dab/health-check/get"] == 0
+    # the responses are received with the QoS the device publishes them with
+    assert client_delivered["_response/dab/applications/launch"] == 2
+    assert client_delivered["_response/dab/system/language/set"] == 2
+    assert client_delivered["_response/dab/health-check/get"] == 0
+
+
+# DabDeviceFarm
+
+@pytest.fixture
+def farm(broker):
+    farm = DabDeviceFarm(3, handler_workers=2, transport=broker.transport("farm"))
+    farm.connect("localhost", 1883)
+    yield farm
+    farm.disconnect()
+
+
+def test_farm_devices_are_served_like_a_device(client, farm):
+    states = {}
+    state_received = threading.Event()
+
+    def on_state(topic, message):
+        states[topic] = message
+        state_received.set()
+
+    client.subscribe("farm/+/dab/applications/state/#", on_state)
+    launch = client.request("farm/device-1/dab/applications/launch", {"appId": "YouTube"}, timeout_s=5)
+    assert launch["status"] == 200
+    assert state_received.wait(5)
+    assert list(states) == ["farm/device-1/dab/applications/state/YouTube"]
+
+    assert client.request("farm/device-1/dab/applications/get-state", {"appId": "YouTube"},
+                          timeout_s=5)["state"] == "FOREGROUND"
+    assert client.request("farm/device-2/dab/applications/get-state", {"appId": "YouTube"},
+                          timeout_s=5)["state"] == "STOPPED"
+    assert client.request("farm/device-1/dab/applications/launch", {"appId": "Nope"}, timeout_s=5)["status"] == 400
+    assert client.request("farm/device-1/dab/applications/launch", {}, timeout_s=5)["status"] == 400
+
+    assert client.request("farm/device-0/dab/system/language/set", {"language": "fr"}, timeout_s=5)["status"] == 200
+    assert client.request("farm/device-0/dab/system/language/get", {}, timeout_s=5)["language"] == "fr"
+    assert client.request("farm/device-2/dab/system/language/get", {}, timeout_s=5)["language"] == "en-US"
+
+    assert client.request("farm/device-9/dab/health-check/get", {}, timeout_s=5)["status"] == 404
+
+    # the state of a launched application is retained for the clients subscribing later
+    retained = threading.Event()
+    client.subscribe("farm/device-1/dab/applications/state/YouTube", lambda topic, message: retained.set())
+    assert retained.wait(5)
+
+
+def test_farm_of_thousands_of_devices_answers_a_broadcast(broker):
+    farm = DabDeviceFarm(3000, handler_workers=2, transport=broker.transport("farm"))
+    farm.connect("localhost", 1883)
+    # the client subscribes to the dab/version message of every device it sends a request to
+    client = DabMqttClient("client", transport=broker.transport("client"), response_topic_filter="_response/#",
+                           response_client_id="scale")
+    client.connect("localhost", 1883)
+    try:
+        fleet = DabFleet(client, farm.fleet_devices(), max_concurrency=128)
+        for _ in range(2):
+            responses = dict(fleet.broadcast("health_check", timeout_s=30))
+            assert len(responses) == 3000
+            assert all(response["status"] == 200 for response in responses.values())
+    finally:
+        client.disconnect()
+        farm.disconnect()
+
+
+# key sequences
+
+class RecordingKeysSystem(System):
+    def __init__(self):
+        super(RecordingKeysSystem, self).__init__()
+        self.pressed = []
+
+    def key_press(self, key_code):
+        self.pressed.append(key_code)
+        if key_code == "KEY_BAD":
+            return {"status": 500, "error": "Unknown key"}
+        return super(RecordingKeysSystem, self).key_press(key_code)
+
+    def long_key_press(self, key_code, duration_ms):
+        self.pressed.append((key_code, duration_ms))
+        return super(RecordingKeysSystem, self).long_key_press(key_code, duration_ms)
+
+
+@pytest.fixture
+def keys_device(broker):
+    system = RecordingKeysSystem()
+    device = new_dab_0_1_device("device", Applications(), system, Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    yield system
+    device.disconnect()
+
+
+@pytest.mark.parametrize("keys", [
+    [{"keyCode": "KEY_A"}, {"keyCode": "KEY_B", "delayMs": "5"}],
+    [{"keyCode": "KEY_A"}, {"keyCode": 5}],
+    [{"keyCode": "KEY_A"}, {"keyCode": "KEY_B", "durationMs": -1}],
+    [{"keyCode": "KEY_A"}, {"keyCode": "KEY_B", "delayMs": None}],
+    [{"keyCode": "KEY_A"}, {"keyCode": "KEY_B", "durationMs": True}],
+    [{"keyCode": "KEY_A"}, "KEY_B"],
+])
+def test_key_sequence_rejects_an_invalid_key_before_pressing_any(client, keys_device, keys):
+    response = client.request("dab/input/key-sequence", {"keys": keys})
+
+    assert response["status"] == 400
+    assert "key 1" in response["error"]
+    assert keys_device.pressed == []
+
+
+def test_key_sequence_responds_with_the_result_of_each_key(client, keys_device):
+    response = client.request("dab/input/key-sequence", {"keys": [
+        {"keyCode": "KEY_A"}, {"keyCode": "KEY_B", "durationMs": 20, "delayMs": 0}, {"keyCode": "KEY_C"}]})
+
+    assert response == {"status": 200, "results": [
+        {"keyCode": "KEY_A", "status": 200}, {"keyCode": "KEY_B", "status": 200}, {"keyCode": "KEY_C", "status": 200}]}
+    assert keys_device.pressed == ["KEY_A", ("KEY_B", 20), "KEY_C"]
+
+
+@pytest.mark.parametrize("stop_on_error, status, pressed", [
+    (True, 500, ["KEY_A", "KEY_BAD"]),
+    (False, 200, ["KEY_A", "KEY_BAD", "KEY_C"]),
+])
+def test_key_sequence_stops_on_error_when_asked(client, keys_device, stop_on_error, status, pressed):
+    response = client.request("dab/input/key-sequence", {
+        "keys": [{"keyCode": "KEY_A"}, {"keyCode": "KEY_BAD"}, {"keyCode": "KEY_C"}],
+        "stopOnError": stop_on_error})
+
+    assert response["status"] == status
+    assert [result["status"] for result in response["results"]] == [200, 500, 200][:len(pressed)]
+    assert keys_device.pressed == pressed
+
+
+def test_key_sequence_publishes_its_progress_under_the_progress_id(client, keys_device):
+    progress = []
+    client.subscribe("dab/input/key-sequence-progress/+", lambda topic, message: progress.append((topic, message)))
+
+    response = client.request("dab/input/key-sequence", {
+        "keys": [{"keyCode": "KEY_A"}, {"keyCode": "KEY_B"}], "progressId": "sequence-1"})
+
+    assert response["status"] == 200
+    deadline = time.monotonic() + 5
+    while len(progress) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert progress == [
+        ("dab/input/key-sequence-progress/sequence-1", {"keyCode": "KEY_A", "status": 200, "index": 0, "total": 2}),
+        ("dab/input/key-sequence-progress/sequence-1", {"keyCode": "KEY_B", "status": 200, "index": 1, "total": 2}),
+    ]
+
+
+# AppStateTracker
+
+def test_app_state_tracker_follows_the_lifecycle_of_the_applications():
+    published = []
+    tracker = AppStateTracker("dab/applications/state", lambda topic, payload: published.append((topic, payload)))
+
+    tracker.launched("Netflix")
+    tracker.launched("YouTube")
+    tracker.launched("YouTube")
+    tracker.exited("YouTube", BACKGROUND)
+    tracker.restarted()
+
+    assert [(topic.rpartition('/')[2], payload["state"]) for topic, payload in published] == [
+        ("Netflix", FOREGROUND),
+        ("Netflix", BACKGROUND), ("YouTube", FOREGROUND),
+        ("YouTube", BACKGROUND),
+        ("Netflix", STOPPED), ("YouTube", STOPPED),
+    ]
+    assert all(payload["appId"] == topic.rpartition('/')[2] for topic, payload in published)
+    with pytest.raises(ValueError):
+        tracker.update("a/#", FOREGROUND)
+
+
+class FailingLaunchApplications(Applications):
+    def launch(self, app_id, params):
+        if app_id == "Broken":
+            return {"status": 500, "error": "Cannot launch"}
+        return super(FailingLaunchApplications, self).launch(app_id, params)
+
+
+def test_device_publishes_the_retained_states_of_its_applications(broker, client):
+    tracker = AppStateTracker()
+    device = new_dab_0_1_device("device", FailingLaunchApplications(), System(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"), app_state_tracker=tracker)
+    device.connect("localhost", 1883)
+    try:
+        assert client.request("dab/applications/launch", {"appId": "Netflix"})["status"] == 200
+        assert client.request("dab/applications/launch", {"appId": "Broken"})["status"] == 500
+        assert client.request("dab/applications/get-state", {"appId": "Netflix"})["state"] == FOREGROUND
+        assert client.request("dab/applications/launch", {"appId": "YouTube"})["status"] == 200
+        assert client.request("dab/applications/exit", {"appId": "YouTube"})["status"] == 200
+
+        # a controller subscribing later receives the current state of every application
+        states = {}
+        received = threading.Semaphore(0)
+
+        def on_state(topic, message):
+            states[message["appId"]] = message["state"]
+            received.release()
+
+        client.subscribe("dab/applications/state/+", on_state)
+        for _ in range(2):
+            assert received.acquire(timeout=5)
+    finally:
+        device.disconnect()
+
+    assert states == {"Netflix": BACKGROUND, "YouTube": STOPPED}
+    assert tracker.states() == states
+
+
+@pytest.mark.parametrize("topic, payload", [
+    ("dab/applications/launch", {"appId": "a/#"}),
+    ("dab/applications/exit", {"appId": "a/b"}),
+    ("dab/app-telemetry/start", {"appId": "x/+", "frequency": 1000}),
+])
+def test_device_rejects_an_app_id_that_is_not_a_topic_level(client, device, topic, payload):
+    response = client.request(topic, payload)
+
+    assert response["status"] == 400
+    assert "appId" in response["error"]
+
+
+# response caching
+
+class CountingApplications(Applications):
+    def __init__(self):
+        super(CountingApplications, self).__init__()
+        self.lists = 0
+
+    def list(self):
+        self.lists += 1
+        return super(CountingApplications, self).list()
+
+
+@pytest.mark.parametrize("response_ttls, port_calls", [(None, 2), (CACHEABLE_RESPONSE_TTLS, 1)])
+def test_device_caches_the_responses_only_when_the_port_opts_in(broker, client, response_ttls, port_calls):
+    applications = CountingApplications()
+    device = new_dab_0_1_device("device", applications, System(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"), response_ttls=response_ttls)
+    device.connect("localhost", 1883)
+    try:
+        assert client.request("dab/applications/list", {})["status"] == 200
+        assert client.request("dab/applications/list", {})["status"] == 200
+    finally:
+        device.disconnect()
+
+    assert applications.lists == port_calls
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("dab_response_cache.monotonic", lambda: now[0])
+    return now
+
+
+def test_cached_responses_expire_after_their_time_to_live(clock):
+    cache = ResponseCache(ttls={"dab/applications/list": 30})
+    cache.put("dab/applications/list", {}, {"status": 200, "applications": []})
+    # no time to live: not cached
+    cache.put("dab/system/restart", {}, {"status": 200})
+    # unsuccessful responses are not cached
+    cache.put("dab/applications/list", {"page": 2}, {"status": 500})
+
+    clock[0] += 29.9
+    assert cache.get("dab/applications/list", {}) == {"status": 200, "applications": []}
+    assert cache.get("dab/system/restart", {}) is None
+    assert cache.get("dab/applications/list", {"page": 2}) is None
+
+    clock[0] += 0.1
+    assert cache.get("dab/applications/list", {}) is None
+
+
+def test_the_least_recently_used_response_is_evicted(clock):
+    cache = ResponseCache(ttls={"dab/applications/get-state": 2}, max_entries=2)
+    for app_id in ("Netflix", "YouTube"):
+        cache.put("dab/applications/get-state", {"appId": app_id}, {"status": 200, "state": app_id})
+    assert cache.get("dab/applications/get-state", {"appId": "Netflix"}) is not None
+
+    cache.put("dab/applications/get-state", {"appId": "PrimeVideo"}, {"status": 200, "state": "PrimeVideo"})
+
+    assert [cache.get("dab/applications/get-state", {"appId": app_id}) is not None
+            for app_id in ("Netflix", "YouTube", "PrimeVideo")] == [True, False, True]
+
+
+def test_every_invalidated_topic_is_cached_by_default():
+    for stale_topics in ResponseCache().invalidations.values():
+        for stale_topic in stale_topics or ():
+            assert stale_topic in ResponseCache().ttls
+
+
+@pytest.mark.parametrize("request_topic, stale_topics", [
+    ("dab/applications/launch", {"dab/applications/get-state"}),
+    ("dab/applications/exit", {"dab/applications/get-state"}),
+    ("dab/system/language/set", {"dab/system/language/get"}),
+    ("dab/system/restart", {"dab/applications/get-state", "dab/applications/list", "dab/system/language/get",
+                            "dab/system/language/list"}),
+    ("dab/health-check/get", set()),
+])
+def test_requests_invalidate_the_responses_they_make_stale(request_topic, stale_topics):
+    cache = ResponseCache()
+    cached_topics = ("dab/applications/get-state", "dab/applications/list", "dab/system/language/get",
+                     "dab/system/language/list")
+    for topic in cached_topics:
+        cache.put(topic, {}, {"status": 200})
+
+    cache.invalidate_for_request(request_topic)
+
+    assert {topic for topic in cached_topics if cache.get(topic, {}) is None} == stale_topics
+
+
+def test_dab_client_caches_the_application_states_until_a_launch(broker, device):
+    sent = []
+    client = DabMqttClient("caching-client", transport=broker.transport("caching-client"),
+                           tap=lambda direction, topic, payload: direction == TAP_OUTBOUND and sent.append(topic))
+    client.connect("localhost", 1883)
+    dab_client = DabClient(client, cache=ResponseCache())
+    try:
+        assert dab_client.get_app_state("Netflix")["state"] == STOPPED
+        assert dab_client.get_app_state("Netflix")["state"] == STOPPED
+        assert len([topic for topic in sent if topic.startswith("dab/applications/get-state/")]) == 1
+
+        assert dab_client.launch_app("Netflix")["status"] == 200
+        assert dab_client.get_app_state("Netflix")["state"] == FOREGROUND
+        assert len([topic for topic in sent if topic.startswith("dab/applications/get-state/")]) == 2
+    finally:
+        client.disconnect()
+
+
+def test_dab_client_caches_the_retained_messages_as_they_are_published(broker, device, client):
+    cache = ResponseCache()
+    dab_client = DabClient(client, cache=cache)
+
+    # the retained messages are delivered on subscription, without a request
+    assert dab_client.device_info() == {"model": "test"}
+    assert cache.get("dab/device/info", None) == {"model": "test"}
+    assert cache.get("dab/version", None) == dab_client.dab_version()
+
+    # an emptied retained message drops its entry
+    publisher = broker.transport("publisher")
+    publisher.connect()
+    publisher.publish("dab/device/info", b"", qos=1, retain=True)
+    deadline = time.monotonic() + 5
+    while cache.get("dab/device/info", None) is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get("dab/device/info", None) is None
+
+
+# traffic recording and replay
+
+def record_traffic(broker, path, tap_client=True):
+    """
+    Records the requests of a client to a dummy port device, tapped by the device and optionally by the client
+    """
+    with TrafficRecorder(path) as recorder:
+        device = new_dab_0_1_device("recorded-device", Applications(), System(), Telemetry(), {"model": "test"},
+                                    tap=recorder.record, transport=broker.transport("recorded-device"))
+        device.connect("localhost", 1883)
+        client = DabMqttClient("recording-client", tap=recorder.record if tap_client else None,
+                               transport=broker.transport("recording-client"))
+        client.connect("localhost", 1883)
+        try:
+            for topic in ("dab/applications/list", "dab/system/language/get", "dab/health-check/get"):
+                assert client.request(topic, {})["status"] == 200
+        finally:
+            client.disconnect()
+            device.disconnect()
+
+
+def replay(client, path, **kwargs):
+    with TrafficLog(path) as traffic_log:
+        return TrafficReplayer(client, **kwargs).replay(traffic_log)
+
+
+@pytest.mark.parametrize("tap_client", [False, True])
+def test_recorded_requests_are_replayed_once_without_divergence(broker, client, tmp_path, tap_client):
+    path = tmp_path / "traffic.dablog"
+    # recorded without another device answering the requests
+    record_traffic(broker, path, tap_client=tap_client)
+
+    with TrafficLog(path) as traffic_log:
+        # the requests recorded by both the client and the device are replayed once
+        assert [topic.rpartition('/')[0] for _, topic, _, _ in TrafficReplayer.requests(traffic_log)] == [
+            "dab/applications/list", "dab/system/language/get", "dab/health-check/get"]
+    device = new_dab_0_1_device("device", Applications(), System(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    try:
+        report = replay(client, path, speed=None)
+    finally:
+        device.disconnect()
+
+    assert (report["requests"], report["responses"], report["failures"], report["timeouts"],
+            report["divergences"]) == (3, 3, 0, 0, 0)
+    assert report["topics"]["dab/health-check/get"] == {"requests": 1, "failures": 0, "timeouts": 0, "divergences": 0}
+
+
+def test_recording_to_an_existing_log_appends_to_it(broker, tmp_path):
+    path = tmp_path / "traffic.dablog"
+    record_traffic(broker, path, tap_client=False)
+    with TrafficLog(path) as traffic_log:
+        start_time = traffic_log.start_time
+        first_topics = [record.topic for record in traffic_log]
+
+    record_traffic(broker, path, tap_client=False)
+
+    with TrafficLog(path) as traffic_log:
+        assert traffic_log.start_time == start_time
+        topics = [record.topic for record in traffic_log]
+        assert len(TrafficReplayer.requests(traffic_log)) == 6
+    assert topics[:len(first_topics)] == first_topics
+    assert len(topics) == 2 * len(first_topics)
+
+
+def test_a_truncated_last_record_ends_the_log(tmp_path):
+    path = tmp_path / "traffic.dablog"
+    with TrafficRecorder(path) as recorder:
+        recorder.record(TAP_OUTBOUND, "dab/device/info/1", b'{}')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/device/info/1", b'{"status": 200}')
+    with open(path, 'r+b') as log:
+        log.truncate(path.stat().st_size - 3)
+
+    with TrafficLog(path) as traffic_log:
+        records = [(record.direction, record.topic, bytes(record.payload)) for record in traffic_log]
+        assert TrafficReplayer.requests(traffic_log) == []
+
+    assert records == [(TAP_OUTBOUND, "dab/device/info/1", b'{}')]
+
+
+def test_replay_reports_the_diverging_responses(device, client, tmp_path):
+    path = tmp_path / "traffic.dablog"
+    with TrafficRecorder(path) as recorder:
+        recorder.record(TAP_OUTBOUND, "dab/system/language/get/1", b'{}')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/system/language/get/1",
+                        b'{"status": 200, "language": "fr"}')
+        recorder.record(TAP_OUTBOUND, "dab/health-check/get/2", b'{}')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/health-check/get/2",
+                        b'{"status": 200, "healthy": false}')
+
+    report = replay(client, path, speed=None, max_divergences=1)
+
+    assert (report["requests"], report["responses"], report["divergences"]) == (2, 2, 2)
+    assert report["diverging_responses"] == [{"topic": "dab/system/language/get",
+                                              "expected": {"status": 200, "language": "fr"},
+                                              "actual": {"status": 200, "language": "en-US"}}]
+
+    # the keys ignored are left out of the comparison
+    report = replay(client, path, speed=None, ignore_keys=("language",))
+    assert report["topics"]["dab/system/language/get"]["divergences"] == 0
+    assert report["topics"]["dab/health-check/get"]["divergences"] == 1
+
+
+def test_a_request_that_cannot_be_sent_is_counted_as_a_failure(device, client, tmp_path):
+    path = tmp_path / "traffic.dablog"
+    with TrafficRecorder(path) as recorder:
+        recorder.record(TAP_OUTBOUND, "dab/system/language/get/1", b'not json')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/system/language/get/1", b'{"status": 200}')
+        recorder.record(TAP_OUTBOUND, "dab/health-check/get/2", b'{}')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/health-check/get/2",
+                        b'{"status": 200, "healthy": true}')
+
+    # a single slot: the slot of the failed request is released
+    report = replay(client, path, speed=None, max_in_flight=1)
+
+    assert (report["requests"], report["responses"], report["failures"], report["divergences"]) == (2, 1, 1, 0)
+    assert report["topics"]["dab/system/language/get"]["failures"] == 1
+
+
+class SilentClient(DabMqttClient):
+    """
+    A client whose requests are neither answered nor timed out
+    """
+
+    def send_request(self, topic, payload, on_response, timeout_s=None, request_id=None, on_timeout=None):
+        return object()
+
+    def discard_request(self, message_in_flight):
+        pass
+
+
+def test_replay_stops_awaiting_requests_that_never_time_out(broker, tmp_path):
+    path = tmp_path / "traffic.dablog"
+    with TrafficRecorder(path) as recorder:
+        recorder.record(TAP_OUTBOUND, "dab/health-check/get/1", b'{}')
+        recorder.record(TAP_INBOUND, RESPONSE_TOPIC_PREFIX + "dab/health-check/get/1", b'{"status": 200}')
+    client = SilentClient("silent-client", transport=broker.transport("silent-client"))
+    client.connect("localhost", 1883)
+    try:
+        report = replay(client, path, speed=None, timeout_s=0.1)
+    finally:
+        client.disconnect()
+
+    assert (report["requests"], report["responses"], report["timeouts"]) == (1, 0, 1)
+    assert report["duration_s"] < 5
+
+
+# DabMetrics
+
+def test_metrics_sum_the_gauges_registered_under_the_same_name():
+    metrics = DabMetrics()
+    metrics.register_gauge("requests_in_flight", lambda: 2)
+    metrics.register_gauge("requests_in_flight", lambda: 3)
+
+    assert metrics.snapshot()["gauges"] == {"requests_in_flight": 5}
+    assert "dab_requests_in_flight 5" in metrics.to_prometheus()
+
+
+def test_metrics_count_the_responses_without_a_status_as_unknown():
+    metrics = DabMetrics()
+    metrics.request_handled("dab/applications/list", None, 0.001)
+    metrics.request_handled("dab/applications/list", 200, 0.001)
+    metrics.request_handled("dab/applications/list", 200, 0.001)
+    metrics.request_handled("dab/health-check/get", None, 0.001)
+
+    counters = metrics.snapshot()["counters"]["responses_sent"]
+    assert counters["dab/applications/list"] == {UNKNOWN_STATUS: 1, 200: 2}
+    assert counters["dab/health-check/get"] == {UNKNOWN_STATUS: 1}
+    assert 'status="unknown"' in metrics.to_prometheus()
+
+
+
+@pytest.mark.parametrize("samples, p, expected", [
+    ([], 50, None),
+    ([7], 99, 7),
+    ([1, 2, 3, 4], 0, 1),
+    ([1, 2, 3, 4], 50, 2.5),
+    ([1, 2, 3, 4], 100, 4),
+    (list(range(101)), 90, 90),
+    ([0, 10], 99, 9.9),
+])
+def test_percentile_interpolates_between_the_closest_ranks(samples, p, expected):
+    assert percentile(samples, p) == expected
+
+
+# telemetry capabilities
+
+class TelemetryWithoutAppMetrics:
+    def __init__(self):
+        self.telemetry = Telemetry()
+        self.start_device_telemetry = self.telemetry.start_device_telemetry
+        self.stop_device_telemetry = self.telemetry.stop_device_telemetry
+        self.start_app_telemetry = self.telemetry.start_app_telemetry
+        self.stop_app_telemetry = self.telemetry.stop_app_telemetry
+        self.device_metrics = self.telemetry.device_metrics
+
+
+def test_device_requires_the_telemetry_sample_methods(broker):
+    with pytest.raises(TypeError, match="does not implement app_metrics, required by dab/app-telemetry/start"):
+        new_dab_0_1_device("device", Applications(), System(), TelemetryWithoutAppMetrics(), {"model": "test"},
+                           transport=broker.transport("device"))
+
+
+def drain(stream):
+    messages = []
+    message = stream.get(timeout_s=0)
+    while message is not None:
+        messages.append(message)
+        message = stream.get(timeout_s=0)
+    return messages
+
+
+@pytest.mark.parametrize("operation, payload, metrics_topic, metric", [
+    ("device-telemetry", {}, "dab/device-telemetry/metrics", "cpu"),
+    ("app-telemetry", {"appId": "Netflix"}, "dab/app-telemetry/metrics/Netflix", "memory"),
+])
+def test_telemetry_stream_publishes_at_the_requested_frequency_until_stopped(client, device, operation, payload,
+                                                                           metrics_topic, metric):
+    stream = client.stream(metrics_topic)
+    assert client.request(f"dab/{operation}/start", dict(payload, frequency=50))["status"] == 200
+
+    samples = [stream.get(timeout_s=5) for _ in range(6)]
+    started = time.monotonic()
+    samples.extend(stream.get(timeout_s=5) for _ in range(4))
+    # 4 intervals of 50 milliseconds, not a burst of samples
+    assert 0.1 < time.monotonic() - started < 1.5
+    assert all(topic == metrics_topic and sample["metric"] == metric for topic, sample in samples)
+
+    assert client.request(f"dab/{operation}/stop", payload)["status"] == 200
+    # a sample published before the stop may still be on its way
+    time.sleep(0.1)
+    drain(stream)
+    time.sleep(0.3)
+    assert drain(stream) == []
+    stream.close()
+
+
+class TelemetrySamplingWithoutAppId(Telemetry):
+    def app_metrics(self):
+        return {}
+
+
+def test_device_checks_the_signature_of_the_telemetry_sample_methods(broker):
+    with pytest.raises(TypeError, match="app_metrics"):
+        new_dab_0_1_device("device", Applications(), System(), TelemetrySamplingWithoutAppId(), {"model": "test"},
+                           transport=broker.transport("device"))
+
+
+# optional operations
+
+class SystemWithoutKeySequence:
+    def __init__(self):
+        system = System()
+        for method in ("restart", "list_languages", "get_language", "set_language", "key_press", "long_key_press",
+                       "health_check"):
+            setattr(self, method, getattr(system, method))
+
+
+class SystemWithKeySequenceWithoutProgress(System):
+    def key_sequence(self, keys, delay_ms=0, stop_on_error=True):
+        return {"status": 200}
+
+
+def test_device_without_an_optional_operation_does_not_serve_it(broker, client):
+    device = new_dab_0_1_device("device", Applications(), SystemWithoutKeySequence(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    try:
+        handled = {request_handler.topic for request_handler in device.request_handlers}
+        assert "dab/input/key-sequence" not in handled
+        assert "dab/input/key-press" in handled
+        assert client.request("dab/input/key-press", {"keyCode": "KEY_ENTER"}, timeout_s=5)["status"] == 200
+    finally:
+        device.disconnect()
+
+
+def test_device_checks_the_signature_of_an_optional_operation(broker):
+    with pytest.raises(TypeError, match="key_sequence"):
+        new_dab_0_1_device("device", Applications(), SystemWithKeySequenceWithoutProgress(), Telemetry(),
+                           {"model": "test"}, transport=broker.transport("device"))
+
+
+
+class PortWithoutSamples:
+    def start(self):
+        return {"status": 200}
+
+
+@pytest.mark.parametrize("optional", [False, True])
+def test_registry_serves_an_operation_without_its_required_methods_only_when_optional(optional, caplog):
+    operations = OperationRegistry()
+    operations.declare("dab/port/start", "port.start", optional=optional, requires=(("port.sample", ()),))
+
+    if not optional:
+        with pytest.raises(TypeError, match="does not implement sample, required by dab/port/start"):
+            operations.request_handlers({"port": PortWithoutSamples()})
+        return
+    with caplog.at_level("INFO", logger="dab.operations"):
+        assert operations.request_handlers({"port": PortWithoutSamples()}) == []
+    assert "dab/port/start is not served, the ports do not implement port.sample" in caplog.text
+
+
+# SampleRing and Downsampler
+
+def test_sample_ring_overwrites_the_oldest_samples_when_full():
+    ring = SampleRing(3)
+    for sample in range(5):
+        ring.append(sample)
+
+    assert ring.samples() == [2, 3, 4]
+    assert len(ring) == 3
+    assert ring.dropped == 2
+
+    ring.clear()
+    assert ring.samples() == []
+    assert ring.dropped == 0
+    ring.append(5)
+    assert ring.samples() == [5]
+
+
+def test_sample_ring_requires_a_positive_capacity():
+    with pytest.raises(ValueError):
+        SampleRing(0)
+
+
+def test_downsampler_reduces_each_window():
+    downsampler = Downsampler(3)
+
+    assert downsampler.add({"timestamp": 1, "value": 4}) is None
+    assert downsampler.add({"timestamp": 2, "value": 1}) is None
+    assert downsampler.add({"timestamp": 3, "value": 7}) == {"timestamp": 1, "min": 1, "max": 7, "mean": 4, "count": 3}
+    assert len(downsampler) == 0
+
+    assert downsampler.add({"timestamp": 4, "value": 2}) is None
+    assert downsampler.reduce() == {"timestamp": 4, "min": 2, "max": 2, "mean": 2, "count": 1}
+    assert downsampler.reduce() is None
+
+
+def test_telemetry_batch_is_published_when_full_or_after_the_flush_interval():
+    batch = TelemetryBatching(max_samples=3, flush_interval_ms=100).new_batch(interval_ms=10)
+
+    assert not batch.add({"value": 1}, now=0)
+    assert batch.add({"value": 2}, now=0.1)
+    batch.clear()
+    assert not batch.pending()
+
+    for now in (1, 1.01, 1.02):
+        full = batch.add({"value": now}, now=now)
+    assert full
+    batch.add({"value": 4}, now=1.03)
+    assert batch.payload() == {"samples": [{"value": 1.01}, {"value": 1.02}, {"value": 4}], "dropped": 1}
+
+
+def test_telemetry_batch_downsamples_and_closes_the_last_window():
+    batch = TelemetryBatching(max_samples=8, downsample_window_ms=30).new_batch(interval_ms=10)
+    for value in range(1, 5):
+        batch.add({"value": value}, now=0)
+    batch.close_window()
+
+    assert batch.payload()["samples"] == [{"min": 1, "max": 3, "mean": 2, "count": 3},
+                                          {"min": 4, "max": 4, "mean": 4, "count": 1}]
+
+
+# TelemetryAggregator and SubscriptionStream
+
+@pytest.fixture(params=["python", "numpy"])
+def aggregator_columns(request, monkeypatch):
+    """
+    Runs a test with the standard library columns of the aggregator, and with the numpy ones when numpy is installed
+    """
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr("telemetry_aggregator.numpy", None)
+    return request.param
+
+
+def sample(metric, value, timestamp_s):
+    return {"metric": metric, "value": value, "timestamp": int(timestamp_s * 1000)}
+
+
+def test_aggregator_columns_keep_the_latest_samples(aggregator_columns):
+    aggregator = TelemetryAggregator(capacity=3)
+    for second in range(5):
+        aggregator.on_message("tv-1/dab/device-telemetry/metrics", sample("cpu", second, 100 + second))
+
+    series = aggregator.series[("tv-1/dab/device-telemetry/metrics", "cpu")]
+    assert [float(value) for value in series.values.values()] == [2, 3, 4]
+    assert [float(timestamp) for timestamp in series.timestamps.values()] == [102, 103, 104]
+    assert aggregator.stats(now=105, window_s=10)["count"] == 3
+
+
+def test_aggregator_computes_the_statistics_of_the_window(aggregator_columns):
+    aggregator = TelemetryAggregator()
+    for second in range(10):
+        aggregator.on_message("tv-1/dab/device-telemetry/metrics", sample("cpu", second, 100 + second))
+    # a batch of downsampled samples, counted by their mean
+    aggregator.on_message("tv-2/dab/device-telemetry/metrics", {"samples": [
+        {"metric": "cpu", "mean": 20, "timestamp": 108000}, {"metric": "cpu", "mean": 30, "timestamp": 109000}]})
+    # samples without a numeric value are ignored
+    aggregator.on_message("tv-2/dab/device-telemetry/metrics", sample("cpu", True, 109))
+    aggregator.on_message("tv-2/dab/device-telemetry/metrics", sample("cpu", "high", 109))
+    aggregator.on_message("tv-2/dab/device-telemetry/metrics", sample("memory", 512, 109))
+
+    stats = aggregator.stats("+/dab/device-telemetry/metrics", metric="cpu", window_s=4, now=110)
+
+    # 6, 7, 8 and 9 of tv-1, 20 and 30 of tv-2
+    assert {key: stats[key] for key in ("count", "rate", "min", "max", "mean")} == {
+        "count": 6, "rate": 1.5, "min": 6, "max": 30, "mean": 80 / 6}
+    assert stats["percentiles"] == {50: 8.5, 90: 25, 99: pytest.approx(29.5)}
+    assert aggregator.stats("tv-1/#", metric="cpu", window_s=4, now=110)["count"] == 4
+    assert aggregator.stats(metric="memory", window_s=4, now=110)["mean"] == 512
+    assert aggregator.topics("+/dab/device-telemetry/metrics") == ["tv-1/dab/device-telemetry/metrics",
+                                                                   "tv-2/dab/device-telemetry/metrics"]
+
+
+def test_aggregator_statistics_of_an_empty_window_are_none(aggregator_columns):
+    aggregator = TelemetryAggregator()
+    aggregator.on_message("tv-1/dab/device-telemetry/metrics", sample("cpu", 1, 100))
+
+    assert aggregator.stats(window_s=10, now=200) == {
+        "count": 0, "rate": 0.0, "min": None, "max": None, "mean": None, "percentiles": {50: None, 90: None, 99: None}}
+
+
+def test_stream_drops_the_oldest_messages_when_the_reader_falls_behind(broker, client):
+    stream = client.stream("telemetry/#", max_queued=3)
+    publisher = broker.transport("publisher")
+    publisher.connect()
+    for index in range(5):
+        publisher.publish(f"telemetry/{index}", str(index).encode(), qos=0, retain=False)
+    # the messages are delivered on the thread of the client
+    deadline = time.monotonic() + 5
+    while stream.dropped < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert [stream.get(timeout_s=5) for _ in range(3)] == [("telemetry/2", 2), ("telemetry/3", 3),
+                                                           ("telemetry/4", 4)]
+    assert stream.dropped == 2
+    assert stream.get(timeout_s=0.01) is None
+
+
+def test_closing_a_stream_ends_its_iteration(broker, client):
+    stream = client.stream("telemetry/#")
+    publisher = broker.transport("publisher")
+    publisher.connect()
+    publisher.publish("telemetry/1", b'1', qos=0, retain=False)
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(stream))
+    reader.start()
+
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stream.close()
+    reader.join(5)
+
+    assert not reader.is_alive()
+    assert received == [("telemetry/1", 1)]
+    # the messages published after the stream is closed are not received
+    publisher.publish("telemetry/2", b'2', qos=0, retain=False)
+    assert stream.get(timeout_s=0.01) is None
+
+
+# RequestDeduplicator and the retries
+
+def test_deduplicator_answers_the_duplicates_once_the_request_completes():
+    dedup = RequestDeduplicator(ttl_s=60)
+
+    assert dedup.begin("dab/applications/launch/1") == (NEW_REQUEST, None)
+    assert dedup.begin("dab/applications/launch/1") == (IN_PROGRESS, None)
+    dedup.complete("dab/applications/launch/1", b'{"status": 200}')
+    assert dedup.begin("dab/applications/launch/1") == (COMPLETED, b'{"status": 200}')
+    assert dedup.begin("dab/applications/launch/2") == (NEW_REQUEST, None)
+
+    dedup.discard("dab/applications/launch/2")
+    assert dedup.begin("dab/applications/launch/2") == (NEW_REQUEST, None)
+
+
+def test_deduplicator_forgets_the_oldest_requests():
+    dedup = RequestDeduplicator(ttl_s=60, max_entries=2)
+    for request_id in range(3):
+        dedup.begin(f"dab/health-check/get/{request_id}")
+
+    assert len(dedup) == 2
+    assert dedup.begin("dab/health-check/get/0") == (NEW_REQUEST, None)
+
+
+class SlowApplications(Applications):
+    def __init__(self, delay_s):
+        super(SlowApplications, self).__init__()
+        self.delay_s = delay_s
+        self.launches = 0
+
+    def launch(self, app_id, params):
+        self.launches += 1
+        time.sleep(self.delay_s)
+        return super(SlowApplications, self).launch(app_id, params)
+
+
+def test_request_sent_again_with_its_request_id_is_executed_once(broker, client):
+    applications = SlowApplications(delay_s=0)
+    device = new_dab_0_1_device("device", applications, System(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    try:
+        for _ in range(2):
+            response = client.request("dab/applications/launch", {"appId": "Netflix"}, request_id="launch-1")
+            assert response["status"] == 200
+    finally:
+        device.disconnect()
+
+    assert applications.launches == 1
+
+
+def test_scenario_retries_a_timed_out_request_with_its_request_id(broker, client):
+    applications = SlowApplications(delay_s=0.3)
+    device = new_dab_0_1_device("device", applications, System(), Telemetry(), {"model": "test"},
+                                handler_workers=2, transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    scenario = Scenario.from_dict({
+        "name": "slow-launch",
+        "steps": [{"operation": "launch_app", "args": {"app_id": "Netflix"}, "timeout_s": 0.1, "retries": 10}],
+    })
+    try:
+        report = ScenarioRunner(client).run(scenario)
+    finally:
+        device.disconnect()
+
+    assert report["passed"] == 1
+    assert report["steps"][0]["timeouts"] > 0
+    assert applications.launches == 1
+
+
+def test_scenario_counts_only_the_timeouts_as_timeouts(broker, client, device):
+    scenario = Scenario.from_dict({
+        "name": "failures",
+        "timeout_s": 0.2,
+        "retries": 1,
+        "steps": [
+            {"operation": "health_check", "continue_on_failure": True},
+            # the payload cannot be serialized: the client fails, without a retry
+            {"operation": "launch_app", "args": {"app_id": "Netflix", "parameters": {"x": object()}},
+             "continue_on_failure": True},
+        ],
+    })
+    runner = ScenarioRunner(client, {"device": None, "missing": "lab/missing"})
+
+    report = runner.run(scenario)
+
+    health_check, launch = report["steps"]
+    assert (health_check["passed"], health_check["failed"], health_check["timeouts"]) == (1, 1, 2)
+    assert (launch["failed"], launch["attempts"], launch["timeouts"]) == (2, 2, 0)
+    assert all(failure["error"].startswith("TypeError") for failure in report["failures"] if failure["step"] == 1)
+
+
+def test_the_instances_of_an_exclusive_scenario_do_not_overlap_on_a_device(broker, client):
+    applications = SlowApplications(0.01)
+    device = new_dab_0_1_device("device", applications, System(), Telemetry(), {"model": "test"},
+                                handler_workers=4, transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    scenario = Scenario.from_dict({
+        "name": "launch-and-exit",
+        "exclusive": True,
+        "steps": [
+            {"operation": "launch_app", "args": {"app_id": "Netflix"}},
+            {"operation": "get_app_state", "args": {"app_id": "Netflix"}, "expect": {"state": FOREGROUND}},
+            {"operation": "exit_app", "args": {"app_id": "Netflix", "force": True}},
+            {"operation": "get_app_state", "args": {"app_id": "Netflix"}, "expect": {"state": STOPPED}},
+        ],
+    })
+    try:
+        report = ScenarioRunner(client, max_concurrency=8).run(scenario, instances=8)
+    finally:
+        device.disconnect()
+
+    assert (report["passed"], report["failed"], report["exclusive"]) == (8, 0, True)
+    assert applications.launches == 8
+    assert Scenario.from_dict({"steps": []}).exclusive is False
+
+
+def test_scenario_does_not_count_the_client_errors_as_timeouts(broker):
+    disconnected = DabMqttClient("disconnected", transport=broker.transport("disconnected"))
+    scenario = Scenario.from_dict({"steps": [{"operation": "health_check", "retries": 1}]})
+
+    report = ScenarioRunner(disconnected).run(scenario)
+
+    assert report["failed"] == 1
+    assert (report["steps"][0]["attempts"], report["steps"][0]["timeouts"]) == (2, 0)
+    assert "not connected" in report["failures"][0]["error"]
+
+
+def test_scenario_operations_return_a_response():
+    assert "watch_app_states" not in OPERATIONS
+    with pytest.raises(ValueError):
+        Scenario.from_dict({"steps": [{"operation": "watch_app_states", "args": {"on_change": None}}]})
+
+
+# TimerWheel and the request timeouts
+
+def test_timer_wheel_fires_the_timers_in_order_never_early():
+    wheel = TimerWheel(tick_ms=5, slots=4)
+    fired = []
+    done = threading.Event()
+    started = time.monotonic()
+
+    def fire(name):
+        fired.append((name, time.monotonic() - started))
+        if len(fired) == 3:
+            done.set()
+
+    # 0.1 seconds is several rounds of the 4 slots
+    wheel.schedule(0.1, lambda: fire("late"))
+    wheel.schedule(0.01, lambda: fire("early"))
+    wheel.schedule(0.05, lambda: fire("middle"))
+
+    assert done.wait(5)
+    assert [name for name, _ in fired] == ["early", "middle", "late"]
+    assert [elapsed_s >= delay_s for (_, elapsed_s), delay_s in zip(fired, (0.01, 0.05, 0.1))] == [True] * 3
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_cancels_the_timers():
+    wheel = TimerWheel(tick_ms=5)
+    fired = threading.Event()
+    timer = wheel.schedule(0.02, fired.set)
+
+    assert timer.cancel()
+    assert not timer.cancel()
+    assert len(wheel) == 0
+    assert not fired.wait(0.1)
+
+
+def test_send_request_calls_on_timeout_without_a_response(client):
+    timed_out = threading.Event()
+    message_in_flight = client.send_request("dab/unknown/operation", {}, lambda response: None, timeout_s=0.05,
+                                            on_timeout=timed_out.set)
+    try:
+        assert timed_out.wait(5)
+        assert message_in_flight.response is None
+    finally:
+        client.discard_request(message_in_flight)
+
+
+class RecordingSystem(System):
+    def __init__(self):
+        super(RecordingSystem, self).__init__()
+        self.health_checks = 0
+
+    def health_check(self):
+        self.health_checks += 1
+        return super(RecordingSystem, self).health_check()
+
+
+def test_device_drops_the_requests_past_their_relative_timeout(broker, client):
+    system = RecordingSystem()
+    device = new_dab_0_1_device("device", Applications(), system, Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"))
+    device.connect("localhost", 1883)
+    try:
+        # sent without a timeout of the client, so that the payload keeps its own
+        responded = threading.Event()
+        message_in_flight = client.send_request("dab/health-check/get", {"_timeoutMs": 0},
+                                                lambda response: responded.set())
+        try:
+            assert not responded.wait(0.2)
+        finally:
+            client.discard_request(message_in_flight)
+
+        assert client.request("dab/health-check/get", {}, timeout_s=5)["status"] == 200
+    finally:
+        device.disconnect()
+
+    assert system.health_checks == 1
+
+
+# payload compression
+
+def test_inflate_bounds_and_checks_the_compressed_payloads():
+    payload = b'{"appId": "' + b'a' * 4096 + b'"}'
+    compressed = zlib.compress(payload)
+
+    assert inflate(payload) == payload
+    assert inflate(compressed) == payload
+    with pytest.raises(ValueError, match="beyond"):
+        inflate(compressed, max_bytes=1024)
+    with pytest.raises(ValueError, match="Truncated"):
+        inflate(compressed[:-4])
+    with pytest.raises(ValueError, match="Invalid"):
+        inflate(b'\x78\x9c' + b'not deflate')
+
+
+def test_device_answers_the_requests_it_cannot_inflate_with_400(broker, client):
+    applications = SlowApplications(delay_s=0)
+    device = new_dab_0_1_device("device", applications, System(), Telemetry(), {"model": "test"},
+                                transport=broker.transport("device"),
+                                compression=PayloadCompression(max_inflated_bytes=1024))
+    device.connect("localhost", 1883)
+    responses = {}
+    responded = threading.Semaphore(0)
+
+    def on_response(topic, message):
+        responses[topic.rpartition('/')[2]] = message
+        responded.release()
+
+    client.subscribe("_response/dab/applications/launch/+", on_response)
+    try:
+        requests = {
+            "valid": zlib.compress(b'{"appId": "Netflix"}'),
+            "bomb": zlib.compress(b'{"appId": "' + b'a' * 4096 + b'"}'),
+            "truncated": zlib.compress(b'{"appId": "Netflix"}')[:-4],
+            "invalid": b'\x78\x9c' + b'not deflate',
+        }
+        for request_id, payload in requests.items():
+            broker.publish("dab/applications/launch/" + request_id, payload, 0, False)
+        for _ in requests:
+            assert responded.acquire(timeout=5)
+    finally:
+        device.disconnect()
+
+    assert {request_id: response["status"] for request_id, response in responses.items()} == \
+        {"valid": 200, "bomb": 400, "truncated": 400, "invalid": 400}
+    assert applications.launches == 1
+
+
+def test_client_without_compression_does_not_inflate(broker, client, device):
+    responded = threading.Event()
+    responses = []
+
+    def on_response(topic, message):
+        responses.append(message)
+        responded.set()
+
+    client.subscribe("_response/dab/health-check/get/+", on_response)
+    broker.publish("dab/health-check/get/compressed", zlib.compress(b'{}'), 0, False)
+
+    assert responded.wait(5)
+    assert responses == [{"status": 400, "error": "Request payload is not valid JSON"}]
+